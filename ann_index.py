@@ -0,0 +1,239 @@
+import math
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from face_detection import histogram_template_vectors
+
+# Rows converted to full-size vectors at a time
+VECTOR_CHUNK_SIZE = 1024
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbor index over face descriptors
+
+    Descriptor vectors are reduced with PCA and clustered with k-means; each
+    student is filed under the nearest cluster centroid (by Euclidean
+    distance, which for unit-length descriptors ranks like the score). A search only scores
+    the students in the nprobe clusters closest to the probe, and returns
+    the best candidates for an exact re-rank.
+    """
+
+    def __init__(self, dim: int = 64, nprobe: int = 0, pca_sample_size: int = 2048,
+                 kmeans_iterations: int = 10, seed: int = 0,
+                 vectorize: Callable[..., np.ndarray] = histogram_template_vectors):
+        """
+        Args:
+            dim: Dimensions kept by PCA
+            nprobe: Clusters scanned per search, 0 for all of them (a scan of
+                the reduced vectors, still far cheaper than the exact scan)
+            pca_sample_size: Rows used to fit the PCA projection
+            kmeans_iterations: Lloyd iterations when training the centroids
+            seed: Seed for sampling and centroid initialization
+            vectorize: Turns stacked gallery descriptors into vectors whose
+                inner products are the score, e.g. FaceDetector.descriptor_vectors
+        """
+        self.dim = dim
+        self.nprobe = nprobe
+        self.pca_sample_size = pca_sample_size
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.vectorize = vectorize
+        self.trained_size = 0
+        self._mean: Optional[np.ndarray] = None
+        self._components: Optional[np.ndarray] = None
+        self._centroids: Optional[np.ndarray] = None
+        self._list_ids: List[np.ndarray] = []
+        self._list_vectors: List[np.ndarray] = []
+        self._where: Dict[int, int] = {}
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    @property
+    def list_count(self) -> int:
+        """Number of clusters, 0 until trained"""
+        return 0 if self._centroids is None else len(self._centroids)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def ids(self) -> np.ndarray:
+        """Student ids of all indexed entries"""
+        return np.fromiter(self._where.keys(), dtype=np.int64, count=len(self._where))
+
+    def reset(self):
+        """Forget the training and all entries"""
+        self.trained_size = 0
+        self._mean = self._components = self._centroids = None
+        self._list_ids = []
+        self._list_vectors = []
+        self._where = {}
+
+    def _project(self, descriptors: Tuple[np.ndarray, ...]) -> np.ndarray:
+        count = len(descriptors[0])
+        reduced = np.empty((count, self._components.shape[0]), dtype=np.float32)
+        for start in range(0, count, VECTOR_CHUNK_SIZE):
+            stop = start + VECTOR_CHUNK_SIZE
+            vectors = self.vectorize(*(part[start:stop] for part in descriptors))
+            reduced[start:stop] = (vectors - self._mean) @ self._components.T
+        return reduced
+
+    def _centroid_distances(self, reduced: np.ndarray) -> np.ndarray:
+        # Squared distances up to the per-row constant |reduced|^2. Full
+        # descriptor vectors have unit length, so the closest vectors are the
+        # ones with the highest score
+        return (self._centroids * self._centroids).sum(axis=1) - 2 * (reduced @ self._centroids.T)
+
+    def _nearest_centroids(self, reduced: np.ndarray) -> np.ndarray:
+        return np.argmin(self._centroid_distances(reduced), axis=1)
+
+    def train(self, student_ids: np.ndarray, descriptors: Tuple[np.ndarray, ...]):
+        """
+        Fit the projection and centroids to a gallery and index all of it
+
+        Replaces everything indexed before.
+
+        Args:
+            student_ids: Student id of each row
+            descriptors: Gallery descriptor matrices, one row per student
+        """
+        rng = np.random.default_rng(self.seed)
+        count = len(student_ids)
+        nlist = max(1, int(math.sqrt(count)))
+
+        sample = np.sort(rng.choice(count, size=min(count, self.pca_sample_size), replace=False))
+        vectors = self.vectorize(*(part[sample] for part in descriptors))
+        self._mean = vectors.mean(axis=0)
+        _, _, vt = np.linalg.svd(vectors - self._mean, full_matrices=False)
+        self._components = np.ascontiguousarray(vt[:self.dim], dtype=np.float32)
+
+        reduced = self._project(descriptors)
+        centroids = reduced[rng.choice(count, size=nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            self._centroids = centroids
+            assignment = self._nearest_centroids(reduced)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, reduced)
+            sizes = np.bincount(assignment, minlength=nlist)
+            filled = sizes > 0
+            centroids[filled] = sums[filled] / sizes[filled, np.newaxis]
+        self._centroids = centroids
+
+        assignment = self._nearest_centroids(reduced)
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+        self._list_ids = [student_ids[order[bounds[i]:bounds[i + 1]]] for i in range(nlist)]
+        self._list_vectors = [reduced[order[bounds[i]:bounds[i + 1]]] for i in range(nlist)]
+        self._where = {int(student_id): int(list_index) for student_id, list_index in zip(student_ids, assignment)}
+        self.trained_size = count
+
+    def add(self, student_ids: np.ndarray, descriptors: Tuple[np.ndarray, ...]):
+        """File new entries under their nearest centroids; the index must be trained"""
+        self.remove(student_ids)
+        reduced = self._project(descriptors)
+        for student_id, vector, list_index in zip(student_ids, reduced, self._nearest_centroids(reduced)):
+            self._list_ids[list_index] = np.append(self._list_ids[list_index], np.int64(student_id))
+            self._list_vectors[list_index] = np.vstack([self._list_vectors[list_index], vector])
+            self._where[int(student_id)] = int(list_index)
+
+    def remove(self, student_ids):
+        """Drop entries; ids that are not indexed are ignored"""
+        by_list: Dict[int, List[int]] = {}
+        for student_id in student_ids:
+            list_index = self._where.pop(int(student_id), None)
+            if list_index is not None:
+                by_list.setdefault(list_index, []).append(int(student_id))
+        for list_index, removed in by_list.items():
+            keep = ~np.isin(self._list_ids[list_index], removed)
+            self._list_ids[list_index] = self._list_ids[list_index][keep]
+            self._list_vectors[list_index] = self._list_vectors[list_index][keep]
+
+    def search(self, probe: Tuple[np.ndarray, ...], candidates: int = 50,
+               nprobe: Optional[int] = None) -> np.ndarray:
+        """
+        Find the students whose descriptors are likely closest to a probe
+
+        Args:
+            probe: Probe descriptor (FaceDetector.face_descriptor)
+            candidates: Maximum number of student ids to return
+            nprobe: Clusters to scan, defaults to the index setting; 0 scans all
+
+        Returns:
+            numpy.ndarray: Candidate student ids, most similar first
+        """
+        reduced = self._project(tuple(np.asarray(part)[np.newaxis] for part in probe))[0]
+        nprobe = self.nprobe if nprobe is None else nprobe
+        if 0 < nprobe < len(self._centroids):
+            probed = np.argpartition(self._centroid_distances(reduced[np.newaxis])[0], nprobe - 1)[:nprobe]
+        else:
+            probed = np.arange(len(self._centroids))
+
+        ids = np.concatenate([self._list_ids[i] for i in probed])
+        if len(ids) == 0:
+            return ids
+        vectors = np.concatenate([self._list_vectors[i] for i in probed])
+        distances = (vectors * vectors).sum(axis=1) - 2 * (vectors @ reduced)
+        if len(ids) > candidates:
+            top = np.argpartition(distances, candidates - 1)[:candidates]
+            ids, distances = ids[top], distances[top]
+        return ids[np.argsort(distances, kind='stable')]
+
+    def save(self, path: str):
+        """Write the index to an .npz file"""
+        if not self.trained:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        sizes = np.array([len(ids) for ids in self._list_ids], dtype=np.int64)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                mean=self._mean,
+                components=self._components,
+                centroids=self._centroids,
+                list_sizes=sizes,
+                ids=np.concatenate(self._list_ids),
+                vectors=np.concatenate(self._list_vectors),
+                trained_size=np.int64(self.trained_size)
+            )
+        os.replace(temp_path, path)
+
+    def load(self, path: str) -> bool:
+        """
+        Read an index written by save()
+
+        Returns:
+            bool: True if the file existed and was read
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                mean = data['mean']
+                components = data['components']
+                centroids = data['centroids']
+                sizes = data['list_sizes']
+                ids = data['ids']
+                vectors = data['vectors']
+                trained_size = int(data['trained_size'])
+        except Exception as e:
+            print(f"Could not read ANN index {path}: {e}")
+            return False
+
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        self._mean, self._components, self._centroids = mean, components, centroids
+        self._list_ids = [ids[bounds[i]:bounds[i + 1]] for i in range(len(sizes))]
+        self._list_vectors = [vectors[bounds[i]:bounds[i + 1]] for i in range(len(sizes))]
+        self._where = {
+            int(student_id): list_index
+            for list_index, list_ids in enumerate(self._list_ids)
+            for student_id in list_ids
+        }
+        self.trained_size = trained_size
+        return True
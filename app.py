@@ -1,5 +1,6 @@
 import os
 import logging
+import multiprocessing
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -30,6 +31,124 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Face processing worker processes (0 runs face processing inline in the
+# request thread) and how many jobs may wait for a worker before new ones
+# are rejected with 503
+app.config['FACE_WORKERS'] = int(os.environ.get("FACE_WORKERS", "0"))
+app.config['FACE_QUEUE_SIZE'] = int(os.environ.get("FACE_QUEUE_SIZE", "16"))
+app.config['FACE_JOB_TIMEOUT'] = float(os.environ.get("FACE_JOB_TIMEOUT", "10"))
+
+# Live tracking sessions: run the full detector every N frames and follow
+# faces with optical flow in between; idle sessions expire after the TTL
+app.config['TRACKING_KEYFRAME_INTERVAL'] = int(os.environ.get("TRACKING_KEYFRAME_INTERVAL", "5"))
+app.config['TRACKING_SESSION_TTL'] = float(os.environ.get("TRACKING_SESSION_TTL", "60"))
+
+# How the live recognition page talks to the server: 'track' posts each frame
+# to /api/track_faces, 'stream' pushes JPEG frames and receives results over
+# Server-Sent Events (needs a threaded server, e.g. gunicorn --threads),
+# 'recognize' draws boxes from /api/detect_faces and, while "Continuous
+# recognition" is checked, posts to /api/recognize_face every 2 seconds.
+# Streaming cameras stop their processing thread after STREAM_IDLE_TIMEOUT seconds
+app.config['LIVE_TRANSPORT'] = os.environ.get("LIVE_TRANSPORT", "track")
+app.config['STREAM_IDLE_TIMEOUT'] = float(os.environ.get("STREAM_IDLE_TIMEOUT", "30"))
+
+# Longest side, in pixels, of the JPEG frames the live recognition page sends
+# for detection and tracking; recognition then uploads only the face crops,
+# cut from the full-resolution frame. 0 sends full-resolution PNG frames and
+# recognizes whole frames instead.
+app.config['LIVE_UPLOAD_SIZE'] = int(os.environ.get("LIVE_UPLOAD_SIZE", "320"))
+
+# Repeated frames of a recently recognized face are matched to their student
+# from a cache instead of scanning the gallery; entries are dropped when the
+# gallery changes
+app.config['RECOGNITION_CACHE_SIZE'] = int(os.environ.get("RECOGNITION_CACHE_SIZE", "1024"))
+app.config['RECOGNITION_CACHE_TTL'] = float(os.environ.get("RECOGNITION_CACHE_TTL", "30"))
+
+# Bulk enrollment: face detection processes, students per transaction and
+# the largest archive accepted by the API
+app.config['BULK_ENROLL_WORKERS'] = int(os.environ.get("BULK_ENROLL_WORKERS", str(os.cpu_count() or 1)))
+app.config['BULK_ENROLL_BATCH_SIZE'] = int(os.environ.get("BULK_ENROLL_BATCH_SIZE", "100"))
+app.config['BULK_ENROLL_MAX_SIZE'] = int(os.environ.get("BULK_ENROLL_MAX_SIZE", str(1024 * 1024 * 1024)))
+
+# Seconds the results of finished bulk enrollment and video jobs can still
+# be polled; at most 100 finished jobs of each kind are kept
+app.config['BACKGROUND_JOB_TTL'] = float(os.environ.get("BACKGROUND_JOB_TTL", "3600"))
+
+# Recorded video attendance: frames per second of video analyzed, sampled
+# frames a student must be matched in, face detection processes, longest
+# side frames are downscaled to and the largest upload accepted by the API
+app.config['VIDEO_SAMPLE_FPS'] = float(os.environ.get("VIDEO_SAMPLE_FPS", "2"))
+app.config['VIDEO_MIN_FRAMES'] = int(os.environ.get("VIDEO_MIN_FRAMES", "2"))
+app.config['VIDEO_WORKERS'] = int(os.environ.get("VIDEO_WORKERS", str(os.cpu_count() or 1)))
+app.config['VIDEO_FRAME_SIZE'] = int(os.environ.get("VIDEO_FRAME_SIZE", "1280"))
+app.config['VIDEO_MAX_SIZE'] = int(os.environ.get("VIDEO_MAX_SIZE", str(4 * 1024 * 1024 * 1024)))
+
+# Precomputed face descriptors of enrolled students, kept next to the database
+app.config['GALLERY_CACHE_PATH'] = os.environ.get(
+    "GALLERY_CACHE_PATH", os.path.join(app.instance_path, "gallery_cache.npz"))
+
+# Optional approximate nearest-neighbor index over the gallery: once the
+# gallery has GALLERY_ANN_MIN_SIZE students, only the index's best
+# GALLERY_ANN_CANDIDATES are scored exactly instead of every student
+app.config['GALLERY_ANN'] = os.environ.get("GALLERY_ANN", "0").lower() in ("1", "true", "yes", "on")
+app.config['GALLERY_ANN_PATH'] = os.environ.get(
+    "GALLERY_ANN_PATH", os.path.join(app.instance_path, "gallery_ann.npz"))
+app.config['GALLERY_ANN_MIN_SIZE'] = int(os.environ.get("GALLERY_ANN_MIN_SIZE", "2000"))
+# Index clusters searched per face (0 for all of them); the index has about
+# sqrt(gallery size) clusters, so 64 scans every cluster up to ~4000
+# students and a shrinking share above that, see benchmarks/gallery_ann.py
+app.config['GALLERY_ANN_NPROBE'] = int(os.environ.get("GALLERY_ANN_NPROBE", "64"))
+app.config['GALLERY_ANN_CANDIDATES'] = int(os.environ.get("GALLERY_ANN_CANDIDATES", "100"))
+
+# Face descriptor used for recognition: "histogram" (histogram + template
+# matching), "lbp" (LBP feature vectors) or "dnn" (embeddings from the ONNX
+# model at FACE_DESCRIPTOR_MODEL, falling back to lbp without it). Changing
+# it recomputes the gallery cache on the next start.
+app.config['FACE_DESCRIPTOR'] = os.environ.get("FACE_DESCRIPTOR", "histogram")
+app.config['FACE_DESCRIPTOR_MODEL'] = os.environ.get("FACE_DESCRIPTOR_MODEL", "face_recognition_sface_2021dec.onnx")
+# Minimum similarity for a match; empty uses the descriptor's default
+app.config['RECOGNITION_THRESHOLD'] = (
+    float(os.environ["RECOGNITION_THRESHOLD"]) if os.environ.get("RECOGNITION_THRESHOLD") else None)
+
+# Longest side, in pixels, of the working copy that face detection runs on;
+# larger uploads are downscaled for detection and faces are cropped from the
+# full-resolution image. 0 detects at full resolution.
+app.config['DETECTION_SIZE'] = int(os.environ.get("DETECTION_SIZE", "640"))
+
+# Model files (DNN face detector, face embedding model) are looked up here
+# first, then in OpenCV's bundled data
+app.config['FACE_MODELS_DIR'] = os.environ.get("FACE_MODELS_DIR", os.path.join(app.instance_path, "models"))
+
+# Student photo thumbnails: cache directory, width and height in pixels, and
+# how long browsers may use a thumbnail before revalidating it
+app.config['THUMBNAIL_CACHE_DIR'] = os.environ.get(
+    "THUMBNAIL_CACHE_DIR", os.path.join(app.instance_path, "thumbnails"))
+app.config['THUMBNAIL_SIZE'] = int(os.environ.get("THUMBNAIL_SIZE", "200"))
+app.config['THUMBNAIL_MAX_AGE'] = int(os.environ.get("THUMBNAIL_MAX_AGE", "86400"))
+
+# Attendance records are journaled to this file and written to the database
+# in the background, up to ATTENDANCE_BATCH_SIZE per transaction, after
+# waiting at most ATTENDANCE_FLUSH_MS for more check-ins to join
+app.config['ATTENDANCE_JOURNAL_PATH'] = os.environ.get(
+    "ATTENDANCE_JOURNAL_PATH", os.path.join(app.instance_path, "attendance_journal.jsonl"))
+app.config['ATTENDANCE_BATCH_SIZE'] = int(os.environ.get("ATTENDANCE_BATCH_SIZE", "64"))
+app.config['ATTENDANCE_FLUSH_MS'] = float(os.environ.get("ATTENDANCE_FLUSH_MS", "5"))
+# Seconds a request waits for queued attendance records to be written, e.g.
+# before deleting a student
+app.config['ATTENDANCE_FLUSH_TIMEOUT'] = float(os.environ.get("ATTENDANCE_FLUSH_TIMEOUT", "5"))
+
+# Use SQLite's write-ahead log, so page loads don't block check-ins
+app.config['SQLITE_WAL'] = os.environ.get("SQLITE_WAL", "1").lower() in ("1", "true", "yes", "on")
+
+# When the startup work (database upgrade, face models, gallery cache) runs:
+# 'request' starts it in the background with the first request, typically the
+# readiness probe (/readyz); 'preload' does the models and gallery at import,
+# so with gunicorn --preload they are loaded once and shared copy-on-write by
+# the workers. Requests other than /healthz, /readyz and /metrics wait up to
+# STARTUP_TIMEOUT seconds for the startup work.
+app.config['STARTUP_WARMUP'] = os.environ.get("STARTUP_WARMUP", "request")
+app.config['STARTUP_TIMEOUT'] = float(os.environ.get("STARTUP_TIMEOUT", "60"))
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -40,9 +159,23 @@ with app.app_context():
     # Make sure to import the models here or their tables won't be created
     import models  # noqa: F401
     import routes  # noqa: F401
+    import migrations
     
     # Add moment to Jinja2 globals for date handling
     from datetime import datetime
     app.jinja_env.globals['moment'] = lambda: datetime.now()
     
-    db.create_all()
\ No newline at end of file
+    if app.config['SQLITE_WAL']:
+        migrations.enable_sqlite_wal(db.engine)
+
+# Models, gallery and worker processes are loaded by routes.warmup, not here,
+# so CLI commands and forked servers don't pay for them at import. Face worker
+# processes import the main module again when they start; they load their own
+# models and must not preload the web process's.
+if app.config['STARTUP_WARMUP'] == 'preload' and multiprocessing.parent_process() is None:
+    routes.warmup.preload()
+
+# Don't hand the connections opened above (WAL setup, schema upgrade, gallery)
+# to processes forked from this one, e.g. gunicorn --preload workers
+with app.app_context():
+    db.engine.dispose()
@@ -0,0 +1,123 @@
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class AttendanceStateCache:
+    """
+    Today's attendance state per student, kept in memory
+
+    Holds each student's last status and timestamp for the current day and
+    the latest check-in/out per status within the duplicate window, so the
+    in/out toggle and duplicate check need no database reads. The state is
+    warmed from the database at startup and updated on every write.
+
+    The state lives in the web process; with several web processes each
+    would only see its own writes, so run one process with threads.
+    """
+
+    def __init__(self, debounce_window: timedelta = timedelta(minutes=5)):
+        """
+        Args:
+            debounce_window: Period in which the same status is not recorded twice
+        """
+        self.debounce_window = debounce_window
+        self._day = date.today()
+        self._last: Dict[int, Tuple[str, datetime]] = {}
+        self._recent: Dict[Tuple[int, str], datetime] = {}
+        self._lock = threading.Lock()
+
+    def warm(self, records: Iterable[Tuple[int, str, datetime, date]]):
+        """
+        Replace the state with attendance records read from the database
+
+        Args:
+            records: (student_id, status, timestamp, date) of today's records
+                and of the records within the duplicate window, oldest first
+        """
+        with self._lock:
+            self._day = date.today()
+            self._last = {}
+            self._recent = {}
+            for student_id, status, timestamp, day in records:
+                if day == self._day:
+                    self._last[student_id] = (status, timestamp)
+                key = (student_id, status)
+                if key not in self._recent or timestamp > self._recent[key]:
+                    self._recent[key] = timestamp
+
+    def _roll_over(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._last = {}
+
+        # Attendance timestamps are naive UTC
+        since = datetime.utcnow() - self.debounce_window
+        self._recent = {key: timestamp for key, timestamp in self._recent.items() if timestamp >= since}
+
+    def last(self, student_id: int) -> Optional[Tuple[str, datetime]]:
+        """Today's last (status, timestamp) of a student, or None"""
+        with self._lock:
+            self._roll_over()
+            return self._last.get(student_id)
+
+    def mark(self, student_id: int, timestamp: datetime, debounce: bool = True) -> Tuple[str, bool]:
+        """
+        Decide a student's next status and record it
+
+        If the last entry today was 'in' the next status is 'out', otherwise
+        'in'. Deciding and recording happen under one lock, so concurrent
+        recognitions of the same student can't both check in.
+
+        Args:
+            student_id: Database id of the student
+            timestamp: Timestamp of the new attendance record
+            debounce: Skip the status if it was already recorded within the
+                duplicate window
+
+        Returns:
+            (status, already_marked): The new status, and whether it is a
+            duplicate that was not recorded
+        """
+        with self._lock:
+            self._roll_over()
+            last = self._last.get(student_id)
+            status = 'out' if last is not None and last[0] == 'in' else 'in'
+            if debounce and (student_id, status) in self._recent:
+                return status, True
+
+            self._last[student_id] = (status, timestamp)
+            self._recent[(student_id, status)] = timestamp
+            return status, False
+
+    def record(self, student_id: int, status: str, timestamp: datetime, day: date):
+        """
+        Add a record whose status was decided elsewhere, e.g. a check-in
+        found in a recorded video
+
+        Unlike mark(), the record may be older than the student's last one;
+        it only becomes the last status if it is the latest of today.
+
+        Args:
+            student_id: Database id of the student
+            status: 'in' or 'out'
+            timestamp: Timestamp of the record
+            day: Date of the record
+        """
+        with self._lock:
+            self._roll_over()
+            last = self._last.get(student_id)
+            if day == self._day and (last is None or timestamp >= last[1]):
+                self._last[student_id] = (status, timestamp)
+            key = (student_id, status)
+            if timestamp >= datetime.utcnow() - self.debounce_window \
+                    and (key not in self._recent or timestamp > self._recent[key]):
+                self._recent[key] = timestamp
+
+    def forget(self, student_id: int):
+        """Drop all state of a student, e.g. after the student was deleted"""
+        with self._lock:
+            self._last.pop(student_id, None)
+            for key in [key for key in self._recent if key[0] == student_id]:
+                del self._recent[key]
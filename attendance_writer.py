@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import Table, and_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from metrics import ATTENDANCE_BATCH_RECORDS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Errors of an unavailable database (locked, unreachable, out of space),
+# after which the same records are retried rather than set aside
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class AttendanceWriter:
+    """
+    Write-behind attendance inserts, committed in groups
+
+    submit() appends new records to an append-only journal file, syncs it to
+    disk and queues the records; a background thread inserts everything
+    queued in one transaction once batch_size records are waiting or
+    flush_interval seconds have passed. The check-ins of a busy moment thus
+    share one database commit instead of each taking SQLite's write lock.
+
+    The journal is emptied whenever all journaled records are committed.
+    Records still in it at startup, after a crash or while the database
+    could not be written, are replayed by start(); records that did reach
+    the database are recognized by their key columns and skipped. A commit
+    must be on disk when it returns for this to hold (for SQLite in WAL
+    mode, synchronous=FULL; see migrations.enable_sqlite_wal).
+
+    If the database rejects a batch, its records are inserted one at a
+    time and those rejected on their own are set aside in a rejects file,
+    so one bad record doesn't hold up the check-ins behind it.
+
+    Like AttendanceStateCache, the journal belongs to one web process.
+    """
+
+    def __init__(self, table: Table, journal_path: str, batch_size: int = 64,
+                 flush_interval: float = 0.005, retry_interval: float = 1.0,
+                 key_columns: Sequence[str] = ('student_id', 'timestamp', 'status'),
+                 rejects_path: Optional[str] = None):
+        """
+        Args:
+            table: Table the records are inserted into
+            journal_path: Append-only file holding the uncommitted records
+            batch_size: Most records per transaction
+            flush_interval: Seconds the first queued record waits for others
+            retry_interval: Seconds to wait after a failed transaction
+            key_columns: Columns identifying a record when the journal is replayed
+            rejects_path: Append-only file for records the database rejects
+                (default: the journal path with a .rejected suffix)
+        """
+        self.table = table
+        self.journal_path = journal_path
+        self.rejects_path = rejects_path or journal_path + '.rejected'
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.key_columns = tuple(key_columns)
+        self.engine: Optional[Engine] = None
+        # Every record gets a value for each column, so the records of a
+        # batch bind the same parameters
+        self._defaults = {column.name: column.default for column in table.columns if not column.primary_key}
+        # Journaled as ISO strings and parsed back on replay
+        self._temporal = {
+            column.name: column.type.python_type for column in table.columns
+            if column.type.python_type in (date, datetime)
+        }
+        self._condition = threading.Condition()
+        self._queue: List[Dict] = []
+        self._unsaved = 0  # Journaled records not committed yet
+        self._journal = None
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        """Records submitted but not committed yet"""
+        with self._condition:
+            return self._unsaved
+
+    def start(self, engine: Engine, timeout: float = 10.0):
+        """
+        Replay the journal and start the writer thread
+
+        Waits up to timeout seconds for the replayed records to be
+        committed, so the database is complete when start() returns.
+
+        Args:
+            engine: Engine of the database the records are written to
+        """
+        self.engine = engine
+        replayed = self._unwritten(self._read_journal())
+        if replayed:
+            logger.info('Replaying %d attendance record(s) from %s', len(replayed), self.journal_path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+        with self._condition:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            if not replayed:
+                self._truncate_journal()
+            self._queue = replayed
+            self._unsaved = len(replayed)
+            self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self._thread.start()
+        if replayed and not self.flush(timeout):
+            logger.warning('Replayed attendance records are not committed yet, the writer keeps retrying')
+
+    def stop(self, timeout: float = 10.0):
+        """Commit the queued records and stop the writer thread"""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+        with self._condition:
+            self._journal.close()
+            self._journal = None
+
+    def submit(self, records: List[Dict]):
+        """
+        Journal and queue new records
+
+        The records are on disk when submit() returns and are committed to
+        the database shortly after. Columns a record leaves out get their
+        default when it is submitted (None without one), so defaults that
+        depend on the time of writing (e.g. the date) are those of submit(),
+        not of a later write or replay.
+
+        Args:
+            records: Column values of each new row
+
+        Raises:
+            OSError: If the journal could not be written; nothing is queued
+            RuntimeError: If the writer is not running
+        """
+        if not records:
+            return
+        records = [self._complete(record) for record in records]
+        lines = ''.join(json.dumps(self._encode(record)) + '\n' for record in records)
+        with self._condition:
+            if self._journal is None:
+                raise RuntimeError('Attendance writer is not running')
+            self._journal.write(lines)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._queue.extend(records)
+            self._unsaved += len(records)
+            self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every submitted record is committed
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        with self._condition:
+            if self._thread is None:
+                return self._unsaved == 0
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._unsaved == 0, timeout)
+
+    def _complete(self, record: Dict) -> Dict:
+        complete = {}
+        for name, default in self._defaults.items():
+            if name in record:
+                complete[name] = record[name]
+            elif default is not None and default.is_scalar:
+                complete[name] = default.arg
+            elif default is not None and default.is_callable:
+                complete[name] = default.arg(None)
+            else:
+                complete[name] = None
+        return complete
+
+    def _encode(self, record: Dict) -> Dict:
+        return {name: value.isoformat() if isinstance(value, (date, datetime)) else value
+                for name, value in record.items()}
+
+    def _decode(self, record: Dict) -> Dict:
+        for name, python_type in self._temporal.items():
+            if record.get(name) is not None:
+                record[name] = python_type.fromisoformat(record[name])
+        return record
+
+    def _read_journal(self) -> List[Dict]:
+        if not os.path.exists(self.journal_path):
+            return []
+        records = []
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    records.append(self._complete(self._decode(json.loads(line))))
+                except ValueError:
+                    # A crash while appending leaves at most a partial last line
+                    logger.warning('Skipping unreadable line %d of %s', line_number, self.journal_path)
+        return records
+
+    def _unwritten(self, records: List[Dict]) -> List[Dict]:
+        """The journaled records that did not reach the database"""
+        if not records:
+            return []
+        unwritten = []
+        with self.engine.connect() as connection:
+            for record in records:
+                key = and_(*(self.table.c[name] == record.get(name) for name in self.key_columns))
+                if connection.execute(select(self.table.c[self.key_columns[0]]).where(key).limit(1)).first() is None:
+                    unwritten.append(record)
+        return unwritten
+
+    def _truncate_journal(self):
+        # Called with the condition held
+        self._journal.seek(0)
+        self._journal.truncate()
+
+    def _next_batch(self) -> Optional[List[Dict]]:
+        with self._condition:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                self._condition.wait()
+
+            # Give concurrent check-ins a moment to join this transaction
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._queue) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            return batch
+
+    def _insert(self, records: List[Dict]):
+        with STAGE_SECONDS.time(stage='db'):
+            with self.engine.begin() as connection:
+                connection.execute(self.table.insert(), records)
+        ATTENDANCE_BATCH_RECORDS.observe(len(records))
+
+    def _write(self, batch: List[Dict]) -> int:
+        """
+        Insert a batch
+
+        Returns:
+            int: Records from the start of the batch that are written or
+            set aside; the others are to be retried
+        """
+        try:
+            self._insert(batch)
+            return len(batch)
+        except TRANSIENT_ERRORS:
+            logger.exception('Writing %d attendance record(s) failed, retrying in %.1fs',
+                             len(batch), self.retry_interval)
+            return 0
+        except Exception:
+            logger.exception('The database rejected a batch of %d attendance record(s), '
+                             'writing them one at a time', len(batch))
+
+        for done, record in enumerate(batch):
+            try:
+                self._insert([record])
+            except TRANSIENT_ERRORS:
+                logger.exception('Writing an attendance record failed, retrying in %.1fs', self.retry_interval)
+                return done
+            except Exception:
+                logger.exception('The database rejected attendance record %s, setting it aside in %s',
+                                 self._encode(record), self.rejects_path)
+                self._reject(record)
+        return len(batch)
+
+    def _reject(self, record: Dict):
+        try:
+            with open(self.rejects_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(self._encode(record)) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            # The record is still in the log message above
+            logger.exception('Could not write %s', self.rejects_path)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            done = self._write(batch)
+            with self._condition:
+                # Records not done go back to the head of the queue, in order
+                self._queue[:0] = batch[done:]
+                self._unsaved -= done
+                if self._unsaved == 0:
+                    self._truncate_journal()
+                self._condition.notify_all()
+
+            if done < len(batch):
+                if self._stopping:
+                    # The records stay in the journal and are replayed on the next start
+                    break
+                time.sleep(self.retry_interval)
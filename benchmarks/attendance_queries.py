@@ -0,0 +1,117 @@
+"""
+Attendance query latency with and without the Attendance indexes
+
+Fills a scratch SQLite database with synthetic attendance records, then
+times the hot queries before and after upgrade_database() creates the
+indexes.
+
+    python benchmarks/attendance_queries.py --rows 1000000
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Attendance records to generate')
+    parser.add_argument('--students', type=int, default=2000, help='Students to spread the records over')
+    parser.add_argument('--days', type=int, default=365, help='Days of history to generate')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+    parser.add_argument('--database', help='SQLite file to use (default: a temporary file)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    return parser.parse_args()
+
+
+def populate(db, Student, Attendance, rows, students, days, batch_size=50_000):
+    """Insert synthetic students and attendance records"""
+    db.session.execute(db.insert(Student), [
+        {'name': f'Student {i}', 'student_id': f'B{i:06d}'} for i in range(1, students + 1)
+    ])
+    now = datetime.now()
+    start = now - timedelta(days=days)
+    span = (now - start).total_seconds()
+    rng = random.Random(0)
+    for offset in range(0, rows, batch_size):
+        batch = []
+        for _ in range(min(batch_size, rows - offset)):
+            timestamp = start + timedelta(seconds=rng.random() * span)
+            batch.append({
+                'student_id': rng.randint(1, students),
+                'timestamp': timestamp,
+                'date': timestamp.date(),
+                'status': rng.choice(('in', 'out')),
+                'confidence_score': rng.random(),
+                'detection_method': rng.choice(('live_recognition', 'face_detection', 'manual'))
+            })
+        db.session.execute(db.insert(Attendance), batch)
+        db.session.commit()
+
+
+def time_query(run, repeat):
+    run()  # Warm the page cache
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    args = parse_args()
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'attendance_bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(database)}'
+
+    from app import app, db
+    from migrations import upgrade_database
+    from models import Attendance, Student
+
+    today = datetime.now().date()
+    since = datetime.now() - timedelta(minutes=5)
+    queries = {
+        'count_for_day': lambda: Attendance.count_for_day(today),
+        'last_for_student': lambda: Attendance.last_for_student(args.students // 2, today),
+        'recent': lambda: Attendance.recent(5),
+        'state_since': lambda: Attendance.state_since(today, since),
+        'student_history': lambda: Attendance.query.filter(
+            Attendance.student_id == args.students // 2
+        ).order_by(Attendance.timestamp.desc()).limit(50).all(),
+    }
+
+    results = {'rows': args.rows, 'database': database, 'queries': {}}
+    with app.app_context():
+        upgrade_database()
+        if db.session.query(db.func.count(Attendance.id)).scalar() < args.rows:
+            populate(db, Student, Attendance, args.rows, args.students, args.days)
+
+        with db.engine.begin() as connection:
+            for index in Attendance.__table__.indexes:
+                connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+        for name, run in queries.items():
+            results['queries'][name] = {'without_indexes_ms': time_query(run, args.repeat)}
+
+        upgrade_database()
+        for name, run in queries.items():
+            results['queries'][name]['with_indexes_ms'] = time_query(run, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.rows:,} attendance records in {database}")
+    print(f"{'query':<20}{'no index (ms)':>16}{'indexed (ms)':>16}")
+    for name, timings in results['queries'].items():
+        print(f"{name:<20}{timings['without_indexes_ms']:>16.2f}{timings['with_indexes_ms']:>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
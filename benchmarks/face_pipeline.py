@@ -0,0 +1,234 @@
+"""
+Per-stage latency of the face pipeline and the recognition endpoints
+
+Enrolls synthetic galleries of N students, made from sample photos with
+random augmentation (crop jitter, scale, brightness, contrast, mirroring
+and noise), into a scratch database. For each gallery size it times the
+pipeline stages on the sample photos (decode, detect, extract, gallery
+match, attendance write) and the /api/detect_faces and /api/recognize_face
+endpoints through the Flask test client. Every recognition request goes
+the full path: the recognition cache and the attendance state of the
+sample students are cleared before each one.
+
+    python benchmarks/face_pipeline.py --sizes 100 500 2000 --json > face_pipeline.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 2000], help='Gallery sizes')
+    parser.add_argument('--images', nargs='+', help='Sample photos with one face each (default: uploads/*)')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per stage and endpoint')
+    parser.add_argument('--budget-ms', type=float, default=2000, help='Latency budget for /api/recognize_face')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the augmentation')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    return parser.parse_args()
+
+
+def timings(samples):
+    samples = sorted(sample * 1000 for sample in samples)
+    return {
+        'median_ms': round(statistics.median(samples), 2),
+        'p95_ms': round(samples[min(len(samples) - 1, int(0.95 * len(samples)))], 2),
+        'max_ms': round(samples[-1], 2),
+    }
+
+
+def time_runs(run, repeat):
+    run()  # Warm up
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - started)
+    return timings(samples)
+
+
+def augment(rng, image, box):
+    """A randomly jittered, re-lit and noisy crop around a face box, and the face box within it"""
+    x, y, w, h = box
+    scale = rng.uniform(0.85, 1.15)
+    size = int(max(w, h) * scale)
+    cx = x + w // 2 + int(rng.uniform(-0.08, 0.08) * w)
+    cy = y + h // 2 + int(rng.uniform(-0.08, 0.08) * h)
+    x1, y1 = max(0, cx - size), max(0, cy - size)
+    crop = image[y1:cy + size, x1:cx + size].astype(np.float32)
+    crop = crop * rng.uniform(0.7, 1.3) + rng.uniform(-30, 30) + rng.normal(0, 6, crop.shape)
+    crop = np.clip(crop, 0, 255).astype(np.uint8)
+    face_box = (cx - size // 2 - x1, cy - size // 2 - y1, size, size)
+    if rng.random() < 0.5:
+        crop = np.ascontiguousarray(crop[:, ::-1])
+        face_box = (crop.shape[1] - face_box[0] - size, face_box[1], size, size)
+    return crop, face_box
+
+
+def enroll(db, Student, gallery, detector, samples, count, rng):
+    """
+    Replace the enrolled students with count synthetic ones
+
+    The first students are the sample faces themselves, so the sample
+    photos are recognized; the rest are augmented copies of them.
+    """
+    db.session.execute(db.delete(Student))
+    db.session.commit()
+    db.session.execute(db.insert(Student), [
+        {'name': f'Student {i}', 'student_id': f'B{i:06d}'} for i in range(1, count + 1)
+    ])
+    db.session.commit()
+    ids = [student_id for (student_id,) in db.session.query(Student.id).order_by(Student.id)]
+
+    entries = []
+    for index, student_id in enumerate(ids):
+        path, image, face = samples[index % len(samples)]
+        if index >= len(samples):
+            crop, box = augment(rng, image, (face.x, face.y, face.width, face.height))
+            face = detector._describe_faces(crop, [(box, None)])[0]
+        entries.append((student_id, path, face))
+    with gallery._lock:
+        gallery._sources.clear()
+        gallery._set_matrices(np.empty(0, dtype=np.int64), detector.empty_descriptors())
+        gallery.add_many(entries, save=False)
+    return ids[:len(samples)]
+
+
+def run_size(modules, samples, count, args, rng):
+    app, db, routes, Student, Attendance = modules
+    detector, gallery = routes.face_detector, routes.gallery
+    sample_ids = enroll(db, Student, gallery, detector, samples, count, rng)
+
+    encoded = [open(path, 'rb').read() for path, _, _ in samples]
+    decoded = [image for _, image, _ in samples]
+    boxes = [detector.detect_face_boxes(image) for image in decoded]
+    faces = [detector._describe_faces(image, image_boxes) for image, image_boxes in zip(decoded, boxes)]
+
+    def cycle(run):
+        # Each timed run handles the next sample photo
+        position = {'index': 0}
+
+        def step():
+            index = position['index'] % len(samples)
+            position['index'] += 1
+            return run(index)
+        return step
+
+    def write_record(index):
+        db.session.execute(db.insert(Attendance), [{
+            'student_id': sample_ids[index], 'timestamp': datetime.utcnow(), 'status': 'in',
+            'confidence_score': 1.0, 'detection_method': 'benchmark'
+        }])
+        db.session.commit()
+
+    stages = {
+        'decode': time_runs(cycle(lambda i: detector.decode_image(encoded[i])), args.repeat),
+        'detect': time_runs(cycle(lambda i: detector.detect_face_boxes(decoded[i])), args.repeat),
+        'extract': time_runs(cycle(lambda i: detector._describe_faces(decoded[i], boxes[i])), args.repeat),
+        'match': time_runs(cycle(lambda i: gallery.best_matches(faces[i])), args.repeat),
+        'db_write': time_runs(cycle(write_record), args.repeat),
+    }
+
+    client = app.test_client()
+    recognized = []
+
+    def post(url, index):
+        response = client.post(url, data={'image': (io.BytesIO(encoded[index]), 'probe.jpg')},
+                               content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_json()
+
+    def recognize(index):
+        routes.recognition_cache.clear()
+        for student_id in sample_ids:
+            routes.attendance_state.forget(student_id)
+        recognized.append(post('/api/recognize_face', index).get('recognized', False))
+
+    endpoints = {
+        'detect_faces': time_runs(cycle(lambda i: post('/api/detect_faces', i)), args.repeat),
+        'recognize_face': time_runs(cycle(recognize), args.repeat),
+    }
+    routes.attendance_writer.flush()
+    db.session.execute(db.delete(Attendance))
+    db.session.commit()
+
+    return {
+        'gallery_size': count,
+        'stages': stages,
+        'endpoints': endpoints,
+        'recognition_rate': round(sum(recognized) / len(recognized), 3),
+        'within_budget': endpoints['recognize_face']['p95_ms'] <= args.budget_ms,
+    }
+
+
+def main():
+    args = parse_args()
+    scratch = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(scratch, 'face_pipeline.db')}"
+    os.environ['GALLERY_CACHE_PATH'] = os.path.join(scratch, 'gallery_cache.npz')
+    os.environ['ATTENDANCE_JOURNAL_PATH'] = os.path.join(scratch, 'attendance_journal.jsonl')
+    os.environ.setdefault('FACE_WORKERS', '0')
+
+    from app import app, db
+    import routes
+    from models import Attendance, Student
+    routes.warmup.run()
+
+    paths = args.images or sorted(
+        path for path in glob.glob(os.path.join(app.root_path, 'uploads', '*'))
+        if path.rsplit('.', 1)[-1].lower() in ('jpg', 'jpeg', 'png')
+    )
+    samples = []
+    for path in paths:
+        image = cv2.imread(path)
+        faces = routes.face_detector.analyze_image(image) if image is not None else []
+        if faces:
+            samples.append((path, image, faces[0]))
+        else:
+            print(f"Skipping {path}: no face found", file=sys.stderr)
+    if not samples:
+        sys.exit('No sample photos with a detectable face')
+
+    rng = np.random.default_rng(args.seed)
+    results = {
+        'descriptor': routes.face_detector.descriptor,
+        'dnn_detector': routes.face_detector.use_dnn,
+        'face_workers': app.config['FACE_WORKERS'],
+        'samples': [os.path.basename(path) for path, _, _ in samples],
+        'budget_ms': args.budget_ms,
+        'repeat': args.repeat,
+        'sizes': [],
+    }
+    with app.app_context():
+        for count in args.sizes:
+            results['sizes'].append(run_size((app, db, routes, Student, Attendance), samples, count, args, rng))
+    routes.face_pool.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"descriptor={results['descriptor']} dnn_detector={results['dnn_detector']} "
+          f"samples={len(samples)} repeat={args.repeat} (median / p95 ms)")
+    names = ['decode', 'detect', 'extract', 'match', 'db_write', 'detect_faces', 'recognize_face']
+    print(f"{'students':>9}" + ''.join(f"{name:>17}" for name in names) + f"{'budget':>8}")
+    for result in results['sizes']:
+        timed = dict(result['stages'], **result['endpoints'])
+        cells = ''.join(f"{timed[name]['median_ms']:>8.1f} /{timed[name]['p95_ms']:>7.1f}" for name in names)
+        print(f"{result['gallery_size']:>9}{cells}{'ok' if result['within_budget'] else 'OVER':>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Recall and latency of the gallery's ANN index against the exact scan
+
+Builds synthetic galleries of face descriptors at several sizes and
+matches noisy probes of enrolled identities with and without the index.
+Recall is the share of probes for which the index returns the same best
+match as the exact scan.
+
+    python benchmarks/gallery_ann.py --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann_index import IVFIndex  # noqa: E402
+from face_detection import FaceDetector  # noqa: E402
+from gallery import FaceGallery  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Gallery sizes')
+    parser.add_argument('--probes', type=int, default=50, help='Probes per gallery size')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[16, 64, 0],
+                        help='Clusters scanned per search, 0 for all')
+    parser.add_argument('--candidates', type=int, default=100, help='Candidates re-ranked exactly')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    return parser.parse_args()
+
+
+def smooth_noise(rng, count, size=100, grid=12):
+    """Low-frequency random images, a crude stand-in for face crops"""
+    coarse = rng.normal(size=(count, grid, grid)).astype(np.float32)
+    return np.stack([cv2.resize(image, (size, size), interpolation=cv2.INTER_CUBIC) for image in coarse])
+
+
+def to_uint8(images):
+    return np.clip(images, 0, 255).astype(np.uint8)
+
+
+def synthetic_gallery(rng, count, chunk_size=2000):
+    """Faces that share a common structure plus a per-identity part"""
+    mean_face = smooth_noise(rng, 1)[0]
+    faces = np.empty((count, 100, 100), dtype=np.uint8)
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        faces[start:start + size] = to_uint8(128 + 30 * mean_face + 25 * smooth_noise(rng, size))
+    return faces
+
+
+def make_probes(rng, identities):
+    """Enrolled identities seen again: shifted, re-lit and noisy"""
+    probes = []
+    for identity in identities:
+        shifted = np.roll(identity.astype(np.float32), shift=tuple(rng.integers(-2, 3, size=2)), axis=(0, 1))
+        probes.append(shifted * rng.uniform(0.9, 1.1) + rng.uniform(-10, 10) + rng.normal(0, 8, identity.shape))
+    return to_uint8(np.stack(probes))
+
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+
+def run_size(detector, rng, count, args):
+    faces = synthetic_gallery(rng, count)
+    histograms = np.stack([detector.face_histogram(face) for face in faces])
+    student_ids = np.arange(1, count + 1, dtype=np.int64)
+
+    gallery = FaceGallery(detector, os.path.join(tempfile.mkdtemp(), 'gallery.npz'))
+    gallery._set_matrices(student_ids, (faces, histograms))
+
+    index = IVFIndex()
+    started = time.perf_counter()
+    index.train(student_ids, (faces, histograms))
+    train_seconds = time.perf_counter() - started
+    ann_gallery = FaceGallery(detector, gallery.cache_path, ann_index=index, ann_min_size=0,
+                              ann_candidates=args.candidates)
+    ann_gallery._set_matrices(student_ids, (faces, histograms))
+
+    picked = rng.choice(count, size=min(args.probes, count), replace=False)
+    probes = [(probe, detector.face_histogram(probe)) for probe in make_probes(rng, faces[picked])]
+
+    def best_ids(matcher):
+        ids, times = [], []
+        for probe, histogram in probes:
+            started = time.perf_counter()
+            matches = matcher.match((probe, histogram), top_k=1, threshold=0.0)
+            times.append(time.perf_counter() - started)
+            ids.append(matches[0][0] if matches else None)
+        return np.array(ids), median_ms(times)
+
+    exact_ids, exact_ms = best_ids(gallery)
+    results = []
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        ann_ids, ann_ms = best_ids(ann_gallery)
+        results.append({
+            'size': count,
+            'nprobe': nprobe if 0 < nprobe < index.list_count else index.list_count,
+            'lists': index.list_count,
+            'train_seconds': round(train_seconds, 2),
+            'exact_ms': round(exact_ms, 2),
+            'ann_ms': round(ann_ms, 2),
+            'recall_at_1': round(float(np.mean(ann_ids == exact_ids)), 4),
+            'exact_accuracy': round(float(np.mean(exact_ids == student_ids[picked])), 4),
+        })
+    return results
+
+
+def main():
+    args = parse_args()
+    detector = FaceDetector()
+    rng = np.random.default_rng(0)
+    results = [result for count in args.sizes for result in run_size(detector, rng, count, args)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"candidates={args.candidates} probes={args.probes}")
+    print(f"{'size':>8}{'lists':>7}{'nprobe':>8}{'train (s)':>11}{'exact (ms)':>12}{'ann (ms)':>10}{'recall@1':>10}")
+    for result in results:
+        print(f"{result['size']:>8}{result['lists']:>7}{result['nprobe']:>8}{result['train_seconds']:>11.2f}"
+              f"{result['exact_ms']:>12.2f}{result['ann_ms']:>10.2f}{result['recall_at_1']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
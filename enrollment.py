@@ -0,0 +1,353 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+import uuid
+import zipfile
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+import click
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from face_workers import BatchAnalyzer
+from gallery import FaceGallery
+from models import Student
+
+PHOTO_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+@dataclass
+class EnrollmentRow:
+    """One student listed in the enrollment CSV"""
+    line: int
+    name: str
+    student_id: str
+    email: Optional[str]
+    photo: Optional[str]  # Photo file name inside the source
+
+
+class EnrollmentSource:
+    """
+    Students and photos to enroll: a CSV with name, student_id and email
+    columns plus the photo files
+
+    Each student's photo is the file named in an optional photo column, or
+    otherwise the photo whose file name (without extension) is the student id.
+    Close the source (or use it as a context manager) when done with it.
+    """
+
+    def __init__(self, names: List[str], read: Callable[[str], bytes],
+                 close: Optional[Callable[[], None]] = None):
+        """
+        Args:
+            names: Paths of all files in the source, relative to its root
+            read: Returns the contents of a file by its path
+            close: Releases what read() uses, e.g. the open archive
+        """
+        self._read = read
+        self._close = close
+        csv_files = sorted(name for name in names if name.lower().endswith('.csv'))
+        if not csv_files:
+            raise ValueError('No CSV file with the student list found')
+        self.csv_name = csv_files[0]
+        self._photos: Dict[str, str] = {}
+        for name in names:
+            base = os.path.basename(name)
+            stem, _, extension = base.rpartition('.')
+            if stem and extension.lower() in PHOTO_EXTENSIONS:
+                self._photos.setdefault(base.lower(), name)
+                self._photos.setdefault(stem.lower(), name)
+
+    def rows(self) -> Iterator[EnrollmentRow]:
+        """Parse the student list; rows with missing fields are yielded as-is for reporting"""
+        text = self._read(self.csv_name).decode('utf-8-sig')
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or not {'name', 'student_id'} <= {field.strip() for field in reader.fieldnames}:
+            raise ValueError(f'{self.csv_name} needs a header with name,student_id[,email][,photo] columns')
+
+        for record in reader:
+            record = {(key or '').strip(): (value or '').strip() for key, value in record.items()}
+            if not any(record.values()):
+                continue
+            student_id = record.get('student_id', '')
+            photo = record.get('photo') or student_id
+            yield EnrollmentRow(
+                line=reader.line_num,
+                name=record.get('name', ''),
+                student_id=student_id,
+                email=record.get('email') or None,
+                photo=self._photos.get(os.path.basename(photo).lower()) if photo else None
+            )
+
+    def read_photo(self, name: str) -> bytes:
+        return self._read(name)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self) -> 'EnrollmentSource':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_enrollment_source(path: str) -> EnrollmentSource:
+    """
+    Open a zip archive or a directory holding the student list and photos
+
+    Raises:
+        ValueError: If the path is neither, or holds no CSV file
+    """
+    if os.path.isdir(path):
+        names = [
+            os.path.relpath(os.path.join(root, filename), path)
+            for root, _, filenames in os.walk(path)
+            for filename in filenames
+        ]
+
+        def read(name):
+            with open(os.path.join(path, name), 'rb') as handle:
+                return handle.read()
+
+        return EnrollmentSource(names, read)
+
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        names = [info.filename for info in archive.infolist()
+                 if not info.is_dir() and not os.path.basename(info.filename).startswith('.')]
+        try:
+            return EnrollmentSource(names, archive.read, archive.close)
+        except Exception:
+            archive.close()
+            raise
+
+    raise ValueError(f'{path} is neither a zip archive nor a directory')
+
+
+class BulkEnrollment:
+    """
+    Enrolls the students of an EnrollmentSource in batches
+
+    The photos of each batch are validated and described in parallel, then
+    the batch's students are inserted in one transaction. Students whose
+    student id is already in the database are skipped, so an interrupted
+    run can simply be started again. The source is closed when the run ends.
+    """
+
+    def __init__(self, source: EnrollmentSource, gallery: FaceGallery, upload_folder: str,
+                 workers: int = 0, batch_size: int = 100):
+        """
+        Args:
+            source: Students and photos to enroll
+            gallery: Gallery that receives the new students' descriptors
+            upload_folder: Directory the photos are stored in
+            workers: Processes used for face detection, 0 to run inline
+            batch_size: Students per transaction
+        """
+        self.source = source
+        self.gallery = gallery
+        self.upload_folder = upload_folder
+        self.workers = workers
+        self.batch_size = batch_size
+        self.results: List[dict] = []
+        self.counts = {'enrolled': 0, 'skipped': 0, 'failed': 0}
+
+    def _report(self, row: EnrollmentRow, status: str, message: Optional[str] = None):
+        self.counts[status] += 1
+        result = {'line': row.line, 'student_id': row.student_id, 'status': status}
+        if message:
+            result['message'] = message
+        self.results.append(result)
+
+    def run(self, on_progress: Optional[Callable[['BulkEnrollment'], None]] = None) -> dict:
+        """
+        Enroll all students; needs an application context
+
+        Args:
+            on_progress: Called after every batch
+
+        Returns:
+            dict: Report with the counts and per-row results
+        """
+        seen = set()
+        batch: List[EnrollmentRow] = []
+        with self.source, BatchAnalyzer(self.workers, self.gallery.face_detector.options) as analyzer:
+            for row in self.source.rows():
+                if not row.name or not row.student_id:
+                    self._report(row, 'failed', 'Name and Student ID are required')
+                elif row.student_id in seen:
+                    self._report(row, 'failed', 'Student ID appears more than once in the list')
+                elif row.photo is None:
+                    self._report(row, 'failed', 'No photo found for this student')
+                else:
+                    seen.add(row.student_id)
+                    batch.append(row)
+
+                if len(batch) >= self.batch_size:
+                    self._enroll_batch(batch, analyzer)
+                    batch = []
+                    if on_progress is not None:
+                        on_progress(self)
+
+            if batch:
+                self._enroll_batch(batch, analyzer)
+                if on_progress is not None:
+                    on_progress(self)
+
+        self.gallery.save()
+        return self.report()
+
+    def report(self) -> dict:
+        return dict(self.counts, results=sorted(self.results, key=lambda result: result['line']))
+
+    def _enroll_batch(self, batch: List[EnrollmentRow], analyzer: BatchAnalyzer):
+        existing = {student_id for (student_id,) in db.session.query(Student.student_id).filter(
+            Student.student_id.in_([row.student_id for row in batch]))}
+        pending = []
+        for row in batch:
+            if row.student_id in existing:
+                self._report(row, 'skipped', 'Student ID already exists')
+            else:
+                pending.append(row)
+        if not pending:
+            return
+
+        photos = []
+        for row in pending:
+            try:
+                photos.append(self.source.read_photo(row.photo))
+            except Exception as e:
+                photos.append(e)
+        analyses = analyzer.analyze([photo if isinstance(photo, bytes) else b'' for photo in photos])
+
+        accepted = []
+        for row, photo, faces in zip(pending, photos, analyses):
+            if isinstance(photo, Exception):
+                self._report(row, 'failed', f'Error reading photo: {photo}')
+            elif isinstance(faces, Exception):
+                self._report(row, 'failed', f'Error processing image: {faces}')
+            elif not faces:
+                self._report(row, 'failed', 'No face detected in the photo')
+            else:
+                filename = secure_filename(f"{row.student_id}_{os.path.basename(row.photo)}")
+                photo_path = os.path.join(self.upload_folder, filename)
+                with open(photo_path, 'wb') as photo_file:
+                    photo_file.write(photo)
+                # The largest face in the photo is the student
+                accepted.append((row, photo_path, faces[0]))
+
+        if accepted:
+            self._insert(accepted)
+
+    def _insert(self, accepted: list):
+        students = [
+            Student(name=row.name, student_id=row.student_id, email=row.email, photo_path=photo_path)
+            for row, photo_path, _ in accepted
+        ]
+        try:
+            db.session.add_all(students)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if len(accepted) == 1:
+                row, photo_path, _ = accepted[0]
+                os.remove(photo_path)
+                self._report(row, 'failed', 'Error saving student')
+                return
+            # Insert one by one to find the rows that fail
+            for entry in accepted:
+                self._insert([entry])
+            return
+
+        self.gallery.add_many(
+            [(student.id, photo_path, face) for student, (_, photo_path, face) in zip(students, accepted)],
+            save=False
+        )
+        for row, _, _ in accepted:
+            self._report(row, 'enrolled')
+
+
+class EnrollmentJob:
+    """A bulk enrollment running in a background thread of the web process"""
+
+    def __init__(self, enrollment: BulkEnrollment, cleanup_path: Optional[str] = None):
+        """
+        Args:
+            enrollment: Enrollment to run
+            cleanup_path: Uploaded archive to delete when the job ends
+        """
+        self.job_id = uuid.uuid4().hex
+        self.enrollment = enrollment
+        self.cleanup_path = cleanup_path
+        self.state = 'running'
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self._thread = threading.Thread(target=self._run, name=f'enrollment-{self.job_id}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with app.app_context():
+                self.enrollment.run()
+            self.state = 'done'
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+        finally:
+            # Also if the run failed before it got to close the source
+            self.enrollment.source.close()
+            if self.cleanup_path and os.path.exists(self.cleanup_path):
+                os.remove(self.cleanup_path)
+            self.finished_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        data = {'job_id': self.job_id, 'state': self.state}
+        data.update(self.enrollment.report())
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+@app.cli.command('enroll-students')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--workers', type=int, default=None, help='Face detection processes (default: BULK_ENROLL_WORKERS)')
+@click.option('--batch-size', type=int, default=None, help='Students per transaction (default: BULK_ENROLL_BATCH_SIZE)')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False), help='Write the per-row results as JSON')
+def enroll_students_command(path, workers, batch_size, report_path):
+    """Enroll the students listed in a CSV inside a zip archive or directory.
+
+    Students that already exist are skipped, so an interrupted run can be
+    started again with the same input.
+    """
+    from routes import gallery, warmup
+
+    try:
+        source = open_enrollment_source(path)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    # Upgrade the database, load the models and the gallery's cache
+    warmup.preload()
+    enrollment = BulkEnrollment(
+        source,
+        gallery,
+        app.config['UPLOAD_FOLDER'],
+        workers=app.config['BULK_ENROLL_WORKERS'] if workers is None else workers,
+        batch_size=batch_size or app.config['BULK_ENROLL_BATCH_SIZE']
+    )
+    report = enrollment.run(on_progress=lambda job: click.echo(
+        f"enrolled {job.counts['enrolled']}, skipped {job.counts['skipped']}, failed {job.counts['failed']}"))
+
+    for result in report['results']:
+        if result['status'] == 'failed':
+            click.echo(f"line {result['line']} ({result['student_id'] or 'no id'}): {result['message']}", err=True)
+    if report_path:
+        with open(report_path, 'w') as handle:
+            json.dump(report, handle, indent=2)
@@ -0,0 +1,184 @@
+import csv
+import importlib.util
+import io
+from datetime import date, datetime
+from typing import Iterator, Optional
+
+import click
+
+from app import app, db
+from migrations import upgrade_database
+from models import Attendance, Student
+
+# Columns of an export, in order
+EXPORT_COLUMNS = [
+    'record_id', 'student_id', 'student_name', 'email', 'date', 'timestamp',
+    'status', 'confidence_score', 'detection_method'
+]
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def export_format_available(export_format: str) -> bool:
+    """Whether an export format's optional dependency is installed"""
+    if export_format == 'parquet':
+        return importlib.util.find_spec('pyarrow') is not None
+    return export_format in EXPORT_FORMATS
+
+
+def parse_export_date(value: Optional[str]) -> Optional[date]:
+    """Parse a YYYY-MM-DD range bound; empty means unbounded"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def iter_attendance_rows(start: Optional[date] = None, end: Optional[date] = None,
+                         chunk_size: int = 5000) -> Iterator[list]:
+    """
+    Attendance records joined with their students, in chunks
+
+    Rows are fetched from the cursor chunk_size at a time (yield_per), so
+    memory stays constant however many records the range holds.
+
+    Args:
+        start: First day to include, None for no lower bound
+        end: Last day to include, None for no upper bound
+        chunk_size: Rows per chunk
+
+    Yields:
+        list: Up to chunk_size rows with the EXPORT_COLUMNS fields
+    """
+    query = db.select(
+        Attendance.id, Student.student_id, Student.name, Student.email, Attendance.date,
+        Attendance.timestamp, Attendance.status, Attendance.confidence_score, Attendance.detection_method
+    ).join(Student, Attendance.student_id == Student.id)
+    if start is not None:
+        query = query.where(Attendance.date >= start)
+    if end is not None:
+        query = query.where(Attendance.date <= end)
+    query = query.order_by(Attendance.timestamp, Attendance.id).execution_options(yield_per=chunk_size)
+
+    result = db.session.execute(query)
+    try:
+        for rows in result.partitions():
+            yield rows
+    finally:
+        result.close()
+
+
+def iter_attendance_csv(start: Optional[date] = None, end: Optional[date] = None,
+                        chunk_size: int = 5000) -> Iterator[str]:
+    """
+    CSV export of attendance records, one piece of text per chunk of rows
+
+    Yields:
+        str: The header line, then the CSV lines of each chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+
+    for rows in iter_attendance_rows(start, end, chunk_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last drain"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_attendance_parquet(start: Optional[date] = None, end: Optional[date] = None,
+                            chunk_size: int = 5000) -> Iterator[bytes]:
+    """
+    Parquet export of attendance records, one row group per chunk of rows
+
+    Requires pyarrow.
+
+    Yields:
+        bytes: Parquet file contents, as soon as each row group is written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires pyarrow (pip install pyarrow)')
+
+    schema = pa.schema([
+        ('record_id', pa.int64()),
+        ('student_id', pa.string()),
+        ('student_name', pa.string()),
+        ('email', pa.string()),
+        ('date', pa.date32()),
+        ('timestamp', pa.timestamp('us')),
+        ('status', pa.string()),
+        ('confidence_score', pa.float64()),
+        ('detection_method', pa.string()),
+    ])
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in iter_attendance_rows(start, end, chunk_size):
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def iter_attendance_export(export_format: str, start: Optional[date] = None, end: Optional[date] = None,
+                           chunk_size: int = 5000) -> Iterator:
+    """Streaming export in one of EXPORT_FORMATS"""
+    if export_format == 'parquet':
+        return iter_attendance_parquet(start, end, chunk_size)
+    return iter_attendance_csv(start, end, chunk_size)
+
+
+@app.cli.command('export-attendance')
+@click.option('--start', help='First day to include (YYYY-MM-DD)')
+@click.option('--end', help='Last day to include (YYYY-MM-DD)')
+@click.option('--format', 'export_format', type=click.Choice(sorted(EXPORT_FORMATS)), default='csv')
+@click.option('--output', type=click.Path(dir_okay=False), required=True, help="File to write, '-' for stdout")
+@click.option('--chunk-size', type=int, default=5000, help='Rows fetched per chunk')
+def export_attendance_command(start, end, export_format, output, chunk_size):
+    """Export attendance records with student details."""
+    try:
+        start, end = parse_export_date(start), parse_export_date(end)
+    except ValueError:
+        raise click.BadParameter('Dates must be YYYY-MM-DD')
+
+    if not export_format_available(export_format):
+        raise click.UsageError(f'{export_format} export requires pyarrow (pip install pyarrow)')
+
+    # A new database has no tables until it is upgraded
+    upgrade_database()
+    with click.open_file(output, 'wb') as handle:
+        for piece in iter_attendance_export(export_format, start, end, chunk_size):
+            handle.write(piece.encode('utf-8') if isinstance(piece, str) else piece)
@@ -1,149 +1,699 @@
 import cv2
+import math
 import numpy as np
 import os
-from typing import List, Tuple, Optional
+import threading
+from dataclasses import dataclass
+from typing import List, Tuple, Optional, Union
+
+from metrics import FACES_DETECTED, STAGE_SECONDS
+
+# An image given either as a file path or as an already decoded BGR array
+ImageSource = Union[str, np.ndarray]
+
+# Haar cascade used when no DNN face detector is available
+HAAR_CASCADE = 'haarcascade_frontalface_default.xml'
+# SSD face detectors, (weights, config) pairs in order of preference:
+# OpenCV's TensorFlow model and the Caffe ResNet-10 model from the OpenCV
+# samples (samples/dnn/face_detector)
+SSD_MODELS = [
+    ('opencv_face_detector_uint8.pb', 'opencv_face_detector.pbtxt'),
+    ('res10_300x300_ssd_iter_140000_fp16.caffemodel', 'deploy.prototxt'),
+    ('res10_300x300_ssd_iter_140000.caffemodel', 'deploy.prototxt'),
+]
+SSD_INPUT_SIZE = (300, 300)
+SSD_MEAN = (104, 117, 123)
+
+
+class ModelRegistry:
+    """
+    Finds model files in a models directory, then in OpenCV's bundled data
+    (cv2.data.haarcascades)
+    """
+    
+    def __init__(self, models_dir: Optional[str] = None):
+        """
+        Args:
+            models_dir: Directory searched first for model files
+        """
+        bundled = getattr(getattr(cv2, 'data', None), 'haarcascades', None)
+        self.search_path = [directory for directory in (models_dir, bundled) if directory]
+    
+    def find(self, filename: Optional[str]) -> Optional[str]:
+        """
+        Locate a model file
+        
+        Args:
+            filename: File name, or a path that is used as-is if it exists
+            
+        Returns:
+            str: Path of the file, or None if it was not found
+        """
+        if not filename:
+            return None
+        if os.path.isfile(filename):
+            return filename
+        for directory in self.search_path:
+            path = os.path.join(directory, os.path.basename(filename))
+            if os.path.isfile(path):
+                return path
+        return None
+    
+    def load_cascade(self) -> Optional[cv2.CascadeClassifier]:
+        """The frontal face Haar cascade, or None if it is missing"""
+        path = self.find(HAAR_CASCADE)
+        if path is None:
+            print(f"{HAAR_CASCADE} not found in {', '.join(self.search_path)}")
+            return None
+        cascade = cv2.CascadeClassifier(path)
+        return None if cascade.empty() else cascade
+    
+    def load_ssd(self) -> Optional[cv2.dnn.Net]:
+        """The first SSD face detector from SSD_MODELS whose files are present, or None"""
+        for weights, config in SSD_MODELS:
+            weights_path, config_path = self.find(weights), self.find(config)
+            if weights_path is None or config_path is None:
+                continue
+            try:
+                net = cv2.dnn.readNet(weights_path, config_path)
+            except cv2.error as e:
+                print(f"Could not load {weights_path}: {e}")
+                continue
+            print(f"Loaded DNN face detection model {weights_path}")
+            return net
+        print(f"DNN face detection model not found in {', '.join(self.search_path)}, using Haar Cascade")
+        return None
+
+
+# Face descriptor backends, see FaceDetector.__init__
+DESCRIPTOR_HISTOGRAM = 'histogram'  # Histogram correlation + template matching on the crop
+DESCRIPTOR_LBP = 'lbp'  # Grid of uniform LBP histograms, compared by dot product
+DESCRIPTOR_DNN = 'dnn'  # Embedding from an ONNX face recognition model, compared by dot product
+DESCRIPTORS = (DESCRIPTOR_HISTOGRAM, DESCRIPTOR_LBP, DESCRIPTOR_DNN)
+
+# Minimum similarity for a match with each descriptor
+DEFAULT_MATCH_THRESHOLDS = {
+    DESCRIPTOR_HISTOGRAM: 0.6,
+    DESCRIPTOR_LBP: 0.75,
+    DESCRIPTOR_DNN: 0.363,  # Cosine threshold published for OpenCV's SFace model
+}
+
+# Weights of the histogram and template terms of the histogram descriptor score
+HISTOGRAM_WEIGHT = 0.6
+TEMPLATE_WEIGHT = 0.4
+
+LBP_GRID = 4  # Cells per side of the LBP histogram grid
+
+
+def _uniform_lbp_table() -> np.ndarray:
+    # Maps each 8-bit LBP code to one of 58 uniform patterns (at most two
+    # 0/1 transitions around the circle) or to bin 58 for all other codes
+    table = np.full(256, 58, dtype=np.int64)
+    next_bin = 0
+    for code in range(256):
+        rotated = ((code >> 1) | ((code & 1) << 7))
+        if bin(code ^ rotated).count('1') <= 2:
+            table[code] = next_bin
+            next_bin += 1
+    return table
+
+
+_LBP_TABLE = _uniform_lbp_table()
+
+
+def lbp_descriptor(face_region: np.ndarray) -> np.ndarray:
+    """
+    Local binary pattern descriptor of a face crop
+
+    Uniform LBP histograms of a LBP_GRID x LBP_GRID grid of cells,
+    concatenated, square-rooted, mean-centered and scaled to unit length so
+    that the dot product of two descriptors is their correlation.
+
+    Args:
+        face_region: Grayscale face crop
+
+    Returns:
+        numpy.ndarray: float16 vector of LBP_GRID * LBP_GRID * 59 values
+    """
+    gray = face_region.astype(np.int16)
+    center = gray[1:-1, 1:-1]
+    height, width = center.shape
+    codes = np.zeros(center.shape, dtype=np.uint8)
+    neighbors = [(0, 0), (0, 1), (0, 2), (1, 2), (2, 2), (2, 1), (2, 0), (1, 0)]
+    for bit, (dy, dx) in enumerate(neighbors):
+        codes |= (gray[dy:dy + height, dx:dx + width] >= center).astype(np.uint8) << bit
+
+    rows = np.minimum(np.arange(height) * LBP_GRID // height, LBP_GRID - 1)
+    cols = np.minimum(np.arange(width) * LBP_GRID // width, LBP_GRID - 1)
+    cells = rows[:, np.newaxis] * LBP_GRID + cols[np.newaxis, :]
+    histogram = np.bincount((cells * 59 + _LBP_TABLE[codes]).ravel(),
+                            minlength=LBP_GRID * LBP_GRID * 59).astype(np.float32)
+    histogram = np.sqrt(histogram)
+    histogram -= histogram.mean()
+    return (histogram / max(float(np.linalg.norm(histogram)), 1e-12)).astype(np.float16)
+
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = matrix - matrix.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def histogram_template_vectors(faces: np.ndarray, histograms: np.ndarray) -> np.ndarray:
+    """
+    Embed histogram descriptors so that inner products give their score
+
+    The score is 0.6 * histogram correlation + 0.4 * normalized
+    cross-correlation of the crops, and both terms are cosines of mean-
+    centered vectors. Concatenating the unit-length centered histogram and
+    crop, scaled by the square roots of the weights, turns the score into
+    a plain dot product (before clipping).
+
+    Args:
+        faces: Face regions, shape (N, 100, 100)
+        histograms: Histograms, shape (N, 256)
+
+    Returns:
+        numpy.ndarray: float32 vectors, shape (N, 256 + 100 * 100)
+    """
+    faces = np.asarray(faces, dtype=np.float32).reshape(len(faces), -1)
+    histograms = np.asarray(histograms, dtype=np.float32).reshape(len(histograms), -1)
+    return np.hstack([
+        _unit_rows(histograms) * np.float32(math.sqrt(HISTOGRAM_WEIGHT)),
+        _unit_rows(faces) * np.float32(math.sqrt(TEMPLATE_WEIGHT))
+    ])
+
+@dataclass
+class DetectedFace:
+    """A face found by FaceDetector.analyze_image, with its recognition descriptor"""
+    x: int
+    y: int
+    width: int
+    height: int
+    confidence: Optional[float]  # DNN score, None for Haar Cascade detections
+    face_region: np.ndarray  # 100x100 grayscale crop
+    histogram: np.ndarray  # 256-bin histogram of face_region
+    embedding: Optional[np.ndarray] = None  # float16 vector with the lbp and dnn descriptors
+    
+    def to_dict(self) -> dict:
+        """Bounding box and confidence in the JSON shape used by the API"""
+        return {
+            'x': self.x,
+            'y': self.y,
+            'width': self.width,
+            'height': self.height,
+            'confidence': self.confidence
+        }
 
 class FaceDetector:
-    def __init__(self):
-        """Initialize the face detector with OpenCV's Haar Cascade and DNN face detection"""
-        # Load the pre-trained Haar Cascade face detection model
-        cascade_path = '/home/runner/workspace/.pythonlibs/lib/python3.11/site-packages/cv2/data/haarcascade_frontalface_default.xml'
-        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+    # Gallery rows processed per matrix product in score_against_gallery
+    MATCH_CHUNK_SIZE = 256
+    # Gallery embeddings converted from float16 per matrix product
+    EMBEDDING_CHUNK_SIZE = 8192
+    # Input size of the embedding model (OpenCV's SFace uses 112x112 RGB)
+    EMBEDDING_INPUT_SIZE = (112, 112)
+    
+    # Attributes that depend on the models, set by load()
+    MODEL_ATTRIBUTES = frozenset({
+        'face_cascade', 'net', 'use_dnn', 'embedding_net', 'embedding_size',
+        'descriptor', 'descriptor_kind', 'match_threshold', 'crop_size'
+    })
+    
+    def __init__(self, descriptor: str = DESCRIPTOR_HISTOGRAM, descriptor_model: Optional[str] = None,
+                 match_threshold: Optional[float] = None, detection_size: int = 640,
+                 models_dir: Optional[str] = None):
+        """
+        Initialize the face detector with OpenCV's Haar Cascade and DNN face detection
         
-        # Try to load DNN face detection model for better accuracy
-        try:
-            # Download and load DNN face detection model
-            self.net = cv2.dnn.readNetFromTensorflow('opencv_face_detector_uint8.pb', 'opencv_face_detector.pbtxt')
-            self.use_dnn = True
-            print("Loaded DNN face detection model")
-        except Exception as e:
-            print(f"DNN model not available, using Haar Cascade: {e}")
-            self.net = None
-            self.use_dnn = False
+        The models are loaded by load(), which runs on first use of the
+        detector (or of an attribute in MODEL_ATTRIBUTES) unless it was
+        called before, so constructing a detector is cheap.
         
-        # Initialize the face recognizer if available
+        Args:
+            descriptor: Face descriptor used for recognition, one of DESCRIPTORS
+            descriptor_model: ONNX face embedding model for the dnn descriptor,
+                a path or a file name looked up like the other models;
+                without it the lbp descriptor is used instead
+            match_threshold: Minimum similarity for a match, defaults to the
+                descriptor's DEFAULT_MATCH_THRESHOLDS entry
+            detection_size: Longest side, in pixels, of the working image that
+                detection runs on; larger images are downscaled first and 0
+                keeps the full resolution
+            models_dir: Directory with model files (SSD_MODELS, the embedding
+                model); OpenCV's bundled data is searched after it
+        """
+        if descriptor not in DESCRIPTORS:
+            raise ValueError(f"Unknown face descriptor {descriptor!r}, use one of {', '.join(DESCRIPTORS)}")
+        self.detection_size = detection_size
         self.has_face_recognizer = False
         self.face_recognizer = None
-        print("Using histogram-based face comparison (OpenCV face module not required)")
-        
-    def detect_faces_in_image(self, image_path: str) -> bool:
+        # Arguments that build an equivalent detector, e.g. in a worker process
+        self.options = {
+            'descriptor': descriptor,
+            'descriptor_model': descriptor_model,
+            'match_threshold': match_threshold,
+            'detection_size': detection_size,
+            'models_dir': models_dir
+        }
+        self._load_lock = threading.Lock()
+        self.loaded = False
+    
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        if name in FaceDetector.MODEL_ATTRIBUTES:
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+    
+    def load(self):
+        """Load the detection and embedding models; safe to call repeatedly"""
+        with self._load_lock:
+            if self.loaded:
+                return
+            descriptor = self.options['descriptor']
+            descriptor_model = self.options['descriptor_model']
+            match_threshold = self.options['match_threshold']
+            models = ModelRegistry(self.options['models_dir'])
+            
+            # Load the pre-trained Haar Cascade face detection model
+            face_cascade = models.load_cascade()
+            
+            # Load the DNN face detector if its model files are present; it is
+            # faster and more accurate than the Haar Cascade on large images
+            net = models.load_ssd()
+            if net is not None:
+                # Run once so the first real image doesn't pay for initialization
+                net.setInput(cv2.dnn.blobFromImage(
+                    np.zeros(SSD_INPUT_SIZE + (3,), dtype=np.uint8), 1.0, SSD_INPUT_SIZE, SSD_MEAN))
+                net.forward()
+            
+            # Load the face embedding model if the dnn descriptor is used
+            embedding_net = None
+            embedding_size = None
+            if descriptor == DESCRIPTOR_DNN:
+                try:
+                    embedding_net = cv2.dnn.readNetFromONNX(models.find(descriptor_model) or descriptor_model)
+                    embedding_size = len(self._dnn_embedding(np.zeros((120, 120, 3), dtype=np.uint8), embedding_net))
+                    print(f"Using DNN face embeddings from {descriptor_model}")
+                except Exception as e:
+                    print(f"Face embedding model not available, using LBP descriptors: {e}")
+                    embedding_net = None
+                    descriptor = DESCRIPTOR_LBP
+            if descriptor == DESCRIPTOR_LBP:
+                embedding_size = LBP_GRID * LBP_GRID * 59
+                print("Using LBP face descriptors")
+            elif descriptor == DESCRIPTOR_HISTOGRAM:
+                print("Using histogram-based face comparison (OpenCV face module not required)")
+            
+            # Identifies descriptors that are comparable with each other
+            descriptor_kind = descriptor
+            if descriptor == DESCRIPTOR_DNN:
+                descriptor_kind = f"{descriptor}:{os.path.basename(descriptor_model)}"
+            
+            self.face_cascade = face_cascade
+            self.net = net
+            self.use_dnn = net is not None
+            self.embedding_net = embedding_net
+            self.embedding_size = embedding_size
+            self.descriptor = descriptor
+            self.descriptor_kind = descriptor_kind
+            self.match_threshold = DEFAULT_MATCH_THRESHOLDS[descriptor] if match_threshold is None else match_threshold
+            # Side, in pixels, of the face crops the descriptor works on; larger
+            # client-side crops carry no extra information
+            self.crop_size = self.EMBEDDING_INPUT_SIZE[0] if descriptor == DESCRIPTOR_DNN else 100
+            self.loaded = True
+    
+    @staticmethod
+    def decode_image(data: bytes) -> Optional[np.ndarray]:
         """
-        Detect faces in an image file using DNN or Haar Cascade
+        Decode an encoded image (PNG, JPEG, ...) held in memory
         
         Args:
-            image_path: Path to the image file
+            data: Raw bytes of the encoded image, e.g. an uploaded file
             
         Returns:
-            bool: True if at least one face is detected, False otherwise
+            numpy.ndarray: Decoded BGR image, or None if it could not be decoded
         """
-        try:
-            # Read the image
-            image = cv2.imread(image_path)
-            if image is None:
-                raise ValueError(f"Could not read image from {image_path}")
+        if not data:
+            return None
+        with STAGE_SECONDS.time(stage='decode'):
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    
+    @staticmethod
+    def _load_image(image: Optional[ImageSource]) -> Optional[np.ndarray]:
+        """Return a BGR array for a path or an already decoded image"""
+        if isinstance(image, str):
+            return cv2.imread(image)
+        return image
+    
+    @staticmethod
+    def _describe(image: Optional[ImageSource]) -> str:
+        """Short description of an image source for log messages"""
+        if isinstance(image, str):
+            return image
+        return 'in-memory image'
+        
+    def _working_image(self, image: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Downscale an image to the detection size; returns it with the scale applied"""
+        h, w = image.shape[:2]
+        if self.detection_size <= 0 or max(h, w) <= self.detection_size:
+            return image, 1.0
+        scale = self.detection_size / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+    
+    def detect_face_boxes(self, image: np.ndarray,
+                          gray: Optional[np.ndarray] = None) -> List[Tuple[Tuple[int, int, int, int], Optional[float]]]:
+        """
+        Run face detection once on a decoded image
+        
+        Detection runs on a copy downscaled to detection_size, and the boxes
+        are mapped back to the coordinates of the original image. The DNN
+        detector is tried first when available; the Haar Cascade is used when
+        the DNN is missing, fails or finds nothing.
+        
+        Args:
+            image: Decoded BGR image
+            gray: Grayscale version of the image, computed if omitted; unused
+                when the image is downscaled
             
-            # Try DNN face detection first if available
-            if self.use_dnn and self.net is not None:
-                try:
-                    h, w = image.shape[:2]
-                    blob = cv2.dnn.blobFromImage(image, 1.0, (300, 300), [104, 117, 123])
-                    self.net.setInput(blob)
-                    detections = self.net.forward()
-                    
-                    # Check for face detections with confidence > 0.5
-                    for i in range(detections.shape[2]):
-                        confidence = detections[0, 0, i, 2]
-                        if confidence > 0.5:
-                            return True
-                except Exception as e:
-                    print(f"DNN detection failed: {e}, falling back to Haar Cascade")
+        Returns:
+            List of ((x, y, width, height), confidence) tuples in original
+            image coordinates, largest face first. Confidence is the DNN
+            score, or None for Haar detections.
+        """
+        return self.detect_face_boxes_batch([image], [gray])[0]
+    
+    def detect_face_boxes_batch(self, images: List[np.ndarray], grays: Optional[List[Optional[np.ndarray]]] = None
+                                ) -> List[List[Tuple[Tuple[int, int, int, int], Optional[float]]]]:
+        """
+        Run face detection on several decoded images at once
+        
+        The DNN detector sees all images in one forward pass (blobFromImages);
+        images it finds no face in go through the Haar Cascade one by one.
+        
+        Args:
+            images: Decoded BGR images
+            grays: Grayscale versions of the images, None entries computed
             
-            # Fallback to Haar Cascade
+        Returns:
+            For each image, the boxes as returned by detect_face_boxes
+        """
+        with STAGE_SECONDS.time(stage='detect'):
+            return self._detect_face_boxes_batch(images, grays)
+    
+    def _detect_face_boxes_batch(self, images: List[np.ndarray], grays: Optional[List[Optional[np.ndarray]]]
+                                 ) -> List[List[Tuple[Tuple[int, int, int, int], Optional[float]]]]:
+        if grays is None:
+            grays = [None] * len(images)
+        working = [self._working_image(image) for image in images]
+        results: List[list] = [[] for _ in images]
+        
+        # Try DNN face detection first if available
+        if self.use_dnn and self.net is not None and images:
+            try:
+                blob = cv2.dnn.blobFromImages([small for small, _ in working], 1.0, SSD_INPUT_SIZE, SSD_MEAN)
+                self.net.setInput(blob)
+                detections = self.net.forward()
+                for index, (small, _) in enumerate(working):
+                    results[index] = self._ssd_boxes(detections, index, *small.shape[:2])
+            except Exception as e:
+                print(f"DNN detection failed: {e}, falling back to Haar Cascade")
+        
+        for index, ((small, scale), gray) in enumerate(zip(working, grays)):
+            if not results[index]:
+                # Fallback to Haar Cascade
+                results[index] = self._haar_boxes(small, gray if scale == 1.0 else None)
+            if scale != 1.0:
+                results[index] = self._scale_boxes(results[index], scale, *images[index].shape[:2])
+        return results
+    
+    @staticmethod
+    def _scale_boxes(boxes: list, scale: float, h: int, w: int) -> list:
+        """Map boxes found on a working image back to the original image"""
+        scaled = []
+        for (x, y, bw, bh), confidence in boxes:
+            x1, y1 = int(x / scale), int(y / scale)
+            x2, y2 = min(w, int(round((x + bw) / scale))), min(h, int(round((y + bh) / scale)))
+            scaled.append(((x1, y1, x2 - x1, y2 - y1), confidence))
+        return scaled
+    
+    @staticmethod
+    def _ssd_boxes(detections: np.ndarray, image_index: int, h: int, w: int) -> list:
+        """Boxes of one image from a (possibly batched) SSD output, largest first"""
+        # Keep face detections with confidence > 0.5; column 0 is the image's
+        # index in the batch
+        boxes = []
+        for detection in detections[0, 0]:
+            confidence = float(detection[2])
+            if int(detection[0]) != image_index or confidence <= 0.5:
+                continue
+            x1, y1, x2, y2 = (detection[3:7] * [w, h, w, h]).astype(int)
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(w, x2), min(h, y2)
+            if x2 > x1 and y2 > y1:
+                boxes.append(((int(x1), int(y1), int(x2 - x1), int(y2 - y1)), confidence))
+        return sorted(boxes, key=lambda box: box[0][2] * box[0][3], reverse=True)
+    
+    def _haar_boxes(self, image: np.ndarray, gray: Optional[np.ndarray] = None) -> list:
+        """Haar Cascade boxes, largest first"""
+        if self.face_cascade is None:
+            return []
+        if gray is None:
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        # Detect faces with multiple scale factors for better detection
+        for scale_factor in [1.1, 1.2, 1.3]:
+            faces = self.face_cascade.detectMultiScale(
+                gray,
+                scaleFactor=scale_factor,
+                minNeighbors=5,
+                minSize=(30, 30),
+                flags=cv2.CASCADE_SCALE_IMAGE
+            )
+            if len(faces) > 0:
+                boxes = [((int(x), int(y), int(fw), int(fh)), None) for x, y, fw, fh in faces]
+                return sorted(boxes, key=lambda box: box[0][2] * box[0][3], reverse=True)
+        
+        return []
+    
+    def analyze_image(self, image_source: ImageSource) -> List[DetectedFace]:
+        """
+        Detect all faces in an image and compute their recognition descriptors
+        
+        Detection runs exactly once, on a downscaled copy of large images;
+        the face regions and histograms are cut from the full-resolution
+        image at the detected boxes, so callers never need to detect again.
+        
+        Args:
+            image_source: Path to the image file or decoded BGR image
             
-            # Detect faces with multiple scale factors for better detection
-            for scale_factor in [1.1, 1.2, 1.3]:
-                faces = self.face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=scale_factor,
-                    minNeighbors=5,
-                    minSize=(30, 30),
-                    flags=cv2.CASCADE_SCALE_IMAGE
-                )
-                if len(faces) > 0:
-                    return True
+        Returns:
+            List of DetectedFace, largest face first (empty if none found)
             
-            return False
+        Raises:
+            ValueError: If the image could not be read
+        """
+        image = self._load_image(image_source)
+        if image is None:
+            raise ValueError(f"Could not read image from {self._describe(image_source)}")
+        return self._describe_faces(image, self.detect_face_boxes(image))
+    
+    def analyze_images(self, image_sources: List[ImageSource]) -> List[List[DetectedFace]]:
+        """
+        analyze_image for several images, detecting faces in one batch
+        
+        Args:
+            image_sources: Paths to image files or decoded BGR images
             
-        except Exception as e:
-            print(f"Error detecting faces in {image_path}: {str(e)}")
-            return False
+        Returns:
+            For each image, its list of DetectedFace, largest face first
+            
+        Raises:
+            ValueError: If an image could not be read
+        """
+        images = []
+        for image_source in image_sources:
+            image = self._load_image(image_source)
+            if image is None:
+                raise ValueError(f"Could not read image from {self._describe(image_source)}")
+            images.append(image)
+        return [
+            self._describe_faces(image, boxes)
+            for image, boxes in zip(images, self.detect_face_boxes_batch(images))
+        ]
+    
+    def _describe_faces(self, image: np.ndarray, boxes: list) -> List[DetectedFace]:
+        with STAGE_SECONDS.time(stage='extract'):
+            faces = self._extract_faces(image, boxes)
+        FACES_DETECTED.inc(len(faces))
+        return faces
     
-    def extract_face_features(self, image_path: str) -> Optional[np.ndarray]:
+    def _extract_faces(self, image: np.ndarray, boxes: list) -> List[DetectedFace]:
+        # Crop at full resolution and describe each crop
+        return [self._describe_crop(image[y:y+h, x:x+w], (x, y, w, h), confidence)
+                for (x, y, w, h), confidence in boxes]
+    
+    def _describe_crop(self, crop: np.ndarray, box: Tuple[int, int, int, int],
+                       confidence: Optional[float]) -> DetectedFace:
+        # Convert only the crop to grayscale and resize to standard size for comparison
+        x, y, w, h = box
+        face_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        face_region = cv2.resize(face_gray, (100, 100))
+        embedding = None
+        if self.descriptor == DESCRIPTOR_DNN:
+            embedding = self._dnn_embedding(crop)
+        elif self.descriptor == DESCRIPTOR_LBP:
+            embedding = lbp_descriptor(face_region)
+        return DetectedFace(
+            x=x, y=y, width=w, height=h,
+            confidence=confidence,
+            face_region=face_region,
+            histogram=self.face_histogram(face_region),
+            embedding=embedding
+        )
+    
+    def describe_face_crops(self, crops: List[np.ndarray], boxes: List[Tuple[int, int, int, int]],
+                            sort: bool = True) -> List[DetectedFace]:
         """
-        Extract face features from an image for recognition
+        Compute recognition descriptors of faces detected and cropped elsewhere
+        
+        Used for clients that run detection themselves (or reuse an earlier
+        detection) and upload only the face crops, so no detection runs here.
+        Each crop is taken as exactly the face box; crops of crop_size
+        pixels per side lose nothing, as faces are described at that size.
         
         Args:
-            image_path: Path to the image file
+            crops: Decoded BGR face crops
+            boxes: (x, y, width, height) of each crop in the client's frame,
+                reported back in the results
+            sort: Order the faces largest first; False keeps the order of
+                the crops
             
         Returns:
-            numpy.ndarray: Face region as grayscale array, or None if no face found
+            List of DetectedFace, largest face first unless sort is False
+            
+        Raises:
+            ValueError: If crops and boxes differ in length or a crop is empty
+        """
+        if len(crops) != len(boxes):
+            raise ValueError(f"Got {len(crops)} face crops but {len(boxes)} boxes")
+        if any(crop is None or crop.size == 0 for crop in crops):
+            raise ValueError("Could not read face crop")
+        with STAGE_SECONDS.time(stage='extract'):
+            faces = [self._describe_crop(crop, tuple(int(v) for v in box), None)
+                     for crop, box in zip(crops, boxes)]
+        FACES_DETECTED.inc(len(faces))
+        if sort:
+            faces.sort(key=lambda face: face.width * face.height, reverse=True)
+        return faces
+    
+    def _dnn_embedding(self, face_image: np.ndarray, embedding_net: Optional[cv2.dnn.Net] = None) -> np.ndarray:
+        """Unit-length float16 embedding of a BGR face crop from the embedding model"""
+        embedding_net = embedding_net or self.embedding_net
+        blob = cv2.dnn.blobFromImage(face_image, 1.0, self.EMBEDDING_INPUT_SIZE, (0, 0, 0), swapRB=True)
+        embedding_net.setInput(blob)
+        embedding = embedding_net.forward().ravel().astype(np.float32)
+        return (embedding / max(float(np.linalg.norm(embedding)), 1e-12)).astype(np.float16)
+        
+    def detect_faces_in_image(self, image_source: ImageSource) -> List[Tuple[Tuple[int, int, int, int], Optional[float]]]:
+        """
+        Detect faces in an image using DNN or Haar Cascade
+        
+        Args:
+            image_source: Path to the image file or decoded BGR image
+            
+        Returns:
+            List of ((x, y, width, height), confidence) tuples as returned by
+            detect_face_boxes; empty (falsy) if no face is detected
         """
         try:
             # Read the image
-            image = cv2.imread(image_path)
+            image = self._load_image(image_source)
             if image is None:
-                return None
+                raise ValueError(f"Could not read image from {self._describe(image_source)}")
             
-            # Convert to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            return self.detect_face_boxes(image)
             
-            # Detect faces
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30)
-            )
+        except Exception as e:
+            print(f"Error detecting faces in {self._describe(image_source)}: {str(e)}")
+            return []
+    
+    def extract_face_features(self, image_source: ImageSource) -> Optional[np.ndarray]:
+        """
+        Extract face features from an image for recognition
+        
+        Args:
+            image_source: Path to the image file or decoded BGR image
             
-            if len(faces) == 0:
+        Returns:
+            numpy.ndarray: Face region as grayscale array, or None if no face found
+        """
+        try:
+            faces = self.analyze_image(image_source)
+            if not faces:
                 return None
             
-            # Take the first (largest) face
-            x, y, w, h = faces[0]
-            face_region = gray[y:y+h, x:x+w]
-            
-            # Resize to standard size for comparison
-            face_region = cv2.resize(face_region, (100, 100))
-            
-            return face_region
+            # Take the largest face
+            return faces[0].face_region
             
         except Exception as e:
-            print(f"Error extracting face features from {image_path}: {str(e)}")
+            print(f"Error extracting face features from {self._describe(image_source)}: {str(e)}")
             return None
     
-    def compare_faces(self, image1_path: str, image2_path: str) -> float:
+    def face_histogram(self, face_region: np.ndarray) -> np.ndarray:
+        """
+        Compute the grayscale histogram used for face comparison
+        
+        Args:
+            face_region: Face region as returned by extract_face_features
+            
+        Returns:
+            numpy.ndarray: 256-bin histogram as a flat float32 array
+        """
+        return cv2.calcHist([face_region], [0], None, [256], [0, 256]).ravel()
+    
+    def compare_faces(self, image1_path: ImageSource, image2_path: ImageSource) -> float:
         """
         Compare two face images and return similarity score
         
         Args:
-            image1_path: Path to first image
-            image2_path: Path to second image
+            image1_path: Path to first image or decoded BGR image
+            image2_path: Path to second image or decoded BGR image
             
         Returns:
             float: Similarity score between 0.0 and 1.0 (higher means more similar)
         """
-        try:
-            # Extract face features from both images
-            face1 = self.extract_face_features(image1_path)
-            face2 = self.extract_face_features(image2_path)
-            
-            if face1 is None or face2 is None:
-                return 0.0
+        # Extract face features from both images
+        face1 = self.extract_face_features(image1_path)
+        face2 = self.extract_face_features(image2_path)
+        
+        if face1 is None or face2 is None:
+            return 0.0
+        
+        return self.compare_face_regions(face1, face2)
+    
+    def compare_face_regions(self, face1: np.ndarray, face2: np.ndarray,
+                             hist1: Optional[np.ndarray] = None,
+                             hist2: Optional[np.ndarray] = None) -> float:
+        """
+        Compare two already extracted face regions and return similarity score
+        
+        Args:
+            face1: First face region (100x100 grayscale)
+            face2: Second face region (100x100 grayscale)
+            hist1: Precomputed histogram of face1, computed if omitted
+            hist2: Precomputed histogram of face2, computed if omitted
             
+        Returns:
+            float: Similarity score between 0.0 and 1.0 (higher means more similar)
+        """
+        try:
             # Calculate histogram comparison
-            hist1 = cv2.calcHist([face1], [0], None, [256], [0, 256])
-            hist2 = cv2.calcHist([face2], [0], None, [256], [0, 256])
+            if hist1 is None:
+                hist1 = self.face_histogram(face1)
+            if hist2 is None:
+                hist2 = self.face_histogram(face2)
             
             # Use correlation method for comparison
             correlation = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
@@ -153,7 +703,7 @@ class FaceDetector:
             template_score = float(np.max(result))
             
             # Combine both scores (weighted average)
-            combined_score = (float(correlation) * 0.6) + (template_score * 0.4)
+            combined_score = (float(correlation) * HISTOGRAM_WEIGHT) + (template_score * TEMPLATE_WEIGHT)
             
             # Ensure score is between 0 and 1
             return max(0.0, min(1.0, combined_score))
@@ -162,6 +712,166 @@ class FaceDetector:
             print(f"Error comparing faces: {str(e)}")
             return 0.0
     
+    def score_against_gallery(self, probe_face: np.ndarray, gallery_faces: np.ndarray,
+                              gallery_histograms: np.ndarray,
+                              probe_histogram: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Score a probe face against every gallery face in one vectorized pass
+        
+        Reproduces compare_face_regions(gallery_face, probe_face) for each row:
+        0.6 * histogram correlation + 0.4 * normalized cross-correlation,
+        clipped to [0, 1].
+        
+        Args:
+            probe_face: Probe face region (100x100 grayscale)
+            gallery_faces: Gallery face regions, shape (N, 100, 100)
+            gallery_histograms: Gallery histograms, shape (N, 256)
+            probe_histogram: Precomputed histogram of the probe, computed if omitted
+            
+        Returns:
+            numpy.ndarray: Similarity score for each gallery face, shape (N,)
+        """
+        if len(gallery_faces) == 0:
+            return np.empty(0, dtype=np.float64)
+        if probe_histogram is None:
+            probe_histogram = self.face_histogram(probe_face)
+        
+        # Histogram correlation, same as cv2.compareHist(..., cv2.HISTCMP_CORREL)
+        histograms = np.asarray(gallery_histograms, dtype=np.float64)
+        histograms = histograms - histograms.mean(axis=1, keepdims=True)
+        probe_hist = np.asarray(probe_histogram, dtype=np.float64).ravel()
+        probe_hist = probe_hist - probe_hist.mean()
+        hist_denominator = np.einsum('ij,ij->i', histograms, histograms) * np.dot(probe_hist, probe_hist)
+        degenerate = np.abs(hist_denominator) <= np.finfo(np.float64).eps
+        correlation = np.ones(len(histograms))
+        correlation[~degenerate] = (histograms[~degenerate] @ probe_hist) / np.sqrt(hist_denominator[~degenerate])
+        
+        # Normalized cross-correlation of equally sized crops, same as
+        # cv2.matchTemplate(gallery_face, probe_face, cv2.TM_CCOEFF_NORMED)
+        template = probe_face.astype(np.float64).ravel()
+        template = template - template.mean()
+        template_norm = np.sqrt(np.dot(template, template))
+        if template_norm < np.finfo(np.float64).eps:
+            # OpenCV reports a perfect match for a flat template
+            template_score = np.ones(len(gallery_faces))
+        else:
+            faces = gallery_faces.reshape(len(gallery_faces), -1)
+            area = faces.shape[1]
+            template_score = np.empty(len(faces))
+            for start in range(0, len(faces), self.MATCH_CHUNK_SIZE):
+                chunk = faces[start:start + self.MATCH_CHUNK_SIZE].astype(np.float64)
+                # The template is zero-mean, so the window mean drops out of the numerator
+                numerator = chunk @ template
+                window_sum = chunk.sum(axis=1)
+                window_sum2 = np.einsum('ij,ij->i', chunk, chunk)
+                variance = np.maximum(window_sum2 - window_sum * window_sum / area, 0)
+                flat = variance <= np.minimum(0.5, 10 * np.finfo(np.float32).eps * window_sum2)
+                denominator = np.sqrt(variance) * template_norm
+                template_score[start:start + len(chunk)] = np.where(
+                    flat, 0.0, numerator / np.where(flat, 1.0, denominator))
+        
+        combined = (correlation * HISTOGRAM_WEIGHT) + (template_score * TEMPLATE_WEIGHT)
+        return np.clip(combined, 0.0, 1.0)
+    
+    def match_against_gallery(self, probe_face: np.ndarray, gallery_faces: np.ndarray,
+                              gallery_histograms: np.ndarray, top_k: int = 1,
+                              threshold: float = 0.6,
+                              probe_histogram: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Find the best matching gallery faces for a probe face
+        
+        Args:
+            probe_face: Probe face region (100x100 grayscale)
+            gallery_faces: Gallery face regions, shape (N, 100, 100)
+            gallery_histograms: Gallery histograms, shape (N, 256)
+            top_k: Maximum number of matches to return
+            threshold: Scores must be strictly greater than this to match
+            probe_histogram: Precomputed histogram of the probe, computed if omitted
+            
+        Returns:
+            List of tuples: (gallery row index, score), best match first
+        """
+        scores = self.score_against_gallery(probe_face, gallery_faces, gallery_histograms, probe_histogram)
+        return self._top_matches(scores, top_k, threshold)
+    
+    @staticmethod
+    def _top_matches(scores: np.ndarray, top_k: int, threshold: float) -> List[Tuple[int, float]]:
+        candidates = np.flatnonzero(scores > threshold)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        # Stable sort keeps the lowest row index first among equal scores
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(index), float(scores[index])) for index in candidates]
+    
+    def face_descriptor(self, face: DetectedFace) -> Tuple[np.ndarray, ...]:
+        """
+        The parts of a detected face that the configured descriptor compares
+        
+        Returns:
+            (face_region, histogram) for the histogram descriptor, otherwise
+            (embedding,)
+        """
+        if self.descriptor == DESCRIPTOR_HISTOGRAM:
+            return face.face_region, face.histogram
+        return (face.embedding,)
+    
+    def empty_descriptors(self) -> Tuple[np.ndarray, ...]:
+        """Gallery matrices with no rows, shaped like stacked face_descriptor results"""
+        if self.descriptor == DESCRIPTOR_HISTOGRAM:
+            return np.empty((0, 100, 100), dtype=np.uint8), np.empty((0, 256), dtype=np.float32)
+        return (np.empty((0, self.embedding_size), dtype=np.float16),)
+    
+    def score_descriptors(self, probe: Tuple[np.ndarray, ...], gallery: Tuple[np.ndarray, ...]) -> np.ndarray:
+        """
+        Score a probe descriptor against stacked gallery descriptors
+        
+        Args:
+            probe: Result of face_descriptor for the probe face
+            gallery: Gallery matrices, one row per enrolled face
+            
+        Returns:
+            numpy.ndarray: Similarity for each gallery row, between 0 and 1
+        """
+        if self.descriptor == DESCRIPTOR_HISTOGRAM:
+            return self.score_against_gallery(probe[0], gallery[0], gallery[1], probe[1])
+        
+        # Unit-length embeddings: the similarity is the dot product
+        embeddings = gallery[0]
+        probe_vector = probe[0].astype(np.float32)
+        scores = np.empty(len(embeddings), dtype=np.float64)
+        for start in range(0, len(embeddings), self.EMBEDDING_CHUNK_SIZE):
+            chunk = embeddings[start:start + self.EMBEDDING_CHUNK_SIZE].astype(np.float32)
+            scores[start:start + len(chunk)] = chunk @ probe_vector
+        return np.clip(scores, 0.0, 1.0)
+    
+    def match_descriptors(self, probe: Tuple[np.ndarray, ...], gallery: Tuple[np.ndarray, ...],
+                          top_k: int = 1, threshold: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Find the best matching gallery rows for a probe descriptor
+        
+        Args:
+            probe: Result of face_descriptor for the probe face
+            gallery: Gallery matrices, one row per enrolled face
+            top_k: Maximum number of matches to return
+            threshold: Scores must be strictly greater than this to match,
+                defaults to match_threshold
+            
+        Returns:
+            List of tuples: (gallery row index, score), best match first
+        """
+        if threshold is None:
+            threshold = self.match_threshold
+        return self._top_matches(self.score_descriptors(probe, gallery), top_k, threshold)
+    
+    def descriptor_vectors(self, *descriptors: np.ndarray) -> np.ndarray:
+        """
+        Stacked gallery descriptors as float32 vectors whose inner products
+        are the similarity, for nearest-neighbor search
+        """
+        if self.descriptor == DESCRIPTOR_HISTOGRAM:
+            return histogram_template_vectors(*descriptors)
+        return descriptors[0].astype(np.float32)
+    
     def detect_faces_in_frame(self, frame: np.ndarray) -> List[Tuple[int, int, int, int]]:
         """
         Detect faces in a video frame
@@ -173,66 +883,43 @@ class FaceDetector:
             List of tuples: Each tuple contains (x, y, width, height) of detected face
         """
         try:
-            # Convert to grayscale
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            # Detect faces with multiple scale factors for better detection
-            faces = []
-            for scale_factor in [1.1, 1.2, 1.3]:
-                detected = self.face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=scale_factor,
-                    minNeighbors=5,
-                    minSize=(50, 50),
-                    flags=cv2.CASCADE_SCALE_IMAGE
-                )
-                if len(detected) > 0:
-                    faces = detected
-                    break
-            
-            return [(x, y, w, h) for x, y, w, h in faces]
+            return [box for box, _ in self.detect_face_boxes(frame)]
             
         except Exception as e:
             print(f"Error detecting faces in frame: {str(e)}")
             return []
     
-    def detect_and_recognize_in_image(self, image_path: str) -> dict:
+    def detect_and_recognize_in_image(self, image_source: ImageSource) -> dict:
         """
         Detect faces and return detailed information including coordinates
         
         Args:
-            image_path: Path to the image file
+            image_source: Path to the image file or decoded BGR image
             
         Returns:
             dict: Detection results with face coordinates and recognition info
         """
         try:
             # Read the image
-            image = cv2.imread(image_path)
+            image = self._load_image(image_source)
             if image is None:
                 return {'success': False, 'error': 'Could not read image'}
             
             # Detect faces and get coordinates
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(50, 50),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            faces = self.detect_face_boxes(image)
             
             if len(faces) == 0:
                 return {'success': False, 'error': 'No faces detected'}
             
             # Return face coordinates for drawing bounding boxes
             face_data = []
-            for (x, y, w, h) in faces:
+            for (x, y, w, h), confidence in faces:
                 face_data.append({
-                    'x': int(x),
-                    'y': int(y),
-                    'width': int(w),
-                    'height': int(h)
+                    'x': x,
+                    'y': y,
+                    'width': w,
+                    'height': h,
+                    'confidence': confidence
                 })
             
             return {
@@ -0,0 +1,377 @@
+import itertools
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from face_detection import DetectedFace, FaceDetector
+from metrics import REGISTRY
+
+# Detector owned by the current worker process (or by the web process when
+# the pool runs inline)
+_detector: Optional[FaceDetector] = None
+
+
+def _init_worker(detector_options: Optional[dict] = None):
+    """Load the models once per worker process"""
+    global _detector
+    # Each worker is one unit of parallelism; don't let OpenCV spawn its own
+    # thread pool on top of it
+    cv2.setNumThreads(1)
+    _detector = FaceDetector(**(detector_options or {}))
+    _detector.load()
+
+
+def _process_pool(workers: int, detector_options: dict) -> ProcessPoolExecutor:
+    """
+    Create a worker process pool
+
+    The pool is usually started from a background thread while other threads
+    (warm-up, attendance writer, requests) are running, and a fork would copy
+    whatever locks they hold. Workers are started by a forkserver instead, or
+    spawned where that isn't available.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # Import the models' dependencies once in the server rather than in every worker
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                               initargs=(detector_options,))
+
+
+def _with_metrics(job: Callable, *args):
+    """Run a job in a worker process and return its result with the metric updates it made"""
+    with REGISTRY.capture() as events:
+        result = job(*args)
+    return result, events
+
+
+def _warm_up() -> int:
+    """Run one detection so the first real request doesn't pay for lazy initialization"""
+    _detector.detect_face_boxes(np.zeros((300, 300, 3), dtype=np.uint8))
+    return os.getpid()
+
+
+def _analyze(data: bytes) -> List[DetectedFace]:
+    image = FaceDetector.decode_image(data)
+    if image is None:
+        return []
+    return _detector.analyze_image(image)
+
+
+def _analyze_image(image: np.ndarray) -> List[DetectedFace]:
+    return _detector.analyze_image(image)
+
+
+def _describe_crops(crops: List[bytes], boxes: List[Tuple[int, int, int, int]],
+                    sort: bool = True) -> List[DetectedFace]:
+    return _detector.describe_face_crops([FaceDetector.decode_image(data) for data in crops], boxes, sort)
+
+
+def _detect_boxes(image: np.ndarray) -> List[Tuple[Tuple[int, int, int, int], Optional[float]]]:
+    return _detector.detect_face_boxes(image)
+
+
+def _detect(data: bytes) -> dict:
+    return _detector.detect_and_recognize_in_image(FaceDetector.decode_image(data))
+
+
+def _analyze_many(images: List[bytes], detector: Optional[FaceDetector] = None
+                  ) -> List[Union[List[DetectedFace], Exception]]:
+    """Decode encoded images and detect their faces in one batch (see BatchAnalyzer.analyze)"""
+    results: List[Union[List[DetectedFace], Exception, None]] = [None] * len(images)
+    decoded = []
+    for index, data in enumerate(images):
+        image = FaceDetector.decode_image(data)
+        if image is None:
+            results[index] = []
+        else:
+            decoded.append((index, image))
+
+    batch = _analyze_decoded([image for _, image in decoded], detector)
+    for (index, _), faces in zip(decoded, batch):
+        results[index] = faces
+    return results
+
+
+def _analyze_decoded(images: List[np.ndarray], detector: Optional[FaceDetector] = None
+                     ) -> List[Union[List[DetectedFace], Exception]]:
+    """Detect the faces of decoded images in one batch, reporting failures per image"""
+    detector = detector or _detector
+    try:
+        return detector.analyze_images(images)
+    except Exception:
+        # Find the images that fail by analyzing them one by one
+        results = []
+        for image in images:
+            try:
+                results.append(detector.analyze_image(image))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class BatchAnalyzer:
+    """
+    Detects and describes the faces in many encoded images using all cores
+
+    Runs its own process pool, so a batch job (e.g. bulk enrollment) doesn't
+    take the slots of the request pool. Each process detects faces in chunks
+    of images at a time (FaceDetector.analyze_images). Use as a context
+    manager.
+    """
+
+    # Most images per detection batch
+    CHUNK_SIZE = 16
+
+    def __init__(self, workers: int, detector_options: Optional[dict] = None):
+        """
+        Args:
+            workers: Worker processes to use, 0 to run in the calling process
+            detector_options: FaceDetector arguments (FaceDetector.options)
+        """
+        self.workers = workers
+        self.detector_options = detector_options or {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._detector: Optional[FaceDetector] = None
+
+    def __enter__(self) -> 'BatchAnalyzer':
+        if self.workers > 0:
+            self._executor = _process_pool(self.workers, self.detector_options)
+        else:
+            # A detector of its own, the shared one is not safe to use concurrently
+            self._detector = FaceDetector(**self.detector_options)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def analyze(self, images: List[bytes]) -> List[Union[List[DetectedFace], Exception]]:
+        """
+        Args:
+            images: Raw bytes of the encoded images
+
+        Returns:
+            For each image, in order, the list of DetectedFace (largest
+            first) or the exception raised while processing it
+        """
+        # Small enough chunks that every worker gets one
+        chunk_size = max(1, min(self.CHUNK_SIZE, -(-len(images) // max(1, self.workers))))
+        chunks = [images[start:start + chunk_size] for start in range(0, len(images), chunk_size)]
+        results: List[Union[List[DetectedFace], Exception]] = []
+        if self._executor is None:
+            for chunk in chunks:
+                results.extend(_analyze_many(chunk, self._detector))
+            return results
+
+        futures = [self._executor.submit(_with_metrics, _analyze_many, chunk) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunk_results, events = future.result()
+            except Exception as e:
+                results.extend([e] * len(chunk))
+                continue
+            REGISTRY.replay(events)
+            results.extend(chunk_results)
+        return results
+
+    def analyze_stream(self, images: Iterable[np.ndarray], chunk_size: int = 4,
+                       max_pending: Optional[int] = None) -> Iterator[Union[List[DetectedFace], Exception]]:
+        """
+        Detect and describe the faces in a stream of decoded images, e.g. video frames
+
+        Images are read from the iterable only as fast as the workers keep
+        up: at most max_pending chunks are in flight, so memory use does not
+        depend on the length of the stream.
+
+        Args:
+            images: Decoded BGR images
+            chunk_size: Images per detection batch
+            max_pending: Chunks submitted ahead of the one being waited for
+                (default: twice the number of workers)
+
+        Yields:
+            For each image, in order, its list of DetectedFace (largest
+            first) or the exception raised while processing it
+        """
+        images = iter(images)
+        chunks = iter(lambda: list(itertools.islice(images, chunk_size)), [])
+        if self._executor is None:
+            for chunk in chunks:
+                yield from _analyze_decoded(chunk, self._detector)
+            return
+
+        max_pending = max_pending or 2 * self.workers
+        pending: deque = deque()
+        for chunk in chunks:
+            pending.append((len(chunk), self._executor.submit(_with_metrics, _analyze_decoded, chunk)))
+            if len(pending) >= max_pending:
+                yield from self._chunk_results(*pending.popleft())
+        while pending:
+            yield from self._chunk_results(*pending.popleft())
+
+    def _chunk_results(self, size: int, future: Future) -> List[Union[List[DetectedFace], Exception]]:
+        try:
+            chunk_results, events = future.result()
+        except Exception as e:
+            return [e] * size
+        REGISTRY.replay(events)
+        return chunk_results
+
+
+class PoolBusyError(Exception):
+    """Raised when the face processing queue is full and a job is rejected"""
+
+
+class FaceWorkerPool:
+    """
+    Runs CPU-bound face processing off the Flask request threads
+
+    With workers > 0 jobs go to a process pool in which every process owns its
+    own FaceDetector. With workers == 0 jobs run in the calling thread on a
+    shared detector, one at a time, since cv2.dnn networks are not safe to
+    use from several threads.
+
+    At most workers + queue_size jobs are accepted at once; further jobs are
+    rejected with PoolBusyError instead of queueing without bound.
+    """
+
+    def __init__(self, workers: int = 0, queue_size: int = 16, timeout: float = 10.0,
+                 detector_options: Optional[dict] = None):
+        """
+        Args:
+            workers: Number of worker processes, 0 to run jobs inline
+            queue_size: Jobs allowed to wait for a free worker
+            timeout: Seconds to wait for a job's result
+            detector_options: FaceDetector arguments for the workers (FaceDetector.options)
+        """
+        self.workers = workers
+        self.detector_options = detector_options or {}
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, workers) + queue_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inline_lock = threading.Lock()
+
+    def start(self, inline_detector: Optional[FaceDetector] = None):
+        """
+        Start and warm up the worker processes
+
+        Worker processes are not inherited across forks of the web process and
+        load their own models, so this runs in every serving process.
+
+        Args:
+            inline_detector: Detector to use when running without workers
+        """
+        global _detector
+        if self.workers <= 0:
+            _detector = inline_detector or FaceDetector(**self.detector_options)
+            return
+
+        self._executor = _process_pool(self.workers, self.detector_options)
+        # Submitting one job per worker makes the executor start all of them now
+        wait([self._executor.submit(_warm_up) for _ in range(self.workers)])
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run(self, job: Callable, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusyError('Face processing queue is full, try again shortly')
+
+        if self._executor is None:
+            try:
+                with self._inline_lock:
+                    return job(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future: Future = self._executor.submit(_with_metrics, job, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # Free the slot when the job finishes, even if we stop waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        result, events = future.result(timeout=self.timeout)
+        REGISTRY.replay(events)
+        return result
+
+    def analyze(self, data: bytes) -> List[DetectedFace]:
+        """
+        Decode an encoded image and detect and describe all faces in it
+
+        Args:
+            data: Raw bytes of the encoded image
+
+        Returns:
+            List of DetectedFace, largest face first (empty if none found or
+            the image could not be decoded)
+        """
+        return self._run(_analyze, data)
+
+    def analyze_image(self, image: np.ndarray) -> List[DetectedFace]:
+        """
+        Detect and describe all faces in an already decoded image
+
+        Args:
+            image: Decoded BGR image
+
+        Returns:
+            List of DetectedFace, largest face first
+        """
+        return self._run(_analyze_image, image)
+
+    def describe_crops(self, crops: List[bytes], boxes: List[Tuple[int, int, int, int]],
+                       sort: bool = True) -> List[DetectedFace]:
+        """
+        Decode face crops uploaded by a client and compute their descriptors
+
+        Args:
+            crops: Raw bytes of the encoded face crops
+            boxes: (x, y, width, height) of each crop in the client's frame
+            sort: Order the faces largest first; False keeps the order of the crops
+
+        Returns:
+            List of DetectedFace, largest face first unless sort is False
+
+        Raises:
+            ValueError: If a crop could not be decoded or the boxes don't match
+        """
+        return self._run(_describe_crops, crops, boxes, sort)
+
+    def detect_face_boxes(self, image: np.ndarray) -> List[Tuple[Tuple[int, int, int, int], Optional[float]]]:
+        """
+        Detect the faces in an already decoded image, without describing them
+
+        Args:
+            image: Decoded BGR image
+
+        Returns:
+            List of ((x, y, width, height), confidence), largest face first
+        """
+        return self._run(_detect_boxes, image)
+
+    def detect(self, data: bytes) -> dict:
+        """
+        Decode an encoded image and return face bounding boxes
+
+        Args:
+            data: Raw bytes of the encoded image
+
+        Returns:
+            dict: Same result as FaceDetector.detect_and_recognize_in_image
+        """
+        return self._run(_detect, data)
@@ -0,0 +1,402 @@
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from ann_index import IVFIndex
+from face_detection import DetectedFace, FaceDetector
+from metrics import FACE_MATCHES, FACE_REJECTIONS, STAGE_SECONDS
+
+
+class FaceGallery:
+    """
+    Face descriptors of all enrolled students, kept in memory as contiguous
+    matrices and mirrored to an on-disk cache.
+
+    Each student's photo is processed once (at registration or when the photo
+    changes) instead of on every recognition request.
+    """
+
+    def __init__(self, face_detector: FaceDetector, cache_path: str,
+                 ann_index: Optional[IVFIndex] = None, ann_path: Optional[str] = None,
+                 ann_min_size: int = 2000, ann_candidates: int = 100):
+        """
+        Args:
+            face_detector: Detector used to extract descriptors from photos
+            cache_path: Location of the .npz cache file
+            ann_index: Approximate nearest-neighbor index used to pick the
+                candidates that are scored exactly, None to always scan the
+                whole gallery
+            ann_path: Location of the index's .npz file
+            ann_min_size: Gallery size from which the index is used
+            ann_candidates: Candidates from the index that are scored exactly
+        """
+        self.face_detector = face_detector
+        self.cache_path = cache_path
+        self.ann_index = ann_index
+        self.ann_path = ann_path
+        self.ann_min_size = ann_min_size
+        self.ann_candidates = ann_candidates
+        self._lock = threading.RLock()
+        # Photo each entry was computed from, used to detect photo changes
+        self._sources: Dict[int, Tuple[str, float]] = {}
+        # The descriptor matrices' shapes depend on the detector's models,
+        # so they are created on first use (_ensure_matrices)
+        self._snapshot = (np.empty(0, dtype=np.int64), ())
+        # Bumped on every change, so results matched against an older
+        # gallery can be recognized (e.g. by the recognition cache)
+        self.version = 0
+
+    @property
+    def threshold(self) -> float:
+        """Default minimum similarity for a match, set by the face descriptor"""
+        return self.face_detector.match_threshold
+
+    def _set_matrices(self, student_ids: np.ndarray, descriptors: Tuple[np.ndarray, ...]):
+        # Swap in a new snapshot in one assignment so readers never see
+        # matrices of different lengths
+        self._snapshot = (student_ids, tuple(descriptors))
+        self.version += 1
+
+    def _ensure_matrices(self):
+        if not self._snapshot[1]:
+            self._set_matrices(np.empty(0, dtype=np.int64), self.face_detector.empty_descriptors())
+
+    def snapshot(self) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+        """
+        Get a consistent view of the gallery
+
+        Returns:
+            Tuple of (student_ids, descriptors) where descriptors holds one
+            matrix per FaceDetector.face_descriptor part (face regions and
+            histograms, or embeddings) and row i of each array belongs to the
+            same student
+        """
+        return self._snapshot
+
+    def __len__(self) -> int:
+        return len(self._snapshot[0])
+
+    def __contains__(self, student_id: int) -> bool:
+        return student_id in self._sources
+
+    def _ann_active(self) -> bool:
+        return self.ann_index is not None and self.ann_index.trained and len(self) >= self.ann_min_size
+
+    def _refresh_ann(self):
+        # (Re)train once the gallery is big enough, and again whenever it has
+        # doubled since, so the clusters keep fitting the data
+        if self.ann_index is None or len(self) < self.ann_min_size:
+            return
+        if not self.ann_index.trained or len(self) > 2 * self.ann_index.trained_size:
+            self.ann_index.train(*self._snapshot)
+
+    def _compute_descriptor(self, photo_path: str) -> Optional[DetectedFace]:
+        try:
+            faces = self.face_detector.analyze_image(photo_path)
+        except Exception as e:
+            print(f"Error extracting face features from {photo_path}: {str(e)}")
+            return None
+        # The largest face in an enrollment photo is the student
+        return faces[0] if faces else None
+
+    def add(self, student_id: int, photo_path: str, save: bool = True,
+            face: Optional[DetectedFace] = None) -> bool:
+        """
+        Add or replace a student's descriptor, computed from their photo
+
+        Args:
+            student_id: Database id of the student
+            photo_path: Path to the enrolled photo
+            save: Whether to write the on-disk cache afterwards
+            face: Face already detected in the photo, avoids detecting again
+
+        Returns:
+            bool: True if a face was found and the entry stored
+        """
+        if face is None:
+            face = self._compute_descriptor(photo_path)
+        with self._lock:
+            self._ensure_matrices()
+            self._remove_rows([student_id])
+            if face is None:
+                if save:
+                    self.save()
+                return False
+
+            student_ids, descriptors = self._snapshot
+            descriptor = tuple(part[np.newaxis] for part in self.face_detector.face_descriptor(face))
+            self._set_matrices(
+                np.append(student_ids, student_id),
+                [np.concatenate([matrix, part]) for matrix, part in zip(descriptors, descriptor)]
+            )
+            self._sources[student_id] = (photo_path, os.path.getmtime(photo_path))
+            if self.ann_index is not None and self.ann_index.trained:
+                self.ann_index.add([student_id], descriptor)
+            self._refresh_ann()
+            if save:
+                self.save()
+        return True
+
+    def add_many(self, entries: Iterable[Tuple[int, str, DetectedFace]], save: bool = True):
+        """
+        Add or replace the descriptors of several students at once
+
+        Grows the matrices once instead of once per student.
+
+        Args:
+            entries: (student_id, photo_path, face) with the face already
+                detected in the photo
+            save: Whether to write the on-disk cache afterwards
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        with self._lock:
+            self._ensure_matrices()
+            self._remove_rows([student_id for student_id, _, _ in entries])
+            student_ids, descriptors = self._snapshot
+            added = tuple(np.stack(parts) for parts in zip(
+                *(self.face_detector.face_descriptor(face) for _, _, face in entries)))
+            self._set_matrices(
+                np.concatenate([student_ids, np.array([entry[0] for entry in entries], dtype=np.int64)]),
+                [np.concatenate([matrix, part]) for matrix, part in zip(descriptors, added)]
+            )
+            for student_id, photo_path, _ in entries:
+                self._sources[student_id] = (photo_path, os.path.getmtime(photo_path))
+            if self.ann_index is not None and self.ann_index.trained:
+                self.ann_index.add([entry[0] for entry in entries], added)
+            self._refresh_ann()
+            if save:
+                self.save()
+
+    def remove(self, student_id: int, save: bool = True):
+        """
+        Drop a student's descriptor, e.g. after the student was deleted
+
+        Args:
+            student_id: Database id of the student
+            save: Whether to write the on-disk cache afterwards
+        """
+        with self._lock:
+            if self._remove_rows([student_id]) and save:
+                self.save()
+
+    def _remove_rows(self, remove_ids: List[int]) -> bool:
+        student_ids, descriptors = self._snapshot
+        keep = ~np.isin(student_ids, remove_ids)
+        for student_id in remove_ids:
+            self._sources.pop(student_id, None)
+        if self.ann_index is not None and self.ann_index.trained:
+            self.ann_index.remove(remove_ids)
+        if keep.all():
+            return False
+        self._set_matrices(student_ids[keep], [matrix[keep] for matrix in descriptors])
+        return True
+
+    def sync(self, students: Iterable[Tuple[int, Optional[str]]]):
+        """
+        Bring the gallery in line with the database
+
+        Loads the on-disk cache, then recomputes entries whose photo is new or
+        has changed since it was cached and drops entries for students that no
+        longer exist or have no photo.
+
+        Args:
+            students: (student id, photo path) pairs of all enrolled students
+        """
+        with self._lock:
+            self._ensure_matrices()
+            self.load()
+            changed = False
+            wanted = set()
+            for student_id, photo_path in students:
+                if not photo_path or not os.path.exists(photo_path):
+                    continue
+                wanted.add(student_id)
+                if self._sources.get(student_id) != (photo_path, os.path.getmtime(photo_path)):
+                    self.add(student_id, photo_path, save=False)
+                    changed = True
+
+            stale = [student_id for student_id in self._sources if student_id not in wanted]
+            if stale:
+                self._remove_rows(stale)
+                changed = True
+
+            if changed:
+                self.save()
+
+    def load(self) -> bool:
+        """
+        Replace the in-memory gallery with the contents of the cache file
+
+        A cache written with a different face descriptor is ignored, so sync()
+        recomputes every entry.
+
+        Returns:
+            bool: True if the cache file existed and was read
+        """
+        if not os.path.exists(self.cache_path):
+            return False
+
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as data:
+                # Caches from before descriptors were selectable hold histogram descriptors
+                kind = str(data['descriptor_kind']) if 'descriptor_kind' in data else 'histogram'
+                if kind != self.face_detector.descriptor_kind:
+                    print(f"Gallery cache {self.cache_path} holds {kind} descriptors, recomputing")
+                    return False
+                student_ids = data['student_ids']
+                if 'descriptor_0' in data:
+                    count = len(self.face_detector.empty_descriptors())
+                    descriptors = tuple(data[f'descriptor_{i}'] for i in range(count))
+                else:
+                    descriptors = (data['faces'], data['histograms'])
+                photo_paths = data['photo_paths']
+                photo_mtimes = data['photo_mtimes']
+        except Exception as e:
+            print(f"Could not read gallery cache {self.cache_path}: {e}")
+            return False
+
+        with self._lock:
+            self._set_matrices(student_ids, descriptors)
+            self._sources = {
+                int(student_id): (str(path), float(mtime))
+                for student_id, path, mtime in zip(student_ids, photo_paths, photo_mtimes)
+            }
+            if self.ann_index is not None:
+                # An index that doesn't cover exactly these students is rebuilt
+                if not (self.ann_path and self.ann_index.load(self.ann_path)) \
+                        or set(self.ann_index.ids().tolist()) != set(self._sources):
+                    self.ann_index.reset()
+                self._refresh_ann()
+        return True
+
+    def save(self):
+        """Write the gallery to the cache file"""
+        with self._lock:
+            self._ensure_matrices()
+            student_ids, descriptors = self._snapshot
+            sources = [self._sources[int(student_id)] for student_id in student_ids]
+            cache_dir = os.path.dirname(self.cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+
+            # Write to a temporary file first so a crash never leaves a truncated cache
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    student_ids=student_ids,
+                    descriptor_kind=np.array(self.face_detector.descriptor_kind),
+                    **{f'descriptor_{i}': matrix for i, matrix in enumerate(descriptors)},
+                    photo_paths=np.array([path for path, _ in sources], dtype=str),
+                    photo_mtimes=np.array([mtime for _, mtime in sources], dtype=np.float64)
+                )
+            os.replace(temp_path, self.cache_path)
+
+            if self.ann_index is not None and self.ann_path:
+                self.ann_index.save(self.ann_path)
+
+    def match(self, probe: Tuple[np.ndarray, ...], top_k: int = 1,
+              threshold: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Find the enrolled students most similar to a probe face
+
+        Args:
+            probe: Descriptor of the probe face (FaceDetector.face_descriptor)
+            top_k: Maximum number of matches to return
+            threshold: Minimum similarity for a match, defaults to the
+                descriptor's threshold
+
+        Returns:
+            List of (student id, similarity), best match first
+        """
+        with STAGE_SECONDS.time(stage='match'):
+            return self._match(probe, top_k, threshold)
+
+    def _match(self, probe: Tuple[np.ndarray, ...], top_k: int,
+               threshold: Optional[float]) -> List[Tuple[int, float]]:
+        self._ensure_matrices()
+        student_ids, descriptors = self.snapshot()
+        if self._ann_active():
+            # Score only the index's candidates exactly
+            with self._lock:
+                student_ids, descriptors = self.snapshot()
+                candidates = self.ann_index.search(probe, candidates=self.ann_candidates)
+            rows = np.flatnonzero(np.isin(student_ids, candidates))
+            student_ids, descriptors = student_ids[rows], tuple(matrix[rows] for matrix in descriptors)
+
+        matches = self.face_detector.match_descriptors(probe, descriptors, top_k=top_k, threshold=threshold)
+        return [(int(student_ids[index]), score) for index, score in matches]
+
+    def score_student(self, probe: DetectedFace, student_id: int) -> Optional[float]:
+        """
+        Score a probe face against a single enrolled student
+
+        Args:
+            probe: Face detected in the probe image
+            student_id: Database id of the student
+
+        Returns:
+            float: Similarity, or None if the student is not in the gallery
+        """
+        student_ids, descriptors = self.snapshot()
+        rows = np.flatnonzero(student_ids == student_id)
+        if len(rows) == 0:
+            return None
+        return float(self.face_detector.score_descriptors(
+            self.face_detector.face_descriptor(probe), tuple(matrix[rows] for matrix in descriptors))[0])
+
+    def best_match(self, probe: DetectedFace, threshold: Optional[float] = None) -> Tuple[Optional[int], float]:
+        """
+        Find the enrolled student most similar to a detected probe face
+
+        Args:
+            probe: Face detected in the probe image
+            threshold: Minimum similarity for a match, defaults to the
+                descriptor's threshold
+
+        Returns:
+            Tuple of (student id or None, similarity of the match)
+        """
+        matches = self.match(self.face_detector.face_descriptor(probe), top_k=1, threshold=threshold)
+        if not matches:
+            FACE_REJECTIONS.inc()
+            return None, 0.0
+        FACE_MATCHES.inc()
+        return matches[0]
+
+    def best_matches(self, probes: List[DetectedFace],
+                     threshold: Optional[float] = None) -> List[Tuple[Optional[int], float]]:
+        """
+        Match every face detected in a frame against the gallery
+
+        A student can appear only once per frame, so when several faces match
+        the same student only the most similar face keeps the match.
+
+        Args:
+            probes: Faces detected in the probe image
+            threshold: Minimum similarity for a match, defaults to the
+                descriptor's threshold
+
+        Returns:
+            List of (student id or None, similarity), one per probe face
+        """
+        results = [self.best_match(probe, threshold=threshold) for probe in probes]
+
+        best_face_for_student: Dict[int, int] = {}
+        for face_index, (student_id, similarity) in enumerate(results):
+            if student_id is None:
+                continue
+            current = best_face_for_student.get(student_id)
+            if current is None or similarity > results[current][1]:
+                best_face_for_student[student_id] = face_index
+
+        return [
+            (student_id, similarity)
+            if student_id is not None and best_face_for_student[student_id] == face_index
+            else (None, 0.0)
+            for face_index, (student_id, similarity) in enumerate(results)
+        ]
@@ -0,0 +1,53 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+class JobRegistry:
+    """
+    Background jobs started through the API, by job id
+
+    Running jobs are always kept. Finished jobs are kept for ttl seconds so
+    their results can still be polled, and at most max_finished of them, so
+    the registry doesn't grow with every upload.
+
+    Jobs need a job_id and a finished_at attribute: the time.monotonic()
+    time the job ended, or None while it runs.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_finished: int = 100):
+        """
+        Args:
+            ttl: Seconds a finished job is kept
+            max_finished: Finished jobs kept, the oldest are dropped first
+        """
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+
+    def get(self, job_id: str) -> Optional[object]:
+        """The job with an id, or None if it is unknown or was dropped"""
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        finished = sorted(
+            (job.finished_at, job_id) for job_id, job in self._jobs.items() if job.finished_at is not None
+        )
+        expired = [job_id for finished_at, job_id in finished if now - finished_at > self.ttl]
+        over_limit = len(finished) - len(expired) - self.max_finished
+        if over_limit > 0:
+            expired += [job_id for _, job_id in finished[len(expired):len(expired) + over_limit]]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def __len__(self) -> int:
+        return len(self._jobs)
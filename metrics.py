@@ -0,0 +1,226 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Events recorded while capturing: (metric name, label values, value)
+Event = Tuple[str, Tuple[str, ...], float]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _record(self, values: Tuple[str, ...], amount: float):
+        raise NotImplementedError
+
+    def _update(self, labels: Dict[str, str], amount: float):
+        values = self._label_values(labels)
+        events = self.registry._capture_events()
+        if events is not None:
+            events.append((self.name, values, amount))
+        else:
+            self._record(values, amount)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of faces detected"""
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            # Unlabeled counters are exported as 0 before their first increment
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        self._update(labels, amount)
+
+    def _record(self, values: Tuple[str, ...], amount: float):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_label_text(self.labelnames, values)} {_format_value(value)}'
+                for values, value in items]
+
+
+class Gauge(_Metric):
+    """Current value read from a function when the metrics are rendered"""
+    kind = 'gauge'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 function: Callable[[], float]):
+        super().__init__(registry, name, documentation)
+        self.function = function
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name} {_format_value(self.function())}']
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds"""
+    kind = 'histogram'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count per bucket (last one is +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        self._update(labels, value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the seconds spent in the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _record(self, values: Tuple[str, ...], amount: float):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            counts, total = self._values.setdefault(values, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((values, (list(counts), total[0])) for values, (counts, total) in self._values.items())
+        lines = []
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, values, le)} {cumulative}')
+            labels = _label_text(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, rendered in the Prometheus text format
+
+    Updates only take a lock on the metric, so they are cheap enough for the
+    face pipeline's hot path. Worker processes run their jobs inside
+    capture() and send the recorded events back with the result, where
+    replay() adds them to the web process's metrics.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._capture = threading.local()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(self, name, documentation, function))
+
+    def _capture_events(self) -> Optional[List[Event]]:
+        return getattr(self._capture, 'events', None)
+
+    @contextmanager
+    def capture(self) -> Iterator[List[Event]]:
+        """Collect the updates made by this thread in a list instead of applying them"""
+        previous = self._capture_events()
+        self._capture.events = []
+        try:
+            yield self._capture.events
+        finally:
+            self._capture.events = previous
+
+    def replay(self, events: List[Event]):
+        """Apply updates collected by capture(), e.g. in a worker process"""
+        for name, values, amount in events:
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric._record(values, amount)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the face attendance pipeline
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'face_pipeline_stage_seconds', 'Latency of each face pipeline stage', ['stage'])
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Latency of HTTP requests by route', ['route', 'method', 'status'])
+FACES_DETECTED = REGISTRY.counter(
+    'faces_detected_total', 'Faces found by face detection')
+FACE_MATCHES = REGISTRY.counter(
+    'face_matches_total', 'Detected faces matched to an enrolled student')
+FACE_REJECTIONS = REGISTRY.counter(
+    'face_match_rejections_total', 'Detected faces with no enrolled student above the match threshold')
+RECOGNITION_CACHE_LOOKUPS = REGISTRY.counter(
+    'recognition_cache_lookups_total', 'Recognition cache lookups by result', ['result'])
+ATTENDANCE_BATCH_RECORDS = REGISTRY.histogram(
+    'attendance_write_batch_records', 'Attendance records committed per transaction',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
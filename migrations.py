@@ -0,0 +1,63 @@
+import logging
+
+from sqlalchemy import event
+
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+
+def enable_sqlite_wal(engine):
+    """
+    Open SQLite databases in write-ahead logging mode
+
+    With WAL, readers don't block the writer and a commit appends to the
+    log instead of rewriting pages under an exclusive lock. synchronous=FULL
+    syncs the log on every commit, so a commit survives a power failure
+    once it returns; the attendance writer relies on that when it empties
+    its journal. Its group commits keep the number of syncs low. No-op for
+    other databases.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=FULL')
+        cursor.close()
+
+
+def upgrade_database():
+    """
+    Bring the database up to the current schema
+
+    db.create_all() only creates missing tables, so indexes added to an
+    existing table (e.g. in an attendance.db from an older release) are
+    created here. Safe to run on every start.
+    """
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index %s on %s', index.name, table.name)
+                index.create(db.engine)
+                created.append(index.name)
+
+    if created and db.engine.dialect.name == 'sqlite':
+        # Give SQLite's query planner statistics for the new indexes
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('ANALYZE')
+    return created
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and indexes."""
+    created = upgrade_database()
+    print(f"Created {len(created)} index(es): {', '.join(created)}" if created else 'Database is up to date')
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import date, datetime
 from app import db
 
 class Student(db.Model):
@@ -19,10 +19,104 @@ class Attendance(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    date = db.Column(db.Date, default=datetime.utcnow().date)
+    date = db.Column(db.Date, default=date.today)  # Same calendar as the date.today() filters
     status = db.Column(db.String(20), default='in')  # in, out
     confidence_score = db.Column(db.Float, nullable=True)  # Face recognition confidence
     detection_method = db.Column(db.String(50), default='face_detection')  # manual, face_detection
     
+    __table_args__ = (
+        # Day counts and per-student lookups for a day
+        db.Index('ix_attendance_date_student', 'date', 'student_id'),
+        # Per-student history and duplicate checks
+        db.Index('ix_attendance_student_timestamp', 'student_id', 'timestamp', 'status'),
+        # Most recent first listings
+        db.Index('ix_attendance_timestamp', 'timestamp', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Attendance {self.student.name} - {self.date}>'
+    
+    @classmethod
+    def count_for_day(cls, day):
+        """Number of records on a day, answered from the (date, student_id) index"""
+        return db.session.query(db.func.count(cls.id)).filter(cls.date == day).scalar()
+    
+    @classmethod
+    def last_for_student(cls, student_id, day):
+        """A student's latest record on a day, or None"""
+        return cls.query.filter(
+            cls.student_id == student_id,
+            cls.date == day
+        ).order_by(cls.timestamp.desc()).first()
+    
+    @classmethod
+    def recent(cls, limit):
+        """The most recent records, newest first, with their students loaded"""
+        return cls.query.options(db.joinedload(cls.student)).order_by(
+            cls.timestamp.desc(), cls.id.desc()
+        ).limit(limit).all()
+    
+    @classmethod
+    def keyset_page(cls, query, per_page, before=None, after=None):
+        """
+        One page of a query, newest first, paginated over (timestamp, id)
+        
+        Seeks with the (timestamp, id) index instead of counting past an
+        OFFSET, so every page costs the same.
+        
+        Args:
+            query: Attendance query with the filters applied
+            per_page: Records per page
+            before: (timestamp, id) of the last record of the previous page,
+                to get the next older page
+            after: (timestamp, id) of the first record of the next page, to
+                get the next newer page
+                
+        Returns:
+            (records, has_newer, has_older)
+        """
+        key = db.tuple_(cls.timestamp, cls.id)
+        if after is not None:
+            rows = query.filter(key > db.tuple_(*after)).order_by(
+                cls.timestamp.asc(), cls.id.asc()
+            ).limit(per_page + 1).all()
+            has_newer = len(rows) > per_page
+            return list(reversed(rows[:per_page])), has_newer, True
+        
+        if before is not None:
+            query = query.filter(key < db.tuple_(*before))
+        rows = query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(per_page + 1).all()
+        return rows[:per_page], before is not None, len(rows) > per_page
+    
+    @classmethod
+    def summary(cls, *criteria):
+        """
+        Record counts in total, by status and by detection method, from one
+        GROUP BY query
+        
+        Args:
+            *criteria: Filters applied to Attendance joined with Student
+        """
+        rows = db.session.query(
+            cls.status, cls.detection_method, db.func.count(cls.id)
+        ).join(Student).filter(*criteria).group_by(cls.status, cls.detection_method).all()
+        
+        counts = {'total': 0, 'by_status': {}, 'by_method': {}}
+        for status, method, count in rows:
+            counts['total'] += count
+            counts['by_status'][status] = counts['by_status'].get(status, 0) + count
+            counts['by_method'][method] = counts['by_method'].get(method, 0) + count
+        return counts
+    
+    @classmethod
+    def state_since(cls, day, since):
+        """
+        (student_id, status, timestamp, date) of a day's records and of all
+        records from since on, oldest first
+        
+        Written as a UNION so each half uses its own index.
+        """
+        by_day = db.select(cls.student_id, cls.status, cls.timestamp, cls.date).where(cls.date == day)
+        by_time = db.select(cls.student_id, cls.status, cls.timestamp, cls.date).where(cls.timestamp >= since)
+        union = db.union(by_day, by_time).subquery()
+        return db.session.execute(db.select(union).order_by(union.c.timestamp.asc())).all()
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+def face_signature(face_region: np.ndarray) -> int:
+    """
+    Perceptual hash (64-bit difference hash) of a face region
+
+    Consecutive frames of the same face give hashes that differ in only a
+    few bits, unlike a hash of the raw pixels.
+
+    Args:
+        face_region: Grayscale face crop
+
+    Returns:
+        int: 64-bit signature
+    """
+    small = cv2.resize(face_region, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class RecognitionCache:
+    """
+    Bounded LRU cache with expiry, mapping face signatures to recognition results
+
+    A lookup matches any cached signature within max_distance differing bits,
+    so small changes between frames still hit the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 30.0, max_distance: int = 6):
+        """
+        Args:
+            max_entries: Entries kept before the least recently used is evicted
+            ttl: Seconds an entry stays valid
+            max_distance: Maximum Hamming distance between signatures for a hit
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[int, Tuple[float, dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, signature: int, validate: Optional[Callable[[dict], bool]] = None) -> Optional[dict]:
+        """
+        Look up the result cached for a face signature
+
+        Args:
+            signature: Signature from face_signature
+            validate: Optional check of the cached result; if it returns False
+                the entry is dropped and the lookup counts as a miss
+
+        Returns:
+            dict: Cached result, or None on a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = []
+            best_key = None
+            best_distance = self.max_distance + 1
+            for key, (expires, _) in self._entries.items():
+                if expires <= now:
+                    expired.append(key)
+                    continue
+                distance = (key ^ signature).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            for key in expired:
+                del self._entries[key]
+            result = self._entries[best_key][1] if best_key is not None else None
+
+        # The check may be slow (e.g. scoring against the gallery), so other
+        # lookups aren't held up by it
+        valid = result is not None and (validate is None or validate(result))
+
+        with self._lock:
+            # The entry may have been replaced or dropped in the meantime
+            current = self._entries.get(best_key) if best_key is not None else None
+            if not valid:
+                if current is not None and current[1] is result:
+                    del self._entries[best_key]
+                self.misses += 1
+                return None
+
+            if current is not None:
+                self._entries.move_to_end(best_key)
+            self.hits += 1
+            return result
+
+    def put(self, signature: int, result: dict):
+        """Cache a result for a face signature, evicting the least recently used entry if full"""
+        with self._lock:
+            self._entries[signature] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(signature)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, predicate: Callable[[dict], bool]) -> int:
+        """
+        Drop the entries whose result matches a predicate
+
+        Returns:
+            int: Number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key, (_, result) in self._entries.items() if predicate(result)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        """Drop all entries, e.g. after the gallery changed"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl
+            }
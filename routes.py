@@ -1,15 +1,87 @@
+import atexit
+import json
 import os
+import uuid
 import cv2
 import numpy as np
-from datetime import datetime, date, timedelta
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from datetime import datetime, date
+import time
+from flask import render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file, abort, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
 from app import app, db
 from models import Student, Attendance
+import migrations
 from face_detection import FaceDetector
+from face_workers import FaceWorkerPool, PoolBusyError
+from metrics import REGISTRY, RECOGNITION_CACHE_LOOKUPS, REQUEST_SECONDS, STAGE_SECONDS
+from ann_index import IVFIndex
+from gallery import FaceGallery
+from attendance_state import AttendanceStateCache
+from attendance_writer import AttendanceWriter
+from enrollment import BulkEnrollment, EnrollmentJob, open_enrollment_source
+from exports import EXPORT_FORMATS, export_format_available, iter_attendance_export, parse_export_date
+from jobs import JobRegistry
+from recognition_cache import RecognitionCache, face_signature
+from startup import Warmup
+from streaming import CameraStreamRegistry, iter_jpeg_frames, iter_sse
+from thumbnails import THUMBNAIL_FORMATS, ThumbnailStore
+from tracking import FaceBox, TrackingSession, TrackingSessionStore
+from video_attendance import VIDEO_EXTENSIONS, VideoAttendance, VideoAttendanceJob
 
 # Initialize face detector
-face_detector = FaceDetector()
+face_detector = FaceDetector(
+    descriptor=app.config['FACE_DESCRIPTOR'],
+    descriptor_model=app.config['FACE_DESCRIPTOR_MODEL'],
+    match_threshold=app.config['RECOGNITION_THRESHOLD'],
+    detection_size=app.config['DETECTION_SIZE'],
+    models_dir=app.config['FACE_MODELS_DIR']
+)
+
+# CPU-bound face processing for request handlers runs through this pool
+face_pool = FaceWorkerPool(
+    workers=app.config['FACE_WORKERS'],
+    queue_size=app.config['FACE_QUEUE_SIZE'],
+    timeout=app.config['FACE_JOB_TIMEOUT'],
+    detector_options=face_detector.options
+)
+
+# Face descriptors of enrolled students, computed once per photo
+gallery = FaceGallery(
+    face_detector,
+    app.config['GALLERY_CACHE_PATH'],
+    ann_index=IVFIndex(
+        nprobe=app.config['GALLERY_ANN_NPROBE'], vectorize=face_detector.descriptor_vectors
+    ) if app.config['GALLERY_ANN'] else None,
+    ann_path=app.config['GALLERY_ANN_PATH'],
+    ann_min_size=app.config['GALLERY_ANN_MIN_SIZE'],
+    ann_candidates=app.config['GALLERY_ANN_CANDIDATES']
+)
+
+# Students matched to recent faces, keyed by a perceptual hash of the face
+recognition_cache = RecognitionCache(
+    max_entries=app.config['RECOGNITION_CACHE_SIZE'],
+    ttl=app.config['RECOGNITION_CACHE_TTL']
+)
+
+# Resized student photos for the roster page
+thumbnails = ThumbnailStore(app.config['THUMBNAIL_CACHE_DIR'], size=app.config['THUMBNAIL_SIZE'])
+
+# Today's in/out state per student, for the toggle and duplicate check
+attendance_state = AttendanceStateCache()
+
+# Write-behind attendance inserts, journaled and committed in groups
+attendance_writer = AttendanceWriter(
+    Attendance.__table__,
+    app.config['ATTENDANCE_JOURNAL_PATH'],
+    batch_size=app.config['ATTENDANCE_BATCH_SIZE'],
+    flush_interval=app.config['ATTENDANCE_FLUSH_MS'] / 1000
+)
+
+# Per-camera face tracks for the live recognition page
+tracking_sessions = TrackingSessionStore(
+    ttl=app.config['TRACKING_SESSION_TTL'],
+    keyframe_interval=app.config['TRACKING_KEYFRAME_INTERVAL']
+)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
@@ -17,12 +89,208 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def start_face_workers():
+    """Start and warm up the face processing pool"""
+    face_pool.start(inline_detector=face_detector)
+
+def load_gallery():
+    """Load the face gallery cache and refresh entries for new or changed photos"""
+    students = db.session.query(Student.id, Student.photo_path).filter(Student.photo_path.isnot(None)).all()
+    gallery.sync(students)
+
+def start_attendance_writer():
+    """Replay attendance records left in the journal and start writing new ones"""
+    attendance_writer.start(db.engine)
+    atexit.register(attendance_writer.stop)
+
+def load_attendance_state():
+    """Warm the attendance state cache from today's and recent attendance records"""
+    # Records still queued for writing must be in the database first
+    if not attendance_writer.flush(app.config['ATTENDANCE_FLUSH_TIMEOUT']):
+        app.logger.warning('Loading the attendance state with %d record(s) not written yet',
+                           attendance_writer.pending)
+    since = datetime.utcnow() - attendance_state.debounce_window
+    attendance_state.warm(Attendance.state_since(date.today(), since))
+
+def record_recognized_faces(faces, detection_method):
+    """
+    Recognize all detected faces and record attendance for the matched students
+    
+    Faces recognized moments ago are matched from the recognition cache,
+    skipping the gallery scan; the other faces are matched against the whole
+    gallery. The matched students are loaded with one query. Their in/out
+    status and duplicate check come from the attendance state cache, for
+    cached faces too, and the new records are handed to the attendance
+    writer, which commits them together with other check-ins.
+    
+    Args:
+        faces: DetectedFace results for one frame
+        detection_method: Value stored in Attendance.detection_method
+        
+    Returns:
+        List of per-face result dicts, in the same order as faces
+    """
+    results = [None] * len(faces)
+    signatures = [face_signature(face.face_region) for face in faces]
+    
+    matches = [None] * len(faces)
+    uncached = []
+    for index, (face, signature) in enumerate(zip(faces, signatures)):
+        # A cache hit is only trusted if the gallery hasn't changed since and
+        # the face still matches that one student
+        scores = {}
+        def still_matches(entry, face=face, scores=scores):
+            if entry['gallery_version'] != gallery.version:
+                return False
+            scores['confidence'] = gallery.score_student(face, entry['student'])
+            return scores['confidence'] is not None and scores['confidence'] > gallery.threshold
+        
+        entry = recognition_cache.get(signature, validate=still_matches)
+        RECOGNITION_CACHE_LOOKUPS.inc(result='miss' if entry is None else 'hit')
+        if entry is None:
+            uncached.append(index)
+        else:
+            matches[index] = (entry['student'], scores['confidence'])
+    
+    gallery_version = gallery.version
+    for index, match in zip(uncached, gallery.best_matches([faces[index] for index in uncached])):
+        matches[index] = match
+    matched_ids = [student_id for student_id, _ in matches if student_id is not None]
+    
+    students = {}
+    if matched_ids:
+        with STAGE_SECONDS.time(stage='db'):
+            students = {student.id: student for student in Student.query.filter(Student.id.in_(matched_ids))}
+    
+    new_records = []
+    uncached = set(uncached)
+    for index, (face, (student_id, confidence)) in enumerate(zip(faces, matches)):
+        student = students.get(student_id)
+        if student is None:
+            results[index] = {
+                'recognized': False,
+                'face': face.to_dict(),
+                'message': 'Face detected but no matching student found'
+            }
+            continue
+        
+        # The in/out toggle and the 5 minute duplicate check come from the
+        # in-memory state, which is updated before the insert
+        timestamp = datetime.utcnow()
+        new_status, already_marked = attendance_state.mark(student.id, timestamp)
+        
+        result = {
+            'recognized': True,
+            'face': face.to_dict(),
+            'student_name': student.name,
+            'student_id': student.student_id,
+            'confidence': round(confidence * 100, 2),
+            'status': new_status,
+            'already_marked': already_marked
+        }
+        if already_marked:
+            result['message'] = f'{student.name} already checked {new_status} recently'
+        else:
+            new_records.append({
+                'student_id': student.id,
+                'timestamp': timestamp,
+                'date': date.today(),
+                'status': new_status,
+                'confidence_score': confidence,
+                'detection_method': detection_method
+            })
+            result['message'] = f'{student.name} checked {new_status}'
+        results[index] = result
+        if index in uncached:
+            recognition_cache.put(signatures[index], {'student': student.id, 'gallery_version': gallery_version})
+    
+    if new_records:
+        try:
+            attendance_writer.submit(new_records)
+        except Exception:
+            # The state already counts the failed records; rebuild it from the database
+            load_attendance_state()
+            raise
+    
+    return results
+
+def in_app_context(function):
+    """Wrap a function to run in an application context, e.g. on a background thread"""
+    def run():
+        with app.app_context():
+            function()
+    return run
+
+# Startup work, run in the background from the first request (or preloaded,
+# see STARTUP_WARMUP) so importing the app stays cheap
+warmup = Warmup(
+    shared_steps=[
+        ('database', in_app_context(migrations.upgrade_database)),
+        ('models', face_detector.load),
+        ('gallery', in_app_context(load_gallery)),
+    ],
+    process_steps=[
+        ('face_workers', start_face_workers),
+        ('attendance_writer', in_app_context(start_attendance_writer)),
+        ('attendance_state', in_app_context(load_attendance_state)),
+    ]
+)
+
+# Gallery and cache sizes, read when /metrics is scraped
+REGISTRY.gauge('gallery_students', 'Students in the face gallery', lambda: len(gallery))
+REGISTRY.gauge('recognition_cache_entries', 'Faces in the recognition cache',
+               lambda: recognition_cache.stats()['entries'])
+REGISTRY.gauge('attendance_writes_pending', 'Attendance records submitted but not committed yet',
+               lambda: attendance_writer.pending)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# Endpoints that answer while the startup work is still running
+STARTUP_EXEMPT_ENDPOINTS = {'healthz', 'readyz', 'metrics', 'static'}
+
+@app.before_request
+def wait_for_startup():
+    """Start the startup work with the first request and hold other requests until it is done"""
+    warmup.start()
+    if warmup.ready or request.endpoint in STARTUP_EXEMPT_ENDPOINTS:
+        return None
+    if not warmup.wait(app.config['STARTUP_TIMEOUT']):
+        return jsonify(dict(warmup.status(), error='Service is starting')), 503, {'Retry-After': '5'}
+
+@app.after_request
+def observe_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by URL rule rather than path, so /students/<id> is one series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once the database, models, gallery and workers are ready, 503 before"""
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    """Pipeline and request metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     """Dashboard showing overview of students and recent attendance"""
     total_students = Student.query.count()
-    today_attendance = Attendance.query.filter_by(date=date.today()).count()
-    recent_attendance = Attendance.query.order_by(Attendance.timestamp.desc()).limit(5).all()
+    today_attendance = Attendance.count_for_day(date.today())
+    recent_attendance = Attendance.recent(5)
     
     return render_template('index.html', 
                          total_students=total_students,
@@ -54,17 +322,20 @@ def register_student():
             return render_template('register_student.html')
         
         photo_path = None
+        enrolled_face = None
         if 'photo' in request.files:
             file = request.files['photo']
             if file and file.filename != '' and allowed_file(file.filename):
                 filename = secure_filename(f"{student_id}_{file.filename}")
                 photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(photo_path)
+                photo_data = file.read()
+                with open(photo_path, 'wb') as photo_file:
+                    photo_file.write(photo_data)
                 
                 # Validate that the uploaded image contains a face
                 try:
-                    face_found = face_detector.detect_faces_in_image(photo_path)
-                    if not face_found:
+                    faces = face_pool.analyze(photo_data)
+                    if not faces:
                         os.remove(photo_path)  # Remove the uploaded file
                         flash('No face detected in the uploaded image. Please upload a clear photo with a visible face.', 'error')
                         return render_template('register_student.html')
@@ -73,6 +344,9 @@ def register_student():
                         os.remove(photo_path)
                     flash(f'Error processing image: {str(e)}', 'error')
                     return render_template('register_student.html')
+                
+                # The largest face in the photo is the student
+                enrolled_face = faces[0]
         
         # Create new student record
         student = Student(
@@ -85,6 +359,14 @@ def register_student():
         try:
             db.session.add(student)
             db.session.commit()
+            if photo_path:
+                gallery.add(student.id, photo_path, face=enrolled_face)
+                # Create the roster thumbnails now rather than on the first page view
+                for thumbnail_format in thumbnails.formats():
+                    try:
+                        thumbnails.get(photo_path, thumbnail_format)
+                    except (OSError, ValueError) as e:
+                        print(f"Could not create thumbnail of {photo_path}: {e}")
             flash('Student registered successfully!', 'success')
             return redirect(url_for('student_list'))
         except Exception as e:
@@ -93,6 +375,57 @@ def register_student():
     
     return render_template('register_student.html')
 
+# Bulk enrollments started through the API, by job id
+enrollment_jobs = JobRegistry(ttl=app.config['BACKGROUND_JOB_TTL'])
+
+@app.route('/api/students/bulk', methods=['POST'])
+def api_bulk_enroll():
+    """
+    Start enrolling the students in an uploaded zip archive
+    
+    The archive holds a CSV with name, student_id and email columns and the
+    photos. Enrollment runs in the background; poll the returned status URL
+    for progress and per-row results.
+    """
+    # Archives of a whole school are far larger than a single photo
+    request.max_content_length = app.config['BULK_ENROLL_MAX_SIZE']
+    file = request.files.get('archive')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No archive uploaded'}), 400
+    
+    upload_dir = os.path.join(app.instance_path, 'enrollment')
+    os.makedirs(upload_dir, exist_ok=True)
+    archive_path = os.path.join(upload_dir, f'{uuid.uuid4().hex}.zip')
+    file.save(archive_path)
+    
+    try:
+        source = open_enrollment_source(archive_path)
+    except ValueError as e:
+        os.remove(archive_path)
+        return jsonify({'error': str(e)}), 400
+    
+    enrollment = BulkEnrollment(
+        source,
+        gallery,
+        app.config['UPLOAD_FOLDER'],
+        workers=app.config['BULK_ENROLL_WORKERS'],
+        batch_size=app.config['BULK_ENROLL_BATCH_SIZE']
+    )
+    job = EnrollmentJob(enrollment, cleanup_path=archive_path)
+    enrollment_jobs.add(job)
+    return jsonify({
+        'job_id': job.job_id,
+        'status_url': url_for('api_bulk_enroll_status', job_id=job.job_id)
+    }), 202
+
+@app.route('/api/students/bulk/<job_id>')
+def api_bulk_enroll_status(job_id):
+    """Progress and per-row results of a bulk enrollment"""
+    job = enrollment_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/mark_attendance', methods=['GET', 'POST'])
 def mark_attendance():
     """Mark attendance using face detection"""
@@ -107,118 +440,229 @@ def mark_attendance():
             return render_template('mark_attendance.html')
         
         if file and allowed_file(file.filename):
-            # Save uploaded photo temporarily
-            filename = secure_filename(f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(temp_path)
-            
             try:
-                # Detect faces in uploaded image
-                faces_detected = face_detector.detect_faces_in_image(temp_path)
+                # Decode the uploaded photo and detect faces in it
+                faces = face_pool.analyze(file.read())
                 
-                if not faces_detected:
+                if not faces:
                     flash('No faces detected in the uploaded image', 'error')
-                    os.remove(temp_path)
                     return render_template('mark_attendance.html')
                 
-                # Get all registered students
-                students = Student.query.filter(Student.photo_path.isnot(None)).all()
-                matched_students = []
-                
-                for student in students:
-                    if student.photo_path and os.path.exists(student.photo_path):
-                        similarity = face_detector.compare_faces(student.photo_path, temp_path)
-                        if similarity > 0.6:  # Threshold for face matching
-                            matched_students.append({
-                                'student': student,
-                                'confidence': similarity
-                            })
+                # Match the largest uploaded face against all registered students
+                best_id, confidence = gallery.best_match(faces[0])
                 
-                # Clean up temporary file
-                os.remove(temp_path)
-                
-                if matched_students:
-                    # Sort by confidence and take the best match
-                    matched_students.sort(key=lambda x: x['confidence'], reverse=True)
-                    best_match = matched_students[0]
-                    student = best_match['student']
-                    confidence = best_match['confidence']
+                if best_id is not None:
+                    with STAGE_SECONDS.time(stage='db'):
+                        student = Student.query.get(best_id)
                     
                     # Check if attendance already marked today
-                    existing_attendance = Attendance.query.filter_by(
-                        student_id=student.id,
-                        date=date.today()
-                    ).first()
-                    
-                    if existing_attendance:
+                    if attendance_state.last(student.id) is not None:
                         flash(f'Attendance already marked for {student.name} today', 'warning')
                     else:
-                        # Mark attendance
-                        attendance = Attendance(
-                            student_id=student.id,
-                            confidence_score=confidence,
-                            detection_method='face_detection'
-                        )
-                        db.session.add(attendance)
-                        db.session.commit()
+                        # Mark attendance; with no entry today the next status is 'in'
+                        timestamp = datetime.utcnow()
+                        attendance_state.mark(student.id, timestamp, debounce=False)
+                        try:
+                            attendance_writer.submit([{
+                                'student_id': student.id,
+                                'timestamp': timestamp,
+                                'date': date.today(),
+                                'status': 'in',
+                                'confidence_score': confidence,
+                                'detection_method': 'face_detection'
+                            }])
+                        except Exception:
+                            load_attendance_state()
+                            raise
                         flash(f'Attendance marked for {student.name} (Confidence: {confidence:.2%})', 'success')
                 else:
                     flash('No matching student found. Please ensure the student is registered with a photo.', 'error')
                     
             except Exception as e:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
                 flash(f'Error processing image: {str(e)}', 'error')
         else:
             flash('Invalid file format. Please upload PNG, JPG, JPEG, or GIF files.', 'error')
     
     return render_template('mark_attendance.html')
 
+def parse_record_cursor(value):
+    """Parse a 'timestamp_id' pagination cursor, None if missing or invalid"""
+    try:
+        timestamp, record_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(record_id)
+    except (AttributeError, ValueError):
+        return None
+
+def format_record_cursor(record):
+    return f'{record.timestamp.isoformat()}_{record.id}'
+
 @app.route('/attendance_records')
 def attendance_records():
     """Display attendance records with filtering options"""
     # Get filter parameters
     student_filter = request.args.get('student', '')
     date_filter = request.args.get('date', '')
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
     
-    # Build query
-    query = Attendance.query
+    # Build filters, applied to attendance joined with students
+    criteria = []
     
     if student_filter:
-        query = query.join(Student).filter(Student.name.contains(student_filter))
+        criteria.append(Student.name.contains(student_filter))
     
     if date_filter:
         try:
             filter_date = datetime.strptime(date_filter, '%Y-%m-%d').date()
-            query = query.filter(Attendance.date == filter_date)
+            criteria.append(Attendance.date == filter_date)
         except ValueError:
             flash('Invalid date format', 'error')
     
-    # Order by most recent first
-    attendance_records = query.order_by(Attendance.timestamp.desc()).all()
+    # One page, most recent first, with the students loaded by the same query
+    query = Attendance.query.join(Student).options(db.contains_eager(Attendance.student)).filter(*criteria)
+    attendance_records, has_newer, has_older = Attendance.keyset_page(
+        query,
+        per_page,
+        before=parse_record_cursor(request.args.get('before')),
+        after=parse_record_cursor(request.args.get('after'))
+    )
     
-    # Get all students for filter dropdown
-    students = Student.query.all()
+    filters = {'student': student_filter, 'date': date_filter, 'per_page': per_page}
+    newer_url = older_url = None
+    if attendance_records and has_newer:
+        newer_url = url_for('attendance_records', after=format_record_cursor(attendance_records[0]), **filters)
+    if attendance_records and has_older:
+        older_url = url_for('attendance_records', before=format_record_cursor(attendance_records[-1]), **filters)
     
     return render_template('attendance_records.html', 
                          attendance_records=attendance_records,
-                         students=students,
+                         summary=Attendance.summary(*criteria),
+                         newer_url=newer_url,
+                         older_url=older_url,
                          student_filter=student_filter,
                          date_filter=date_filter)
 
+@app.route('/api/attendance/export')
+def export_attendance():
+    """Stream attendance records with student details as CSV or Parquet"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format, use one of: {', '.join(sorted(EXPORT_FORMATS))}"}), 400
+    if not export_format_available(export_format):
+        return jsonify({'error': f'{export_format} export is not available on this server'}), 400
+    
+    try:
+        start = parse_export_date(request.args.get('start'))
+        end = parse_export_date(request.args.get('end'))
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f"attendance_{start or 'start'}_{end or 'end'}.{extension}"
+    return Response(
+        stream_with_context(iter_attendance_export(export_format, start, end)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+# Recorded videos processed through the API, by job id
+video_jobs = JobRegistry(ttl=app.config['BACKGROUND_JOB_TTL'])
+
+def write_video_attendance(records):
+    """Add a video's check-ins to the attendance state and hand them to the attendance writer"""
+    for record in records:
+        attendance_state.record(record['student_id'], record['status'], record['timestamp'], record['date'])
+    try:
+        attendance_writer.submit(records)
+    except Exception:
+        # The state already counts the failed records; rebuild it from the database
+        load_attendance_state()
+        raise
+
+@app.route('/api/attendance/video', methods=['POST'])
+def api_video_attendance():
+    """
+    Start recording attendance from an uploaded video
+    
+    Optional form fields: started_at (local ISO time the recording started,
+    default: upload time minus the video's duration), sample_fps and
+    min_frames. Processing runs in the background; poll the returned status
+    URL for progress and the per-student results.
+    """
+    # Recorded lectures are far larger than a single photo
+    request.max_content_length = app.config['VIDEO_MAX_SIZE']
+    file = request.files.get('video')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No video uploaded'}), 400
+    extension = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
+    if extension not in VIDEO_EXTENSIONS:
+        return jsonify({'error': f"Unsupported video type, use one of {', '.join(sorted(VIDEO_EXTENSIONS))}"}), 400
+    
+    try:
+        started_at = request.form.get('started_at')
+        started_at = datetime.fromisoformat(started_at) if started_at else None
+        sample_fps = request.form.get('sample_fps', app.config['VIDEO_SAMPLE_FPS'], type=float)
+        min_frames = request.form.get('min_frames', app.config['VIDEO_MIN_FRAMES'], type=int)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid started_at: {e}'}), 400
+    
+    upload_dir = os.path.join(app.instance_path, 'videos')
+    os.makedirs(upload_dir, exist_ok=True)
+    video_path = os.path.join(upload_dir, f'{uuid.uuid4().hex}.{extension}')
+    file.save(video_path)
+    
+    try:
+        processing = VideoAttendance(
+            video_path,
+            gallery,
+            started_at=started_at,
+            sample_fps=sample_fps,
+            min_frames=min_frames,
+            workers=app.config['VIDEO_WORKERS'],
+            max_size=app.config['VIDEO_FRAME_SIZE'],
+            write=write_video_attendance
+        )
+    except Exception as e:
+        os.remove(video_path)
+        return jsonify({'error': f'Could not read video: {e}'}), 400
+    
+    job = VideoAttendanceJob(processing, cleanup_path=video_path)
+    video_jobs.add(job)
+    return jsonify({
+        'job_id': job.job_id,
+        'status_url': url_for('api_video_attendance_status', job_id=job.job_id)
+    }), 202
+
+@app.route('/api/attendance/video/<job_id>')
+def api_video_attendance_status(job_id):
+    """Progress and per-student results of a video attendance job"""
+    job = video_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/delete_student/<int:student_id>', methods=['POST'])
 def delete_student(student_id):
     """Delete a student and their associated records"""
     student = Student.query.get_or_404(student_id)
     
+    # The cascade only deletes attendance records that are written, so the
+    # queued ones must be in the database first
+    if not attendance_writer.flush(app.config['ATTENDANCE_FLUSH_TIMEOUT']):
+        flash(f'Attendance records are still being saved, try deleting {student.name} again shortly', 'error')
+        return redirect(url_for('student_list'))
+    
     try:
         # Delete photo file if it exists
         if student.photo_path and os.path.exists(student.photo_path):
+            thumbnails.remove(student.photo_path)
             os.remove(student.photo_path)
         
         # Delete student (cascade will handle attendance records)
         db.session.delete(student)
         db.session.commit()
+        gallery.remove(student_id)
+        recognition_cache.discard(lambda entry: entry['student'] == student_id)
+        attendance_state.forget(student_id)
         flash(f'Student {student.name} deleted successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -231,10 +675,32 @@ def uploaded_file(filename):
     """Serve uploaded files"""
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/students/<int:student_id>/thumbnail')
+def student_thumbnail(student_id):
+    """Serve a student's photo as a small square thumbnail, WebP if the browser accepts it"""
+    photo_path = db.session.query(Student.photo_path).filter(Student.id == student_id).scalar()
+    if not photo_path or not os.path.exists(photo_path):
+        abort(404)
+    
+    thumbnail_format = thumbnails.negotiate(request.accept_mimetypes)
+    try:
+        path, digest = thumbnails.get(photo_path, thumbnail_format)
+    except (OSError, ValueError):
+        abort(404)
+    
+    # The ETag changes with the photo, so clients revalidate with If-None-Match
+    # and get a 304 once max_age has passed
+    response = send_file(path, mimetype=THUMBNAIL_FORMATS[thumbnail_format][0], etag=digest,
+                         conditional=True, max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.vary.add('Accept')
+    return response
+
 @app.route('/live_recognition')
 def live_recognition():
     """Live camera face recognition page"""
-    return render_template('live_recognition.html')
+    return render_template('live_recognition.html', live_transport=app.config['LIVE_TRANSPORT'],
+                           live_upload_size=app.config['LIVE_UPLOAD_SIZE'],
+                           face_crop_size=face_detector.crop_size)
 
 @app.route('/api/detect_faces', methods=['POST'])
 def api_detect_faces():
@@ -245,145 +711,339 @@ def api_detect_faces():
         if not image_data:
             return jsonify({'success': False, 'error': 'No image provided'}), 400
         
-        # Save temporary image
-        temp_filename = f"temp_detection_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-        image_data.save(temp_path)
-        
         try:
-            # Use the enhanced face detection method
-            detection_result = face_detector.detect_and_recognize_in_image(temp_path)
-            
-            # Clean up temporary file
-            os.remove(temp_path)
+            # Decode the frame and detect faces in a worker
+            detection_result = face_pool.detect(image_data.read())
             
             return jsonify(detection_result)
             
+        except (PoolBusyError, TimeoutError) as e:
+            return jsonify({'success': False, 'error': f'Server busy: {str(e)}'}), 503
         except Exception as e:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
             return jsonify({'success': False, 'error': f'Detection error: {str(e)}'}), 500
             
     except Exception as e:
         return jsonify({'success': False, 'error': f'Server error: {str(e)}'}), 500
 
+def parse_face_boxes(value):
+    """
+    Parse the 'boxes' form field of a face crop upload
+    
+    Args:
+        value: JSON list of [x, y, width, height] lists
+        
+    Returns:
+        List of (x, y, width, height) tuples of ints
+        
+    Raises:
+        ValueError: If the value is not such a list
+    """
+    try:
+        boxes = [tuple(int(v) for v in box) for box in json.loads(value)]
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid boxes: {e}')
+    if any(len(box) != 4 or box[2] <= 0 or box[3] <= 0 for box in boxes):
+        raise ValueError('Each box must be [x, y, width, height] with a positive size')
+    return boxes
+
 @app.route('/api/recognize_face', methods=['POST'])
 def api_recognize_face():
-    """API endpoint for real-time face recognition"""
+    """
+    API endpoint for real-time face recognition
+    
+    Accepts either a whole frame as 'image', in which faces are detected, or
+    the client's own face crops as 'faces' files with their boxes in the
+    frame as a 'boxes' JSON list, which skips detection.
+    """
     try:
         # Get image data from request
         image_data = request.files.get('image')
-        if not image_data:
+        crops = request.files.getlist('faces')
+        if not image_data and not crops:
             return jsonify({'error': 'No image provided'}), 400
         
-        # Save temporary image
-        temp_filename = f"temp_recognition_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-        image_data.save(temp_path)
-        
         try:
-            # Detect faces in the image
-            faces_detected = face_detector.detect_faces_in_image(temp_path)
+            if crops:
+                # Only extract the descriptors of the uploaded crops in a worker
+                try:
+                    boxes = parse_face_boxes(request.form.get('boxes', '[]'))
+                    faces = face_pool.describe_crops([crop.read() for crop in crops], boxes)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            else:
+                # Decode the frame, detect faces and extract their descriptors in a worker
+                faces = face_pool.analyze(image_data.read())
             
-            if not faces_detected:
-                os.remove(temp_path)
+            if not faces:
                 return jsonify({'recognized': False, 'message': 'No faces detected'})
             
-            # Get all registered students
-            students = Student.query.filter(Student.photo_path.isnot(None)).all()
-            best_match = None
-            best_confidence = 0.0
+            # Match every face against all registered students and record
+            # the check-ins in a single transaction
+            results = record_recognized_faces(faces, detection_method='live_recognition')
+            recognized = [result for result in results if result['recognized']]
             
-            for student in students:
-                if student.photo_path and os.path.exists(student.photo_path):
-                    similarity = face_detector.compare_faces(student.photo_path, temp_path)
-                    if similarity > best_confidence and similarity > 0.6:  # Minimum threshold
-                        best_confidence = similarity
-                        best_match = student
-            
-            # Clean up temporary file
-            os.remove(temp_path)
-            
-            if best_match:
-                # Determine check-in or check-out based on last attendance record
-                today = date.today()
-                last_attendance = Attendance.query.filter_by(
-                    student_id=best_match.id,
-                    date=today
-                ).order_by(Attendance.timestamp.desc()).first()
-                
-                # Determine status: if last entry was 'in', then this should be 'out', otherwise 'in'
-                new_status = 'out' if last_attendance and last_attendance.status == 'in' else 'in'
-                
-                # Check if already checked in/out in the last 5 minutes to avoid duplicates
-                five_minutes_ago = datetime.now() - timedelta(minutes=5)
-                recent_attendance = Attendance.query.filter(
-                    Attendance.student_id == best_match.id,
-                    Attendance.timestamp >= five_minutes_ago,
-                    Attendance.status == new_status
-                ).first()
-                
-                response_data = {
-                    'recognized': True,
-                    'student_name': best_match.name,
-                    'student_id': best_match.student_id,
-                    'confidence': round(best_confidence * 100, 2),
-                    'status': new_status,
-                    'already_marked': recent_attendance is not None
-                }
-                
-                if not recent_attendance:
-                    # Mark attendance with new status
-                    attendance = Attendance(
-                        student_id=best_match.id,
-                        status=new_status,
-                        confidence_score=best_confidence,
-                        detection_method='live_recognition'
-                    )
-                    db.session.add(attendance)
-                    db.session.commit()
-                    response_data['message'] = f'{best_match.name} checked {new_status}'
-                else:
-                    response_data['message'] = f'{best_match.name} already checked {new_status} recently'
-                
-                return jsonify(response_data)
+            if recognized:
+                # Top-level fields describe the largest recognized face, for
+                # clients that only handle one person per frame
+                response_data = dict(recognized[0])
+                response_data['message'] = '; '.join(result['message'] for result in recognized)
             else:
-                return jsonify({
+                response_data = {
                     'recognized': False, 
                     'message': 'Face detected but no matching student found'
-                })
+                }
+            response_data['faces'] = results
+            response_data['total_faces'] = len(faces)
+            
+            return jsonify(response_data)
                 
+        except (PoolBusyError, TimeoutError) as e:
+            return jsonify({'error': f'Server busy: {str(e)}'}), 503
         except Exception as e:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
             return jsonify({'error': f'Recognition error: {str(e)}'}), 500
             
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+def recognize_tracks(tracks, faces):
+    """
+    Recognize the faces of tracks and record attendance for the matched students
+    
+    Args:
+        tracks: FaceTracks to recognize
+        faces: DetectedFace of each track, with its descriptor
+        
+    Returns:
+        List of the recognition results of newly recognized faces
+    """
+    events = []
+    results = record_recognized_faces(faces, detection_method='live_recognition')
+    for track, result in zip(tracks, results):
+        track.recognition_attempts += 1
+        track.result = result
+        if result['recognized']:
+            events.append(result)
+    return events
+
+def process_tracking_frame(session, image, client_crops=False):
+    """
+    Advance a tracking session by one frame
+    
+    Runs the detector on keyframes and optical flow otherwise, and recognizes
+    faces of new tracks (recording their attendance). The caller must hold
+    session.lock.
+    
+    Args:
+        session: TrackingSession of the camera
+        image: Decoded BGR frame
+        client_crops: Leave recognition to the client, which uploads crops
+            of the tracks listed as 'recognize' from its full-resolution
+            frame (see api_track_faces_recognize)
+        
+    Returns:
+        dict: 'keyframe', current track boxes as 'faces', recognition
+        results of newly recognized faces as 'events' and, with
+        client_crops, the ids of the tracks to recognize as 'recognize'
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    
+    events = []
+    recognize = []
+    keyframe = session.needs_keyframe(gray) or not session.propagate(gray)
+    if keyframe:
+        if client_crops:
+            # The client's crops are described instead, so only detect here
+            faces = [FaceBox(*box, confidence) for box, confidence in face_pool.detect_face_boxes(image)]
+        else:
+            faces = face_pool.analyze_image(image)
+        pending = session.update_with_detections(faces, gray)
+        
+        # Recognize each new face once instead of on every frame
+        if pending and client_crops:
+            recognize = [track.track_id for track in pending]
+        elif pending:
+            events = recognize_tracks(pending, [track.face for track in pending])
+    
+    result = {
+        'keyframe': keyframe,
+        'faces': [track.to_dict() for track in session.tracks],
+        'events': events
+    }
+    if client_crops:
+        result['recognize'] = recognize
+    return result
+
+def stream_frame_processor(camera_id):
+    """Frame processing function for a streaming camera, run on its stream thread"""
+    session = TrackingSession(keyframe_interval=app.config['TRACKING_KEYFRAME_INTERVAL'])
+    
+    def process(image):
+        with app.app_context(), session.lock:
+            return process_tracking_frame(session, image)
+    
+    return process
+
+# Streaming cameras, each processed on its own background thread
+camera_streams = CameraStreamRegistry(
+    stream_frame_processor,
+    idle_timeout=app.config['STREAM_IDLE_TIMEOUT']
+)
+
+@app.route('/api/track_faces', methods=['POST'])
+def api_track_faces():
+    """
+    API endpoint for live tracking: detects on keyframes, recognizes each new face once
+    
+    Clients that send downscaled frames set 'client_crops', so new faces
+    are recognized from their full-resolution crops instead of the small
+    frame (see api_track_faces_recognize).
+    """
+    try:
+        # Get image data and the camera's session id from request
+        image_data = request.files.get('image')
+        session_id = request.form.get('session_id')
+        if not image_data or not session_id:
+            return jsonify({'success': False, 'error': 'Image and session_id are required'}), 400
+        
+        client_crops = request.form.get('client_crops') == '1'
+        session = tracking_sessions.get(session_id)
+        
+        # Drop the frame if this camera's previous frame is still being processed
+        if not session.lock.acquire(blocking=False):
+            return jsonify({
+                'success': True,
+                'dropped': True,
+                'faces': [track.to_dict() for track in session.tracks],
+                'events': []
+            })
+        
+        try:
+            image = face_detector.decode_image(image_data.read())
+            if image is None:
+                return jsonify({'success': False, 'error': 'Could not read image'}), 400
+            
+            result = process_tracking_frame(session, image, client_crops=client_crops)
+            result['success'] = True
+            return jsonify(result)
+        finally:
+            session.lock.release()
+            
+    except (PoolBusyError, TimeoutError) as e:
+        return jsonify({'success': False, 'error': f'Server busy: {str(e)}'}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Tracking error: {str(e)}'}), 500
+
+@app.route('/api/track_faces/recognize', methods=['POST'])
+def api_track_faces_recognize():
+    """
+    Recognize tracked faces from crops of the client's full-resolution frame
+    
+    Takes the crops of the tracks /api/track_faces listed as 'recognize' as
+    'faces' files, with their boxes in the full-resolution frame as a
+    'boxes' JSON list and their track ids as a 'track_ids' JSON list.
+    Tracks that ended or were recognized in the meantime are skipped.
+    """
+    try:
+        session_id = request.form.get('session_id')
+        crops = request.files.getlist('faces')
+        if not session_id or not crops:
+            return jsonify({'success': False, 'error': 'Face crops and session_id are required'}), 400
+        
+        try:
+            boxes = parse_face_boxes(request.form.get('boxes', '[]'))
+            track_ids = [int(track_id) for track_id in json.loads(request.form.get('track_ids', '[]'))]
+            if len(track_ids) != len(crops):
+                raise ValueError(f'Got {len(crops)} face crops but {len(track_ids)} track ids')
+            # In the order of the crops, so each face belongs to the crop's track id
+            faces = face_pool.describe_crops([crop.read() for crop in crops], boxes, sort=False)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        face_of_track = dict(zip(track_ids, faces))
+        session = tracking_sessions.get(session_id)
+        with session.lock:
+            pairs = [(track, face_of_track[track.track_id]) for track in session.tracks
+                     if track.track_id in face_of_track and not track.recognized]
+            events = recognize_tracks([track for track, _ in pairs], [face for _, face in pairs])
+        
+        return jsonify({'success': True, 'events': events})
+        
+    except (PoolBusyError, TimeoutError) as e:
+        return jsonify({'success': False, 'error': f'Server busy: {str(e)}'}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Recognition error: {str(e)}'}), 500
+
+@app.route('/api/stream/<camera_id>/frames', methods=['POST'])
+def api_stream_frames(camera_id):
+    """
+    Accept JPEG frames for a streaming camera
+    
+    The body is one JPEG, or a continuous stream of concatenated JPEGs sent
+    with chunked transfer encoding. Frames are processed asynchronously and
+    results are pushed to /api/stream/<camera_id>/events.
+    """
+    # A continuous stream is expected to be longer than a single upload
+    request.max_content_length = None
+    stream = camera_streams.attach(camera_id)
+    
+    frames = 0
+    try:
+        for frame in iter_jpeg_frames(request.stream):
+            stream.submit(frame)
+            frames += 1
+    except Exception as e:
+        # E.g. the camera disconnected mid-upload; the frames received so far are still processed
+        app.logger.warning('Frame upload of camera %s ended after %d frame(s): %s', camera_id, frames, e)
+        return jsonify({'success': False, 'error': str(e), 'frames_received': frames}), 400
+    finally:
+        stream.detach()
+    
+    return jsonify({
+        'success': True,
+        'frames_received': frames,
+        'frames_dropped': stream.frames_dropped
+    }), 202
+
+@app.route('/api/stream/<camera_id>/events')
+def api_stream_events(camera_id):
+    """Server-Sent Events with face boxes and recognition results of a streaming camera"""
+    stream, listener = camera_streams.subscribe(camera_id)
+    
+    def generate():
+        try:
+            yield from iter_sse(listener)
+        finally:
+            stream.unsubscribe(listener)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/recognition_cache')
+def api_recognition_cache():
+    """Hit/miss counters of the recognition result cache"""
+    return jsonify(recognition_cache.stats())
+
 @app.route('/manual_attendance/<int:student_id>', methods=['POST'])
 def manual_attendance(student_id):
     """Manually mark attendance for a student"""
     student = Student.query.get_or_404(student_id)
     
     # Determine check-in or check-out based on last attendance record
-    today = date.today()
-    last_attendance = Attendance.query.filter_by(
-        student_id=student.id,
-        date=today
-    ).order_by(Attendance.timestamp.desc()).first()
-    
-    # Determine status: if last entry was 'in', then this should be 'out', otherwise 'in'
-    new_status = 'out' if last_attendance and last_attendance.status == 'in' else 'in'
+    timestamp = datetime.utcnow()
+    new_status, _ = attendance_state.mark(student.id, timestamp, debounce=False)
     
     # Mark attendance manually
-    attendance = Attendance(
-        student_id=student.id,
-        status=new_status,
-        detection_method='manual'
-    )
-    db.session.add(attendance)
-    db.session.commit()
+    try:
+        attendance_writer.submit([{
+            'student_id': student.id,
+            'timestamp': timestamp,
+            'date': date.today(),
+            'status': new_status,
+            'detection_method': 'manual'
+        }])
+    except Exception:
+        load_attendance_state()
+        raise
     flash(f'{student.name} manually checked {new_status}', 'success')
     
     return redirect(url_for('student_list'))
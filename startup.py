@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A named startup step
+Step = Tuple[str, Callable[[], None]]
+
+
+class Warmup:
+    """
+    Startup work of the web process (database upgrade, models, gallery),
+    run once in the background instead of at import
+
+    Shared steps build state that child processes inherit when the process
+    forks (e.g. loaded models, shared copy-on-write), so they can run once in
+    a parent process with preload(). Per-process steps (worker processes,
+    background threads) don't survive a fork and run in every process that
+    serves requests. Steps that completed are never run again; a failed step
+    is retried on the next start().
+    """
+
+    def __init__(self, shared_steps: List[Step], process_steps: List[Step]):
+        """
+        Args:
+            shared_steps: (name, function) pairs that may run before a fork
+            process_steps: (name, function) pairs run in each serving process
+        """
+        self.shared_steps = shared_steps
+        self.process_steps = process_steps
+        self._status: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def _run_steps(self, steps: List[Step]):
+        for name, function in steps:
+            if self._status.get(name, {}).get('state') == 'done':
+                continue
+            self._status[name] = {'state': 'running'}
+            started = time.perf_counter()
+            try:
+                function()
+            except Exception as e:
+                logger.exception('Startup step %s failed', name)
+                self._status[name] = {'state': 'failed', 'error': str(e)}
+                raise
+            self._status[name] = {'state': 'done', 'seconds': round(time.perf_counter() - started, 3)}
+            logger.info('Startup step %s done in %.2fs', name, self._status[name]['seconds'])
+
+    def preload(self):
+        """Run the shared steps now, in the calling thread"""
+        with self._lock:
+            self._run_steps(self.shared_steps)
+
+    def run(self):
+        """Run all remaining steps now, in the calling thread"""
+        self._check_fork()
+        with self._lock:
+            self._pid = os.getpid()
+            self._run_steps(self.shared_steps + self.process_steps)
+        self._ready.set()
+
+    def _check_fork(self):
+        if self._pid is not None and self._pid != os.getpid():
+            # A forked child inherits the parent's shared steps but not its
+            # worker processes and threads
+            self._pid = None
+            self._thread = None
+            self._ready = threading.Event()
+            for name, _ in self.process_steps:
+                self._status.pop(name, None)
+
+    def start(self):
+        """Run the remaining steps in a background thread, unless that already happened in this process"""
+        self._check_fork()
+        if self._ready.is_set() or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            # Failed steps are tried again
+            for name in [name for name, status in self._status.items() if status['state'] == 'failed']:
+                del self._status[name]
+            self._thread = threading.Thread(target=self._run_quietly, name='warmup', daemon=True)
+            self._thread.start()
+
+    def _run_quietly(self):
+        try:
+            self.run()
+        except Exception:
+            pass  # Reported by status() and retried on the next start()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all steps are done; False if the timeout expired or a step failed"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready.is_set():
+            if any(status['state'] == 'failed' for status in self._status.values()):
+                return False
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._ready.wait(0.1 if remaining is None else min(0.1, remaining))
+        return True
+
+    def status(self) -> dict:
+        """Readiness and the state of every step, for /readyz"""
+        steps = {}
+        for name, _ in self.shared_steps + self.process_steps:
+            steps[name] = dict(self._status.get(name, {'state': 'pending'}))
+        return {'ready': self.ready, 'steps': steps}
@@ -0,0 +1,285 @@
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from face_detection import FaceDetector
+
+logger = logging.getLogger(__name__)
+
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+
+
+def iter_jpeg_frames(stream, chunk_size: int = 64 * 1024,
+                     max_frame_size: int = 4 * 1024 * 1024) -> Iterator[bytes]:
+    """
+    Split a byte stream of concatenated JPEG images into single frames
+
+    Works for a single JPEG request body as well as for a long-lived chunked
+    upload (e.g. ffmpeg's mjpeg output), without buffering more than one frame.
+
+    Args:
+        stream: File-like object with a read(size) method
+        chunk_size: Bytes read at a time
+        max_frame_size: Frames larger than this are discarded
+
+    Yields:
+        bytes: One complete JPEG image
+    """
+    buffer = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+
+        while True:
+            start = buffer.find(JPEG_START)
+            if start < 0:
+                # Keep a trailing 0xff in case it begins the next start marker
+                buffer = buffer[-1:]
+                break
+            end = buffer.find(JPEG_END, start + 2)
+            if end < 0:
+                buffer = buffer[start:]
+                if len(buffer) > max_frame_size:
+                    buffer = b''
+                break
+            yield buffer[start:end + 2]
+            buffer = buffer[end + 2:]
+
+
+class CameraStream:
+    """
+    Frame processing for one streaming camera
+
+    Incoming frames go into a single slot; a background thread always
+    processes the most recent frame, so when processing falls behind the
+    frames in between are dropped instead of queueing up. Results are
+    published to every subscribed event listener. The stream stops once it
+    has had no frames, uploads or listeners for idle_timeout seconds.
+    """
+
+    def __init__(self, camera_id: str, process_frame: Callable[[np.ndarray], dict],
+                 idle_timeout: float = 30.0, on_idle: Optional[Callable[['CameraStream'], None]] = None):
+        """
+        Args:
+            camera_id: Identifier chosen by the camera client
+            process_frame: Turns a decoded frame into a dict with 'faces' and 'events'
+            idle_timeout: Seconds without frames or listeners before the stream stops
+            on_idle: Called when the stream stops because it went idle
+        """
+        self.camera_id = camera_id
+        self.process_frame = process_frame
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_processed = 0
+        self.frames_failed = 0
+        self._condition = threading.Condition()
+        self._latest: Optional[bytes] = None
+        self._subscribers: List[queue.Queue] = []
+        self._uploads = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f'camera-stream-{camera_id}', daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def submit(self, jpeg: bytes):
+        """Offer a new frame, replacing any frame that has not been processed yet"""
+        with self._condition:
+            self.frames_received += 1
+            if self._latest is not None:
+                self.frames_dropped += 1
+            self._latest = jpeg
+            self._condition.notify()
+
+    def subscribe(self, max_events: int = 100) -> Optional[queue.Queue]:
+        """
+        Register a listener; events are delivered as (event name, data) tuples
+
+        Returns:
+            queue.Queue: The listener, or None if the stream already stopped
+        """
+        listener = queue.Queue(maxsize=max_events)
+        with self._condition:
+            if not self._running:
+                return None
+            self._subscribers.append(listener)
+        return listener
+
+    def unsubscribe(self, listener: queue.Queue):
+        with self._condition:
+            if listener in self._subscribers:
+                self._subscribers.remove(listener)
+
+    def attach(self) -> bool:
+        """Register an upload, which keeps the stream from going idle; False if it already stopped"""
+        with self._condition:
+            if not self._running:
+                return False
+            self._uploads += 1
+            return True
+
+    def detach(self):
+        """Unregister an upload registered with attach()"""
+        with self._condition:
+            self._uploads = max(0, self._uploads - 1)
+
+    def publish(self, event: str, data: dict):
+        with self._condition:
+            subscribers = list(self._subscribers)
+        for listener in subscribers:
+            try:
+                listener.put_nowait((event, data))
+            except queue.Full:
+                # A slow listener loses its oldest event rather than stalling the camera
+                try:
+                    listener.get_nowait()
+                    listener.put_nowait((event, data))
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def _next_frame(self) -> Optional[bytes]:
+        with self._condition:
+            idle_since = time.monotonic()
+            while self._latest is None:
+                self._condition.wait(timeout=1.0)
+                if self._latest is None and not self._subscribers and not self._uploads \
+                        and time.monotonic() - idle_since > self.idle_timeout:
+                    self._running = False
+                    return None
+            frame, self._latest = self._latest, None
+            return frame
+
+    def _run(self):
+        try:
+            while True:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                self._process(frame)
+        finally:
+            # Also when the thread fails, so the registry starts a new stream
+            # instead of handing out one that no longer processes frames
+            with self._condition:
+                self._running = False
+            if self.on_idle is not None:
+                self.on_idle(self)
+
+    def _process(self, frame: bytes):
+        try:
+            image = FaceDetector.decode_image(frame)
+        except Exception:
+            image = None
+        if image is None:
+            # A corrupt frame only costs that frame
+            self.frames_failed += 1
+            logger.warning('Camera %s: could not decode a %d byte frame', self.camera_id, len(frame))
+            self.publish('error', {'error': 'Could not decode frame'})
+            return
+        try:
+            result = self.process_frame(image)
+        except Exception as e:
+            logger.exception('Camera %s: frame processing failed', self.camera_id)
+            self.publish('error', {'error': str(e)})
+            return
+        self.frames_processed += 1
+
+        self.publish('faces', {
+            'faces': result['faces'],
+            'keyframe': result.get('keyframe', False),
+            'frames_dropped': self.frames_dropped
+        })
+        for event in result.get('events', []):
+            self.publish('recognition', event)
+
+
+class CameraStreamRegistry:
+    """Live CameraStreams keyed by camera id"""
+
+    def __init__(self, process_frame_factory: Callable[[str], Callable[[np.ndarray], dict]],
+                 idle_timeout: float = 30.0):
+        """
+        Args:
+            process_frame_factory: Builds the frame processing function for a camera id
+            idle_timeout: Passed to every CameraStream
+        """
+        self.process_frame_factory = process_frame_factory
+        self.idle_timeout = idle_timeout
+        self._streams: Dict[str, CameraStream] = {}
+        self._lock = threading.Lock()
+
+    def get(self, camera_id: str) -> CameraStream:
+        """Get the running stream for a camera, starting one if needed"""
+        with self._lock:
+            stream = self._streams.get(camera_id)
+            if stream is None or not stream.running:
+                stream = CameraStream(
+                    camera_id,
+                    self.process_frame_factory(camera_id),
+                    idle_timeout=self.idle_timeout,
+                    on_idle=self._remove
+                )
+                self._streams[camera_id] = stream
+            return stream
+
+    def attach(self, camera_id: str) -> CameraStream:
+        """Get the running stream for a camera with an upload registered; call its detach() when the upload ends"""
+        while True:
+            stream = self.get(camera_id)
+            # The stream may go idle between get() and attach()
+            if stream.attach():
+                return stream
+
+    def subscribe(self, camera_id: str) -> Tuple[CameraStream, queue.Queue]:
+        """Get the running stream for a camera and a listener registered with it"""
+        while True:
+            stream = self.get(camera_id)
+            listener = stream.subscribe()
+            if listener is not None:
+                return stream, listener
+
+    def _remove(self, stream: CameraStream):
+        with self._lock:
+            if self._streams.get(stream.camera_id) is stream:
+                del self._streams[stream.camera_id]
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Encode one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def iter_sse(listener: queue.Queue, keepalive: float = 15.0) -> Iterator[str]:
+    """
+    Turn a CameraStream listener into a Server-Sent Events body
+
+    Args:
+        listener: Queue returned by CameraStream.subscribe
+        keepalive: Seconds of silence after which a comment line is sent,
+            which keeps proxies from closing the connection
+
+    Yields:
+        str: SSE formatted messages
+    """
+    yield "retry: 2000\n\n"
+    while True:
+        try:
+            event, data = listener.get(timeout=keepalive)
+        except queue.Empty:
+            yield ": keepalive\n\n"
+            continue
+        yield format_sse(event, data)
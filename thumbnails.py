@@ -0,0 +1,130 @@
+import hashlib
+import os
+import threading
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Thumbnail formats: MIME type, file extension and encoder parameters
+THUMBNAIL_FORMATS = {
+    'webp': ('image/webp', '.webp', [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    'jpeg': ('image/jpeg', '.jpg', [cv2.IMWRITE_JPEG_QUALITY, 85]),
+}
+
+# Photos larger than this are decoded at reduced resolution first
+REDUCED_DECODE_MIN_BYTES = 1024 * 1024
+
+
+class ThumbnailStore:
+    """
+    Square, resized copies of student photos, cached on disk
+
+    A thumbnail is named after a digest of its source photo (path, size and
+    modification time) and of its own size and format, so a changed photo
+    gets a new name and a new ETag, and files never need to be invalidated.
+    """
+
+    def __init__(self, cache_dir: str, size: int = 200):
+        """
+        Args:
+            cache_dir: Directory the thumbnails are written to
+            size: Width and height of the thumbnails, in pixels
+        """
+        self.cache_dir = cache_dir
+        self.size = size
+
+    def formats(self):
+        """Formats this OpenCV build can write, preferred first"""
+        return [name for name, (_, extension, _) in THUMBNAIL_FORMATS.items() if cv2.haveImageWriter(extension)]
+
+    def negotiate(self, accept_mimetypes) -> str:
+        """
+        Pick the preferred format a client accepts
+
+        Only formats named explicitly in the Accept header count, since
+        browsers that can't decode WebP still send image/* or */*.
+
+        Args:
+            accept_mimetypes: The request's werkzeug MIMEAccept
+        """
+        accepted = {value for value, quality in accept_mimetypes if quality > 0}
+        for name in self.formats():
+            if name == 'jpeg' or THUMBNAIL_FORMATS[name][0] in accepted:
+                return name
+        return 'jpeg'
+
+    def digest(self, photo_path: str, thumbnail_format: str) -> str:
+        """Name of the thumbnail of a photo, without extension"""
+        stat = os.stat(photo_path)
+        source = f'{os.path.abspath(photo_path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.size}|{thumbnail_format}'
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()[:32]
+
+    def path(self, digest: str, thumbnail_format: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest + THUMBNAIL_FORMATS[thumbnail_format][1])
+
+    def get(self, photo_path: str, thumbnail_format: str = 'jpeg') -> Tuple[str, str]:
+        """
+        Get the thumbnail of a photo, creating it on first use
+
+        Args:
+            photo_path: Path of the student photo
+            thumbnail_format: One of THUMBNAIL_FORMATS
+
+        Returns:
+            Tuple of (thumbnail path, digest for use as ETag)
+
+        Raises:
+            OSError: If the photo does not exist
+            ValueError: If the photo could not be decoded
+        """
+        digest = self.digest(photo_path, thumbnail_format)
+        path = self.path(digest, thumbnail_format)
+        if not os.path.exists(path):
+            self._create(photo_path, path, thumbnail_format)
+        return path, digest
+
+    def _create(self, photo_path: str, path: str, thumbnail_format: str):
+        image = self._decode(photo_path)
+        if image is None:
+            raise ValueError(f'Could not read image from {photo_path}')
+
+        # Center crop to a square, then shrink
+        h, w = image.shape[:2]
+        side = min(h, w)
+        top, left = (h - side) // 2, (w - side) // 2
+        square = image[top:top + side, left:left + side]
+        interpolation = cv2.INTER_AREA if side > self.size else cv2.INTER_LINEAR
+        thumbnail = cv2.resize(square, (self.size, self.size), interpolation=interpolation)
+
+        _, extension, params = THUMBNAIL_FORMATS[thumbnail_format]
+        ok, encoded = cv2.imencode(extension, thumbnail, params)
+        if not ok:
+            raise ValueError(f'Could not encode {thumbnail_format} thumbnail of {photo_path}')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Concurrent requests for the same new thumbnail each write their
+        # own temporary file; the rename makes the result appear atomically
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(encoded.tobytes())
+        os.replace(temp_path, path)
+
+    def _decode(self, photo_path: str) -> Optional[np.ndarray]:
+        # Large JPEGs decode several times faster at a reduced scale; fall
+        # back to full resolution if that would leave the image too small
+        if os.path.getsize(photo_path) >= REDUCED_DECODE_MIN_BYTES:
+            for flag in (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_COLOR_2):
+                image = cv2.imread(photo_path, flag)
+                if image is not None and min(image.shape[:2]) >= self.size:
+                    return image
+        return cv2.imread(photo_path)
+
+    def remove(self, photo_path: str):
+        """Delete the cached thumbnails of a photo, e.g. before the photo is deleted"""
+        if not os.path.exists(photo_path):
+            return
+        for thumbnail_format in THUMBNAIL_FORMATS:
+            path = self.path(self.digest(photo_path, thumbnail_format), thumbnail_format)
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,253 @@
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from face_detection import DetectedFace
+
+# Minimum number of optical-flow points needed to trust a propagated box
+MIN_TRACK_POINTS = 4
+
+
+def box_iou(box1: Tuple[float, float, float, float], box2: Tuple[float, float, float, float]) -> float:
+    """
+    Intersection over union of two (x, y, width, height) boxes
+
+    Returns:
+        float: Overlap between 0.0 (disjoint) and 1.0 (identical)
+    """
+    x1, y1, w1, h1 = box1
+    x2, y2, w2, h2 = box2
+    inter_w = max(0.0, min(x1 + w1, x2 + w2) - max(x1, x2))
+    inter_h = max(0.0, min(y1 + h1, y2 + h2) - max(y1, y2))
+    intersection = inter_w * inter_h
+    union = w1 * h1 + w2 * h2 - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+@dataclass
+class FaceBox:
+    """A detected face without a descriptor, for sessions whose faces are recognized from client crops"""
+    x: int
+    y: int
+    width: int
+    height: int
+    confidence: Optional[float] = None
+
+
+class FaceTrack:
+    """A face followed across the frames of one tracking session"""
+
+    def __init__(self, track_id: int, face: Union[DetectedFace, FaceBox]):
+        self.track_id = track_id
+        self.box = (float(face.x), float(face.y), float(face.width), float(face.height))
+        self.face = face  # Latest detection; a DetectedFace carries the descriptor for recognition
+        self.result: Optional[dict] = None  # Recognition result once recognized
+        self.recognition_attempts = 0
+        self.misses = 0
+
+    @property
+    def recognized(self) -> bool:
+        return self.result is not None and self.result.get('recognized', False)
+
+    def to_dict(self) -> dict:
+        """Box and recognition state in the JSON shape used by the API"""
+        x, y, w, h = (int(round(value)) for value in self.box)
+        data = {
+            'track_id': self.track_id,
+            'x': x,
+            'y': y,
+            'width': w,
+            'height': h,
+            'recognized': self.recognized
+        }
+        if self.recognized:
+            data['student_name'] = self.result['student_name']
+            data['student_id'] = self.result['student_id']
+            data['status'] = self.result['status']
+        return data
+
+
+class TrackingSession:
+    """
+    Tracking state for one live camera
+
+    The face detector only runs on keyframes: every keyframe_interval frames,
+    or as soon as a track can no longer be followed. In between, boxes are
+    moved with sparse Lucas-Kanade optical flow, which is far cheaper than
+    detection.
+    """
+
+    def __init__(self, keyframe_interval: int = 5, max_misses: int = 1,
+                 recognition_attempts: int = 3, iou_threshold: float = 0.3):
+        """
+        Args:
+            keyframe_interval: Run detection at least every this many frames
+            max_misses: Keyframes a track may go undetected before it is dropped
+            recognition_attempts: Keyframes on which an unrecognized track is retried
+            iou_threshold: Minimum overlap to associate a detection with a track
+        """
+        self.keyframe_interval = keyframe_interval
+        self.max_misses = max_misses
+        self.recognition_attempts = recognition_attempts
+        self.iou_threshold = iou_threshold
+        self.tracks: List[FaceTrack] = []
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self._prev_gray: Optional[np.ndarray] = None
+        self._frames_since_keyframe = 0
+        self._track_ids = itertools.count(1)
+
+    def needs_keyframe(self, gray: np.ndarray) -> bool:
+        """Whether the next frame has to go through the full detector"""
+        return (self._prev_gray is None
+                or self._prev_gray.shape != gray.shape
+                or self._frames_since_keyframe + 1 >= self.keyframe_interval)
+
+    def propagate(self, gray: np.ndarray) -> bool:
+        """
+        Move all tracks to a new frame using optical flow
+
+        Args:
+            gray: Grayscale version of the new frame
+
+        Returns:
+            bool: False if any track was lost and a keyframe is needed
+        """
+        for track in self.tracks:
+            box = self._propagate_box(track.box, gray)
+            if box is None:
+                return False
+            track.box = box
+
+        self._prev_gray = gray
+        self._frames_since_keyframe += 1
+        return True
+
+    def _propagate_box(self, box: Tuple[float, float, float, float],
+                       gray: np.ndarray) -> Optional[Tuple[float, float, float, float]]:
+        frame_h, frame_w = gray.shape[:2]
+        x, y, w, h = (int(round(value)) for value in box)
+        x0, y0 = max(0, x), max(0, y)
+        region = self._prev_gray[y0:min(frame_h, y + h), x0:min(frame_w, x + w)]
+        if region.size == 0:
+            return None
+
+        points = cv2.goodFeaturesToTrack(region, maxCorners=40, qualityLevel=0.01, minDistance=4)
+        if points is None or len(points) < MIN_TRACK_POINTS:
+            return None
+        points = points.astype(np.float32) + np.array([x0, y0], dtype=np.float32)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        found = status.ravel() == 1
+        if found.sum() < MIN_TRACK_POINTS:
+            return None
+
+        # The median shift is robust to a few badly tracked points
+        dx, dy = np.median((moved - points).reshape(-1, 2)[found], axis=0)
+        new_x, new_y = box[0] + float(dx), box[1] + float(dy)
+
+        # Lose the track once the face has mostly left the frame
+        inside_w = max(0.0, min(new_x + box[2], frame_w) - max(new_x, 0.0))
+        inside_h = max(0.0, min(new_y + box[3], frame_h) - max(new_y, 0.0))
+        if inside_w * inside_h < 0.5 * box[2] * box[3]:
+            return None
+        return new_x, new_y, box[2], box[3]
+
+    def update_with_detections(self, faces: List[Union[DetectedFace, FaceBox]], gray: np.ndarray) -> List[FaceTrack]:
+        """
+        Reconcile the tracks with the faces found on a keyframe
+
+        Detections are associated with existing tracks greedily by box
+        overlap. Unmatched detections start new tracks; tracks without a
+        detection are dropped after max_misses keyframes.
+
+        Args:
+            faces: Faces detected in the keyframe, FaceBoxes if the tracks
+                are not recognized from these detections
+            gray: Grayscale version of the keyframe
+
+        Returns:
+            List of tracks that still need recognition, i.e. new tracks and
+            tracks whose earlier recognition attempts found no match
+        """
+        pairs = sorted(
+            ((box_iou(track.box, (face.x, face.y, face.width, face.height)), track_index, face_index)
+             for track_index, track in enumerate(self.tracks)
+             for face_index, face in enumerate(faces)),
+            reverse=True
+        )
+        matched_tracks = set()
+        matched_faces = set()
+        for overlap, track_index, face_index in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if track_index in matched_tracks or face_index in matched_faces:
+                continue
+            matched_tracks.add(track_index)
+            matched_faces.add(face_index)
+            track = self.tracks[track_index]
+            face = faces[face_index]
+            track.box = (float(face.x), float(face.y), float(face.width), float(face.height))
+            track.face = face
+            track.misses = 0
+
+        kept = []
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            kept.append(track)
+        for face_index, face in enumerate(faces):
+            if face_index not in matched_faces:
+                kept.append(FaceTrack(next(self._track_ids), face))
+        self.tracks = kept
+
+        self._prev_gray = gray
+        self._frames_since_keyframe = 0
+
+        return [
+            track for track in self.tracks
+            if track.misses == 0
+            and not track.recognized
+            and track.recognition_attempts < self.recognition_attempts
+        ]
+
+
+class TrackingSessionStore:
+    """Tracking sessions keyed by a client-chosen session id, expired when idle"""
+
+    def __init__(self, ttl: float = 60.0, **session_options):
+        """
+        Args:
+            ttl: Seconds after which an unused session is discarded
+            **session_options: Passed to every new TrackingSession
+        """
+        self.ttl = ttl
+        self.session_options = session_options
+        self._sessions: Dict[str, TrackingSession] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> TrackingSession:
+        """Get the session for an id, creating it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, session in self._sessions.items() if now - session.last_used > self.ttl]
+            for key in expired:
+                del self._sessions[key]
+
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = TrackingSession(**self.session_options)
+                self._sessions[session_id] = session
+            session.last_used = now
+            return session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
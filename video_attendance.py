@@ -0,0 +1,337 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+import click
+import cv2
+import numpy as np
+
+from app import app, db
+from face_workers import BatchAnalyzer
+from gallery import FaceGallery
+from models import Attendance, Student
+
+VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'm4v'}
+
+
+@dataclass
+class VideoFrame:
+    """A sampled frame and its position in the video"""
+    index: int
+    offset: float  # Seconds from the start of the video
+    image: np.ndarray
+
+
+def video_duration(path: str) -> Optional[float]:
+    """Length of a video in seconds, None if the container doesn't tell"""
+    capture = cv2.VideoCapture(path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frames = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        return frames / fps if fps > 0 and frames > 0 else None
+    finally:
+        capture.release()
+
+
+def iter_video_frames(path: str, sample_fps: float = 2.0, max_size: int = 1280) -> Iterator[VideoFrame]:
+    """
+    Decode a video file as a stream of sampled frames
+
+    Frames between the samples are only grabbed, not converted, and one
+    frame is held at a time.
+
+    Args:
+        path: Video file readable by OpenCV
+        sample_fps: Frames per second of video to yield, 0 for every frame
+        max_size: Longest side frames are downscaled to, 0 to keep the
+            full resolution
+
+    Yields:
+        VideoFrame
+
+    Raises:
+        ValueError: If the file can't be opened as a video
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        capture.release()
+        raise ValueError(f'Could not open video {path}')
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        step = max(1, int(round(fps / sample_fps))) if fps > 0 and sample_fps > 0 else 1
+        index = -1
+        while capture.grab():
+            index += 1
+            if index % step:
+                continue
+            ok, image = capture.retrieve()
+            if not ok:
+                continue
+            offset = index / fps if fps > 0 else capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            h, w = image.shape[:2]
+            if max_size and max(h, w) > max_size:
+                scale = max_size / max(h, w)
+                image = cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+            yield VideoFrame(index, offset, image)
+    finally:
+        capture.release()
+
+
+@dataclass
+class Sighting:
+    """An enrolled student seen in the video"""
+    first_seen: float  # Seconds from the start of the video
+    last_seen: float
+    frames: int
+    confidence: float  # Best match confidence
+
+
+class VideoAttendance:
+    """
+    Derives attendance from a recorded video
+
+    Sampled frames are decoded one at a time, their faces detected and
+    described in parallel (BatchAnalyzer.analyze_stream) and matched against
+    the gallery as the results come in. Each student is kept once with the
+    time they were first seen, so memory use does not grow with the length
+    of the video. At the end, students seen in at least min_frames sampled
+    frames get one 'in' record at their first sighting, inserted in one
+    transaction or handed to write. Students that already have a record
+    within the video's time span are skipped, so a video can be processed
+    again.
+    """
+
+    def __init__(self, path: str, gallery: FaceGallery, started_at: Optional[datetime] = None,
+                 sample_fps: float = 2.0, min_frames: int = 2, workers: int = 0, max_size: int = 1280,
+                 write: Optional[Callable[[List[dict]], None]] = None):
+        """
+        Args:
+            path: Video file
+            gallery: Gallery of enrolled students to match against
+            started_at: Local time the recording started (default: the
+                file's modification time minus its duration, i.e. assuming
+                the file was last written when the recording ended)
+            sample_fps: Frames per second of video analyzed
+            min_frames: Sampled frames a student must be matched in
+            workers: Processes used for face detection, 0 to run inline
+            max_size: Longest side frames are downscaled to before detection
+            write: Writes the new attendance records (column dicts), e.g.
+                through the web process's attendance writer; by default they
+                are inserted directly
+        """
+        self.path = path
+        self.gallery = gallery
+        self.duration = video_duration(path)
+        if started_at is None:
+            started_at = datetime.fromtimestamp(os.path.getmtime(path)) - timedelta(seconds=self.duration or 0)
+        self.started_at = started_at
+        self.sample_fps = sample_fps
+        self.min_frames = min_frames
+        self.workers = workers
+        self.max_size = max_size
+        self.write = write
+        self.sightings: Dict[int, Sighting] = {}
+        self.counts = {'frames': 0, 'faces': 0, 'failed_frames': 0, 'recorded': 0, 'skipped': 0}
+        self.results: List[dict] = []
+
+    def run(self, on_progress: Optional[Callable[['VideoAttendance'], None]] = None,
+            progress_every: int = 100) -> dict:
+        """
+        Process the video and record attendance; needs an application context
+
+        Args:
+            on_progress: Called every progress_every sampled frames
+
+        Returns:
+            dict: Report with the counts and per-student results
+        """
+        frames = iter_video_frames(self.path, self.sample_fps, self.max_size)
+        # Offsets of the frames in flight; results come back in frame order
+        offsets: deque = deque()
+
+        def images():
+            for frame in frames:
+                offsets.append(frame.offset)
+                yield frame.image
+
+        with BatchAnalyzer(self.workers, self.gallery.face_detector.options) as analyzer:
+            for faces in analyzer.analyze_stream(images()):
+                offset = offsets.popleft()
+                self.counts['frames'] += 1
+                if isinstance(faces, Exception):
+                    self.counts['failed_frames'] += 1
+                else:
+                    self._observe(offset, faces)
+                if on_progress is not None and self.counts['frames'] % progress_every == 0:
+                    on_progress(self)
+
+        self._record()
+        return self.report()
+
+    def _observe(self, offset: float, faces: list):
+        self.counts['faces'] += len(faces)
+        for student_id, confidence in self.gallery.best_matches(faces):
+            if student_id is None:
+                continue
+            sighting = self.sightings.get(student_id)
+            if sighting is None:
+                self.sightings[student_id] = Sighting(offset, offset, 1, confidence)
+            else:
+                sighting.last_seen = offset
+                sighting.frames += 1
+                sighting.confidence = max(sighting.confidence, confidence)
+
+    def _utc(self, offset: float) -> datetime:
+        # Attendance timestamps are naive UTC, like datetime.utcnow()
+        local = self.started_at + timedelta(seconds=offset)
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def _record(self):
+        seen = {student_id: sighting for student_id, sighting in self.sightings.items()
+                if sighting.frames >= self.min_frames}
+        if not seen:
+            return
+
+        span_end = self.duration if self.duration is not None else max(s.last_seen for s in seen.values())
+        already = {student_id for (student_id,) in db.session.query(Attendance.student_id).filter(
+            Attendance.student_id.in_(list(seen)),
+            Attendance.timestamp.between(self._utc(0), self._utc(span_end))
+        ).distinct()}
+        students = dict(db.session.query(Student.id, Student.student_id).filter(Student.id.in_(list(seen))))
+
+        records = []
+        for student_id, sighting in sorted(seen.items(), key=lambda item: item[1].first_seen):
+            if student_id not in students:
+                continue  # Deleted while the video was processed
+            result = {
+                'student_id': students[student_id],
+                'first_seen': round(sighting.first_seen, 2),
+                'last_seen': round(sighting.last_seen, 2),
+                'frames': sighting.frames,
+                'confidence': round(sighting.confidence * 100, 2),
+            }
+            if student_id in already:
+                result['status'] = 'skipped'
+                self.counts['skipped'] += 1
+            else:
+                result['status'] = 'recorded'
+                records.append({
+                    'student_id': student_id,
+                    'timestamp': self._utc(sighting.first_seen),
+                    'date': (self.started_at + timedelta(seconds=sighting.first_seen)).date(),
+                    'status': 'in',
+                    'confidence_score': sighting.confidence,
+                    'detection_method': 'video'
+                })
+            self.results.append(result)
+
+        if records:
+            if self.write is not None:
+                self.write(records)
+            else:
+                try:
+                    db.session.execute(db.insert(Attendance), records)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+            self.counts['recorded'] = len(records)
+
+    def report(self) -> dict:
+        return dict(self.counts, started_at=self.started_at.isoformat(), duration=self.duration,
+                    students=list(self.results))
+
+    def recorded_dates(self) -> List[date]:
+        """Days of the records written by run()"""
+        return sorted({(self.started_at + timedelta(seconds=result['first_seen'])).date()
+                       for result in self.results if result['status'] == 'recorded'})
+
+
+class VideoAttendanceJob:
+    """A video being processed in a background thread of the web process"""
+
+    def __init__(self, processing: VideoAttendance, cleanup_path: Optional[str] = None):
+        """
+        Args:
+            processing: Video to process
+            cleanup_path: Uploaded video to delete when the job ends
+        """
+        self.job_id = uuid.uuid4().hex
+        self.processing = processing
+        self.cleanup_path = cleanup_path
+        self.state = 'running'
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self._thread = threading.Thread(target=self._run, name=f'video-{self.job_id}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with app.app_context():
+                self.processing.run()
+            self.state = 'done'
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+        finally:
+            if self.cleanup_path and os.path.exists(self.cleanup_path):
+                os.remove(self.cleanup_path)
+            self.finished_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        data = {'job_id': self.job_id, 'state': self.state}
+        data.update(self.processing.report())
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+@app.cli.command('video-attendance')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--start', 'started_at', type=click.DateTime(), default=None,
+              help='Local time the recording started (default: file modification time minus duration)')
+@click.option('--fps', 'sample_fps', type=float, default=None, help='Frames per second analyzed (default: VIDEO_SAMPLE_FPS)')
+@click.option('--min-frames', type=int, default=None, help='Frames a student must be seen in (default: VIDEO_MIN_FRAMES)')
+@click.option('--workers', type=int, default=None, help='Face detection processes (default: VIDEO_WORKERS)')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False), help='Write the per-student results as JSON')
+def video_attendance_command(path, started_at, sample_fps, min_frames, workers, report_path):
+    """Record attendance of the students seen in a recorded video.
+
+    Students that already have a record within the video's time span are
+    skipped, so a video can be processed again. The records are written
+    directly to the database; a running web server only sees today's in its
+    in/out state after a restart.
+    """
+    from routes import gallery, warmup
+
+    # Upgrade the database, load the models and the gallery's cache
+    warmup.preload()
+    try:
+        processing = VideoAttendance(
+            path,
+            gallery,
+            started_at=started_at,
+            sample_fps=app.config['VIDEO_SAMPLE_FPS'] if sample_fps is None else sample_fps,
+            min_frames=app.config['VIDEO_MIN_FRAMES'] if min_frames is None else min_frames,
+            workers=app.config['VIDEO_WORKERS'] if workers is None else workers,
+            max_size=app.config['VIDEO_FRAME_SIZE']
+        )
+        report = processing.run(on_progress=lambda job: click.echo(
+            f"frames {job.counts['frames']}, faces {job.counts['faces']}, students {len(job.sightings)}"))
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    click.echo(f"recorded {report['recorded']}, skipped {report['skipped']} "
+               f"({report['frames']} frames, {report['faces']} faces)")
+    if date.today() in processing.recorded_dates():
+        click.echo("Records for today were added: restart the web server so its in/out state "
+                   "and duplicate check include them", err=True)
+    if report_path:
+        with open(report_path, 'w') as handle:
+            json.dump(report, handle, indent=2)